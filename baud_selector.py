@@ -0,0 +1,139 @@
+"""自适应波特率选择
+
+廉价 USB 转串口芯片或较长的线缆在高波特率下容易出现同步超时或校验错误。
+自适应模式下每个端口从已学到的稳定速率（没有记录时从最高速率）开始，
+出错时沿 BAUD_LADDER 逐级降速并在同一连接内重写当前固件，不必重新开始任务。
+
+学到的速率按 USB 序列号（没有序列号时按 Hub 位置）保存到 baud_history.json，
+以后插在同一转接器或同一 Hub 口上的板子直接以该速率开始；
+在较低速率上连续成功 probe_after 次后会尝试升高一级。
+"""
+import json
+import os
+import threading
+import time
+
+from port_monitor import find_port
+
+BAUD_HISTORY_FILE = 'baud_history.json'
+
+# 逐级降速的候选速率
+BAUD_LADDER = (2000000, 1500000, 921600, 460800, 230400, 115200)
+
+
+class BaudHistory:
+    """按身份键持久保存的速率记录"""
+    def __init__(self, path=BAUD_HISTORY_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._records = None
+
+    def _load(self):
+        """首次访问时读入文件（调用方持有锁）"""
+        if self._records is None:
+            self._records = {}
+            if self.path and os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        self._records = json.load(f)
+                except (OSError, ValueError):
+                    self._records = {}
+        return self._records
+
+    def get(self, key):
+        with self._lock:
+            record = self._load().get(key)
+            return dict(record) if record else None
+
+    def put(self, key, record):
+        with self._lock:
+            self._load()[key] = dict(record, updated=time.time())
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._records = {}
+            self._save()
+
+    def _save(self):
+        """先写临时文件再替换，避免写到一半断电损坏（调用方持有锁）"""
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self._records, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+
+class AdaptiveBaud:
+    """为每个端口选择起始速率，并根据烧录结果更新记录
+
+    identify(port) 返回该端口的 PortInfo（或 None），默认每次枚举串口查找。
+    """
+    def __init__(self, history=None, identify=None, ladder=BAUD_LADDER, probe_after=20):
+        self.history = history or BaudHistory()
+        self.identify = identify or find_port
+        self.ladder = tuple(sorted(ladder, reverse=True))
+        self.probe_after = probe_after
+
+    def key(self, port):
+        try:
+            info = self.identify(port)
+        except Exception:
+            info = None
+        return info.identity() if info is not None else f"port:{port}"
+
+    def start_baud(self, port, max_baud):
+        """该端口本次应使用的起始速率，不超过 max_baud"""
+        record = self.history.get(self.key(port))
+        if not record:
+            return max_baud
+        baud = record.get('baud', max_baud)
+        # 在较低速率上已稳定多次，试探升高一级
+        if record.get('ok', 0) >= self.probe_after:
+            baud = self.higher(baud) or baud
+        return min(baud, max_baud)
+
+    def lower(self, baud):
+        """比 baud 低一级的速率，已是最低时返回 None"""
+        for rate in self.ladder:
+            if rate < baud:
+                return rate
+        return None
+
+    def higher(self, baud):
+        """比 baud 高一级的速率，已是最高时返回 None"""
+        for rate in reversed(self.ladder):
+            if rate > baud:
+                return rate
+        return None
+
+    def report(self, port, baud, success, stepped_down=False):
+        """记录一次烧录：baud 为最终使用的速率，stepped_down 表示本次发生过降速"""
+        if not baud:
+            return
+        key = self.key(port)
+        record = self.history.get(key) or {'baud': baud, 'ok': 0, 'fail': 0}
+        if success and not stepped_down:
+            if baud >= record['baud']:
+                # 试探成功或维持原速率
+                record['ok'] = 0 if baud > record['baud'] else record.get('ok', 0) + 1
+                record['baud'] = baud
+            else:
+                record['ok'] = record.get('ok', 0) + 1
+        elif success:
+            record['baud'] = baud
+            record['ok'] = 0
+        else:
+            # 失败原因不一定是链路（如未进入下载模式），只有降过速才记住降到的速率
+            record['fail'] = record.get('fail', 0) + 1
+            if stepped_down:
+                record['baud'] = min(record['baud'], baud)
+            record['ok'] = 0
+        self.history.put(key, record)
+
+
+shared_selector = AdaptiveBaud()
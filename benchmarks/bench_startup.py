@@ -0,0 +1,139 @@
+"""启动时间基准测试
+
+多次启动 esp32_flasher.py（带 --profile-startup --profile-exit），读取程序保存的
+logs/startup_profile.json，统计从进程启动到界面可操作的时间、import 和各初始化阶段的耗时。
+每次在临时目录中启动，不读取也不修改当前的 config.json 和 logs。
+
+需要图形环境；没有显示器时（如 CI）可加 --imports-only，只统计导入主程序模块的耗时。
+
+示例:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10 --json startup.json
+    python benchmarks/bench_startup.py --imports-only
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from startup_profile import EXIT_FLAG, PROFILE_FILE, PROFILE_FLAG  # noqa: E402
+
+MAIN = os.path.join(ROOT, 'esp32_flasher.py')
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run_once(directory, timeout, imports_only=False):
+    """启动一次，返回 (进程总用时, 启动报告)"""
+    if imports_only:
+        # 与 GUI 相同的统计方式：先导入 startup_profile，再导入主程序模块
+        code = (
+            "import sys; sys.argv.append(%r); sys.path.insert(0, %r)\n"
+            "from startup_profile import PROFILE\n"
+            "import esp32_flasher\n"
+            "report = PROFILE.finish()\n"
+            "PROFILE.save(report, 'logs')\n" % (PROFILE_FLAG, ROOT)
+        )
+        command = [sys.executable, '-c', code]
+    else:
+        command = [sys.executable, MAIN, PROFILE_FLAG, EXIT_FLAG]
+    path = os.path.join(directory, 'logs', PROFILE_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=directory, timeout=timeout, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if completed.returncode != 0 or not os.path.exists(path):
+        raise RuntimeError(f"启动失败（退出码 {completed.returncode}）: {completed.stderr.strip()[-500:]}")
+    with open(path, encoding='utf-8') as f:
+        return wall, json.load(f)
+
+
+def summarize(runs):
+    """合并多次启动的结果：总时间和各项耗时取中位数"""
+    def stats(values):
+        return {'p50': percentile(values, 50), 'min': min(values), 'max': max(values)}
+
+    imports = {}
+    phases = {}
+    for _, report in runs:
+        for item in report['imports']:
+            imports.setdefault(item['module'], []).append(item['seconds'])
+        for item in report['phases']:
+            phases.setdefault(item['phase'], []).append(item['seconds'])
+    return {
+        'runs': len(runs),
+        'process': stats([wall for wall, _ in runs]),
+        'interactive': stats([report['interactive'] for _, report in runs]),
+        'imports_total': stats([report['imports_total'] for _, report in runs]),
+        'imports': sorted(
+            ({'module': name, 'p50': percentile(values, 50)} for name, values in imports.items()),
+            key=lambda item: -item['p50']
+        ),
+        'phases': [{'phase': name, 'p50': percentile(values, 50)} for name, values in phases.items()],
+    }
+
+
+def print_report(summary, top):
+    ms = lambda seconds: f"{seconds * 1000:7.1f} ms"  # noqa: E731
+    print(f"{summary['runs']} 次启动（中位数 / 最小 / 最大）:")
+    for key, title in (('process', '进程总用时'), ('interactive', '界面可操作'), ('imports_total', 'import 合计')):
+        stats = summary[key]
+        print(f"  {title:<10} {ms(stats['p50'])} / {ms(stats['min'])} / {ms(stats['max'])}")
+    if summary['phases']:
+        print("初始化阶段:")
+        for item in summary['phases']:
+            print(f"  {item['phase']:<24} {ms(item['p50'])}")
+    print(f"耗时最多的 {top} 个 import:")
+    for item in summary['imports'][:top]:
+        print(f"  {item['module']:<24} {ms(item['p50'])}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="主程序启动时间基准测试")
+    parser.add_argument('--runs', type=int, default=5, help="启动次数")
+    parser.add_argument('--warmup', type=int, default=1, help="不计入统计的预热次数（填充系统文件缓存）")
+    parser.add_argument('--timeout', type=float, default=60, help="单次启动超时（秒）")
+    parser.add_argument('--top', type=int, default=10, help="显示耗时最多的 import 个数")
+    parser.add_argument('--imports-only', action='store_true', help="只统计模块导入，不创建窗口")
+    parser.add_argument('--json', default=None, help="把结果另存为 JSON 文件")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    directory = tempfile.mkdtemp(prefix='esp_startup_')
+    try:
+        runs = []
+        for i in range(args.warmup + args.runs):
+            result = run_once(directory, args.timeout, args.imports_only)
+            if i >= args.warmup:
+                runs.append(result)
+    except (RuntimeError, subprocess.TimeoutExpired) as e:
+        sys.stderr.write(f"错误: {e}\n")
+        return 1
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    summary = summarize(runs)
+    print_report(summary, args.top)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'summary': summary}, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""烧录吞吐量基准测试
+
+在 pty 上启动若干模拟 ESP 设备（见 fake_esp_rom.py），用真实的 esptool、FlashEngine
+和 FlashScheduler 跑完整的烧录流程，统计每小时可烧录的板子数、各阶段耗时和 CPU 占用。
+不需要任何硬件，只能在 Linux / macOS 上运行。
+
+示例:
+    python benchmarks/bench_throughput.py
+    python benchmarks/bench_throughput.py --ports 1,8,16,32 --baud 2000000 --images 3 --image-size 1024
+    python benchmarks/bench_throughput.py --ports 8 --rounds 3 --json result.json
+    python benchmarks/bench_throughput.py --ports 4 --drop-after 128
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from baud_selector import AdaptiveBaud, BaudHistory  # noqa: E402
+from fake_esp_rom import FakeStation  # noqa: E402
+from firmware_cache import FirmwareCache  # noqa: E402
+from flash_engine import RESUME_RETRIES, FlashEngine  # noqa: E402
+from job_scheduler import FINISHED_STATES, FlashScheduler  # noqa: E402
+from metrics import PHASES  # noqa: E402
+
+
+
+def make_images(directory, count, size_kb):
+    """生成 count 个固件：前 3/4 为随机数据（不可压缩），其余为 0xFF，地址按 64KB 对齐依次排列"""
+    firmwares = []
+    size = size_kb * 1024
+    address = 0x10000
+    for i in range(count):
+        path = os.path.join(directory, f"image{i}.bin")
+        random_part = size * 3 // 4
+        with open(path, 'wb') as f:
+            f.write(os.urandom(random_part) + b'\xff' * (size - random_part))
+        firmwares.append((path, hex(address)))
+        address += (size + 0xFFFF) & ~0xFFFF
+    return firmwares
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run_case(port_count, firmwares, rounds, baud, chip, write_speed, diff, max_baud=None, adaptive=False,
+             drop_after=None, resume_retries=RESUME_RETRIES):
+    """在 port_count 个模拟端口上每个烧录 rounds 块板子，返回统计结果
+
+    drop_after 不为 None 时每块板子在写入该字节数后链路中断一次。
+    """
+    station = FakeStation(port_count, chip=chip, write_speed=write_speed, max_baud=max_baud, outage=0.5).start()
+    selector = AdaptiveBaud(BaudHistory(None)) if adaptive else None
+    engine = FlashEngine(baud=baud, cache=FirmwareCache(), diff=diff, before='no_reset', after='no_reset',
+                         baud_selector=selector, resume_retries=resume_retries, resume_backoff=0.2)
+    remaining = {port: rounds for port in station.ports}
+    results = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def runner(job):
+        # 每次烧录前把模拟设备复位回 ROM，相当于换上一块新板子
+        device = station.device(job.port)
+        device.reset()
+        if drop_after is not None:
+            device.drop_after = [device.stats['flash_written'] + drop_after]
+        return engine.flash(job.port, job.firmwares, cancel=job.cancel_event)
+
+    def on_change(job):
+        if job.state not in FINISHED_STATES:
+            return
+        with lock:
+            results.append(job.result)
+            remaining[job.port] -= 1
+            again = remaining[job.port] > 0
+            if not any(remaining.values()):
+                done.set()
+        if again:
+            scheduler.submit(job.port, firmwares)
+
+    scheduler = FlashScheduler(runner, max_workers=port_count, on_change=on_change)
+    cpu_start = os.times()
+    wall_start = time.time()
+    try:
+        for port in station.ports:
+            scheduler.submit(port, firmwares)
+        done.wait()
+    finally:
+        wall = time.time() - wall_start
+        cpu_end = os.times()
+        scheduler.shutdown()
+        station.stop()
+
+    cpu = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+    boards = [r for r in results if r is not None]
+    ok = [r for r in boards if r.success]
+    phases = {}
+    for phase in PHASES:
+        values = [r.phases[phase] for r in ok if phase in r.phases]
+        phases[phase] = {
+            'mean': sum(values) / len(values) if values else 0.0,
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+        }
+    cycle = [r.elapsed for r in ok]
+    return {
+        'ports': port_count,
+        'boards': len(boards),
+        'failed': len(boards) - len(ok),
+        'errors': sorted(set(r.error for r in boards if not r.success)),
+        'wall': wall,
+        'boards_per_hour': len(ok) * 3600.0 / wall if wall else 0.0,
+        'cycle_mean': sum(cycle) / len(cycle) if cycle else 0.0,
+        'cycle_p95': percentile(cycle, 95),
+        'cpu_seconds': cpu,
+        'cpu_percent': cpu * 100.0 / wall if wall else 0.0,
+        'cpu_per_board': cpu / len(boards) if boards else 0.0,
+        'recoveries': sum(len(r.recoveries) for r in boards),
+        'phases': phases,
+    }
+
+
+def print_report(case):
+    print(f"\n端口数 {case['ports']}: {case['boards']} 块板子, 失败 {case['failed']}, 用时 {case['wall']:.1f} 秒")
+    if case['errors']:
+        print(f"  错误: {case['errors']}")
+    if case['recoveries']:
+        print(f"  链路中断后恢复 {case['recoveries']} 次")
+    print(f"  吞吐量: {case['boards_per_hour']:.0f} 块/小时, 单板周期 平均 {case['cycle_mean']:.2f} 秒 / p95 {case['cycle_p95']:.2f} 秒")
+    print(f"  CPU: {case['cpu_seconds']:.2f} 秒 ({case['cpu_percent']:.0f}%), 每块板子 {case['cpu_per_board'] * 1000:.0f} 毫秒")
+    for phase in PHASES:
+        stats = case['phases'][phase]
+        if not stats['mean']:
+            continue
+        print(f"  {phase:<8} 平均 {stats['mean'] * 1000:8.1f} ms  p50 {stats['p50'] * 1000:8.1f} ms  p95 {stats['p95'] * 1000:8.1f} ms")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="烧录吞吐量基准测试（模拟设备）")
+    parser.add_argument('--ports', default='1,8,16,32', help="逗号分隔的端口数列表")
+    parser.add_argument('--baud', type=int, default=921600, help="烧录波特率")
+    parser.add_argument('--images', type=int, default=1, help="每块板子烧录的固件数")
+    parser.add_argument('--image-size', type=int, default=256, help="每个固件的大小（KB）")
+    parser.add_argument('--rounds', type=int, default=2, help="每个端口连续烧录的板子数")
+    parser.add_argument('--chip', default='ESP32-S3', choices=('ESP32', 'ESP32-S3'), help="模拟的芯片型号")
+    parser.add_argument('--write-speed', type=int, default=400, help="模拟 flash 写入速度（KB/s），0 表示不限")
+    parser.add_argument('--diff', action='store_true', help="使用差分烧录")
+    parser.add_argument('--max-baud', type=int, default=None, help="模拟劣质转接器：高于该波特率时丢弃数据帧")
+    parser.add_argument('--adaptive', action='store_true', help="使用自适应波特率")
+    parser.add_argument('--drop-after', type=int, default=None, help="模拟链路中断：每块板子写入该数量（KB）后断开一次")
+    parser.add_argument('--resume-retries', type=int, default=RESUME_RETRIES, help="链路中断后续写的次数，0 表示不恢复")
+    parser.add_argument('--json', default=None, help="把结果另存为 JSON 文件")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not hasattr(os, 'openpty'):
+        sys.stderr.write("错误: 当前系统不支持 pty，请在 Linux 或 macOS 上运行\n")
+        return 2
+    port_counts = [int(x) for x in args.ports.split(',') if x.strip()]
+    directory = tempfile.mkdtemp(prefix='esp_bench_')
+    try:
+        firmwares = make_images(directory, args.images, args.image_size)
+        print(f"芯片 {args.chip}, 波特率 {args.baud}, 固件 {args.images} x {args.image_size}KB, "
+              f"每端口 {args.rounds} 块板子")
+        cases = []
+        for count in port_counts:
+            case = run_case(count, firmwares, args.rounds, args.baud, args.chip, args.write_speed * 1024, args.diff,
+                            args.max_baud, args.adaptive,
+                            args.drop_after * 1024 if args.drop_after is not None else None, args.resume_retries)
+            print_report(case)
+            cases.append(case)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'cases': cases}, f, indent=2, ensure_ascii=False)
+    return 0 if all(case['failed'] == 0 for case in cases) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
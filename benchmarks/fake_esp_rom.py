@@ -0,0 +1,360 @@
+"""基于 pty 的模拟 ESP32 / ESP32-S3 串口引导程序
+
+实现了 esptool 烧录所需的最小协议子集：同步、读写寄存器、芯片识别、
+stub 上传（应答 OHAI）、修改波特率、压缩写入、flash MD5、读 flash 和擦除。
+按当前波特率和设定的 flash 写入速度模拟耗时，无需任何硬件即可压测整条烧录流程。
+
+由于 pty 不支持 DTR/RTS，连接和复位需使用 no_reset 模式。
+"""
+import hashlib
+import os
+import select
+import struct
+import threading
+import time
+import tty
+import zlib
+
+ESP_FLASH_BEGIN = 0x02
+ESP_FLASH_DATA = 0x03
+ESP_FLASH_END = 0x04
+ESP_MEM_BEGIN = 0x05
+ESP_MEM_END = 0x06
+ESP_MEM_DATA = 0x07
+ESP_SYNC = 0x08
+ESP_WRITE_REG = 0x09
+ESP_READ_REG = 0x0A
+ESP_SPI_SET_PARAMS = 0x0B
+ESP_SPI_ATTACH = 0x0D
+ESP_CHANGE_BAUDRATE = 0x0F
+ESP_FLASH_DEFL_BEGIN = 0x10
+ESP_FLASH_DEFL_DATA = 0x11
+ESP_FLASH_DEFL_END = 0x12
+ESP_SPI_FLASH_MD5 = 0x13
+ESP_GET_SECURITY_INFO = 0x14
+ESP_ERASE_FLASH = 0xD0
+ESP_ERASE_REGION = 0xD1
+ESP_READ_FLASH = 0xD2
+
+ROM_INVALID_RECV_MSG = 0x05
+CHIP_DETECT_MAGIC_REG_ADDR = 0x40001000
+SPI_CMD_USR = 1 << 18
+SPIFLASH_RDID = 0x9F
+
+# 各芯片在协议层面的差异
+CHIPS = {
+    'ESP32': {
+        'magic': 0x00F01D83,
+        'chip_id': None,             # ESP32 ROM 不支持 GET_SECURITY_INFO
+        'rom_status_len': 4,
+        'spi_base': 0x3FF42000,
+        'spi_usr2_offs': 0x24,
+        'spi_w0_offs': 0x80,
+        'mac_regs': (0x3FF5A008, 0x3FF5A004),
+    },
+    'ESP32-S3': {
+        'magic': 0x9,
+        'chip_id': 9,
+        'rom_status_len': 4,
+        'spi_base': 0x60002000,
+        'spi_usr2_offs': 0x20,
+        'spi_w0_offs': 0x58,
+        'mac_regs': (0x60007048, 0x60007044),
+    },
+}
+
+FLASH_SIZE_IDS = {4: 0x16, 8: 0x17, 16: 0x18, 32: 0x19}
+
+
+def slip_encode(packet):
+    return b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+
+class FakeEspRom:
+    """一个模拟设备：打开 pty 并在后台线程中应答 esptool 的命令
+
+    write_speed / erase_speed 为 flash 写入和擦除速度（字节/秒），
+    md5_speed 为片上计算 MD5 的速度，设为 0 表示不模拟耗时。
+    max_baud 模拟劣质转接器：波特率高于该值时丢弃较长的帧（短命令仍能通过）。
+    drop_after 模拟链路中断：写入 flash 的数据累计达到该字节数时，刚应答的那一块不写入，
+    之后 outage 秒内不响应任何命令，再复位回 ROM 引导程序；可以是列表，依次触发多次。
+    """
+    def __init__(self, chip='ESP32-S3', flash_mb=16, mac=None, write_speed=400 * 1024,
+                 erase_speed=1024 * 1024, md5_speed=16 * 1024 * 1024, simulate_baud=True, max_baud=None,
+                 drop_after=None, outage=1.0):
+        self.chip = chip
+        self.params = CHIPS[chip]
+        self.flash = bytearray(b'\xff' * (flash_mb << 20))
+        self.flash_id = (FLASH_SIZE_IDS.get(flash_mb, 0x18) << 16) | 0x4068
+        self.mac = mac or os.urandom(6)
+        self.write_speed = write_speed
+        self.erase_speed = erase_speed
+        self.md5_speed = md5_speed
+        self.simulate_baud = simulate_baud
+        self.max_baud = max_baud
+        self.drop_after = sorted(drop_after if isinstance(drop_after, (list, tuple)) else
+                                 [drop_after] if drop_after is not None else [])
+        self.outage = outage
+        self._outage_until = 0.0
+        self.baud = 115200
+        self.stats = {'commands': 0, 'rx_bytes': 0, 'tx_bytes': 0, 'flash_written': 0, 'dropped': 0,
+                      'link_drops': 0}
+        self._reset_state()
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=1)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def reset(self):
+        """模拟复位回到 ROM 引导程序（flash 内容保留）"""
+        self._reset_state()
+
+    def _reset_state(self):
+        self.is_stub = False
+        self.baud = 115200
+        self.regs = {}
+        # MAC 的高 2 字节和低 4 字节分别存放在两个 efuse 寄存器中
+        high, low = self.params['mac_regs']
+        self.regs[high] = struct.unpack('>I', b'\0\0' + bytes(self.mac[:2]))[0]
+        self.regs[low] = struct.unpack('>I', bytes(self.mac[2:]))[0]
+        self.regs[CHIP_DETECT_MAGIC_REG_ADDR] = self.params['magic']
+        self._defl = None
+        self._busy_until = 0.0
+
+    # ---- 传输层 ----
+
+    def _wire_delay(self, nbytes):
+        """按当前波特率模拟串口传输耗时（每字节 10 位）"""
+        if self.simulate_baud:
+            time.sleep(nbytes * 10.0 / self.baud)
+
+    def _send(self, packet):
+        frame = slip_encode(packet)
+        self._wire_delay(len(frame))
+        view = memoryview(frame)
+        while view:
+            written = os.write(self.master, view)
+            view = view[written:]
+        self.stats['tx_bytes'] += len(frame)
+
+    def _respond(self, op, val=0, data=b'', status=0, error=0):
+        status_len = 2 if self.is_stub else self.params['rom_status_len']
+        status_bytes = bytes([status, error]) + b'\0' * (status_len - 2)
+        body = data + status_bytes
+        self._send(struct.pack('<BBHI', 1, op, len(body), val) + body)
+
+    def _frames(self):
+        """从 pty 读出完整的 SLIP 帧"""
+        buf = bytearray()
+        in_frame = False
+        escape = False
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                chunk = os.read(self.master, 65536)
+            except OSError:
+                return
+            self.stats['rx_bytes'] += len(chunk)
+            for b in chunk:
+                if b == 0xC0:
+                    if in_frame and buf:
+                        packet = bytes(buf)
+                        buf.clear()
+                        in_frame = False
+                        self._wire_delay(len(packet))
+                        yield packet
+                    else:
+                        in_frame = True
+                        buf.clear()
+                elif not in_frame:
+                    continue
+                elif escape:
+                    buf.append(0xC0 if b == 0xDC else 0xDB)
+                    escape = False
+                elif b == 0xDB:
+                    escape = True
+                else:
+                    buf.append(b)
+
+    def _run(self):
+        for packet in self._frames():
+            if len(packet) < 8 or packet[0] != 0:
+                continue
+            if self.max_baud and self.baud > self.max_baud and len(packet) > 256:
+                self.stats['dropped'] += 1
+                continue
+            if time.time() < self._outage_until:
+                self.stats['dropped'] += 1
+                continue
+            op, size, _chk = struct.unpack('<xBHI', packet[:8])
+            data = packet[8:8 + size]
+            # stub 先应答再写 flash，下一条命令需等上一块写完
+            wait = self._busy_until - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.stats['commands'] += 1
+            try:
+                self._handle(op, data)
+            except Exception:
+                self._respond(op, status=1, error=ROM_INVALID_RECV_MSG)
+
+    # ---- 命令处理 ----
+
+    def _busy(self, nbytes, speed):
+        if speed:
+            self._busy_until = max(self._busy_until, time.time()) + nbytes / float(speed)
+
+    def _handle(self, op, data):
+        if op == ESP_SYNC:
+            # ROM 对同步命令应答 8 次且 val 非零；stub 的 val 为 0
+            for _ in range(8):
+                self._respond(op, val=0 if self.is_stub else 0x20120707)
+        elif op == ESP_READ_REG:
+            addr, = struct.unpack('<I', data[:4])
+            self._respond(op, val=self.regs.get(addr, 0))
+        elif op == ESP_WRITE_REG:
+            for i in range(0, len(data) - 15, 16):
+                addr, value, mask, _delay = struct.unpack('<IIII', data[i:i + 16])
+                self._write_reg(addr, value, mask)
+            self._respond(op)
+        elif op == ESP_GET_SECURITY_INFO:
+            if self.params['chip_id'] is None:
+                self._respond(op, status=1, error=ROM_INVALID_RECV_MSG)
+            else:
+                info = struct.pack('<IBBBBBBBBII', 0, 0, 0, 0, 0, 0, 0, 0, 0, self.params['chip_id'], 0)
+                self._respond(op, data=info)
+        elif op in (ESP_MEM_BEGIN, ESP_MEM_DATA, ESP_SPI_SET_PARAMS, ESP_SPI_ATTACH):
+            self._respond(op)
+        elif op == ESP_MEM_END:
+            _no_entry, entry = struct.unpack('<II', data[:8])
+            self._respond(op)
+            if entry:
+                self.is_stub = True
+                self._send(b'OHAI')
+        elif op == ESP_CHANGE_BAUDRATE:
+            baud, _old = struct.unpack('<II', data[:8])
+            self._respond(op)
+            self.baud = baud
+        elif op == ESP_FLASH_DEFL_BEGIN:
+            write_size, _blocks, _block_size, offset = struct.unpack('<IIII', data[:16])
+            if not self.is_stub:
+                # ROM 在开始时整体擦除
+                self._erase(offset, write_size)
+            self._defl = [zlib.decompressobj(), offset]
+            self._respond(op)
+        elif op == ESP_FLASH_DEFL_DATA:
+            length, _seq = struct.unpack('<II', data[:8])
+            out = self._defl[0].decompress(data[16:16 + length])
+            self._respond(op)
+            offset = self._defl[1]
+            self._defl[1] += len(out)
+            self._write_flash(offset, out)
+        elif op == ESP_FLASH_BEGIN:
+            size, _blocks, _block_size, offset = struct.unpack('<IIII', data[:16])
+            self._erase(offset, size)
+            self._respond(op)
+        elif op in (ESP_FLASH_END, ESP_FLASH_DEFL_END):
+            self._respond(op)
+        elif op == ESP_SPI_FLASH_MD5:
+            addr, size = struct.unpack('<II', data[:8])
+            self._busy(size, self.md5_speed)
+            wait = self._busy_until - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            digest = hashlib.md5(self.flash[addr:addr + size])
+            self._respond(op, data=digest.digest() if self.is_stub else digest.hexdigest().encode())
+        elif op in (ESP_ERASE_FLASH, ESP_ERASE_REGION):
+            if op == ESP_ERASE_FLASH:
+                self._erase(0, len(self.flash))
+            else:
+                offset, size = struct.unpack('<II', data[:8])
+                self._erase(offset, size)
+            # 擦除命令在擦除完成后才应答
+            wait = self._busy_until - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self._respond(op)
+        elif op == ESP_READ_FLASH:
+            offset, length, block_size, _in_flight = struct.unpack('<IIII', data[:16])
+            self._respond(op)
+            self._read_flash(offset, length, block_size)
+        else:
+            self._respond(op, status=1, error=ROM_INVALID_RECV_MSG)
+
+    def _write_reg(self, addr, value, mask):
+        old = self.regs.get(addr, 0)
+        self.regs[addr] = (old & ~mask) | (value & mask)
+        base = self.params['spi_base']
+        if addr == base and value & SPI_CMD_USR:
+            # 模拟 SPI 用户命令：RDID 返回 flash ID，命令立即完成
+            command = self.regs.get(base + self.params['spi_usr2_offs'], 0) & 0xFF
+            if command == SPIFLASH_RDID:
+                self.regs[base + self.params['spi_w0_offs']] = self.flash_id
+            self.regs[addr] = 0
+
+    def _erase(self, offset, size):
+        size = min(size, len(self.flash) - offset)
+        self.flash[offset:offset + size] = b'\xff' * size
+        self._busy(size, self.erase_speed)
+
+    def _write_flash(self, offset, data):
+        if self.drop_after and self.stats['flash_written'] + len(data) >= self.drop_after[0]:
+            # 已应答但未写入，随后链路中断、板子复位
+            self.drop_after.pop(0)
+            self.stats['link_drops'] += 1
+            self._outage_until = time.time() + self.outage
+            self.reset()
+            return
+        self.flash[offset:offset + len(data)] = data
+        self.stats['flash_written'] += len(data)
+        self._busy(len(data), self.write_speed)
+
+    def _read_flash(self, offset, length, block_size):
+        """stub 的读 flash 协议：逐块发送，等待主机确认，最后发送 MD5"""
+        data = bytes(self.flash[offset:offset + length])
+        frames = self._frames()
+        for i in range(0, length, block_size):
+            self._send(data[i:i + block_size])
+            next(frames, None)  # 主机回传已接收字节数
+        self._send(hashlib.md5(data).digest())
+
+
+class FakeStation:
+    """一组模拟设备，模拟多端口烧录站"""
+    def __init__(self, count, chip='ESP32-S3', **kwargs):
+        self.devices = [FakeEspRom(chip=chip, **kwargs) for _ in range(count)]
+
+    @property
+    def ports(self):
+        return [device.port for device in self.devices]
+
+    def start(self):
+        for device in self.devices:
+            device.start()
+        return self
+
+    def stop(self):
+        for device in self.devices:
+            device.stop()
+
+    def device(self, port):
+        for device in self.devices:
+            if device.port == port:
+                return device
+        return None
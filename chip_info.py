@@ -0,0 +1,114 @@
+"""芯片识别结果与识别缓存
+
+识别结果以 ChipInfo 表示：芯片型号、版本、特性、MAC、flash ID 和容量。
+ChipCache 以端口的 USB 身份（序列号 + VID:PID，或 Hub 位置）为键保存上一次的识别结果。
+同一块板子重新插入或重试时，直接按已知型号连接，省去 esptool 的自动识别
+（ESP32 上识别失败后还要再复位连接一次），MAC 相同时也跳过读取描述和 flash ID；
+MAC 不同说明换了板子，旧记录作废并重新识别。
+"""
+import threading
+import time
+
+# esptool 的 CHIP_NAME 与内部参数名的对应关系
+CHIP_MAP = {
+    'ESP32': 'esp32',
+    'ESP32-S3': 'esp32s3',
+    'ESP32-S2': 'esp32s2',
+    'ESP32-C3': 'esp32c3',
+    'ESP32-C6': 'esp32c6',
+    'ESP32-P4': 'esp32p4'
+}
+
+
+def get_chip_param(chip_type):
+    """将检测到的芯片类型转换为对应的参数"""
+    return CHIP_MAP.get(chip_type)
+
+
+class ChipInfo:
+    """一块芯片的识别结果"""
+    def __init__(self, chip, description=None, revision=None, features=None, mac=None,
+                 flash_id=None, flash_size=None):
+        self.chip = chip
+        self.chip_param = CHIP_MAP.get(chip)
+        self.description = description or chip
+        self.revision = revision
+        self.features = list(features or [])
+        self.mac = mac
+        self.flash_id = flash_id
+        self.flash_size = flash_size
+        self.detected = time.time()
+
+    @classmethod
+    def from_loader(cls, esp, mac=None):
+        """从已连接的 esptool 加载器读取型号、版本和特性（不含 flash 信息）"""
+        try:
+            description = esp.get_chip_description()
+        except Exception:
+            description = esp.CHIP_NAME
+        try:
+            revision = f"v{esp.get_major_chip_version()}.{esp.get_minor_chip_version()}"
+        except Exception:
+            revision = None
+        try:
+            features = esp.get_chip_features()
+        except Exception:
+            features = []
+        return cls(esp.CHIP_NAME, description, revision, features, mac)
+
+    def to_dict(self):
+        return {
+            'chip': self.chip,
+            'description': self.description,
+            'revision': self.revision,
+            'features': self.features,
+            'mac': self.mac,
+            'flash_id': '0x%06x' % self.flash_id if self.flash_id is not None else None,
+            'flash_size': self.flash_size,
+        }
+
+    def __repr__(self):
+        return f"ChipInfo({self.chip!r}, mac={self.mac!r}, flash={self.flash_size!r})"
+
+
+class ChipCache:
+    """按 USB 身份缓存识别结果，线程安全"""
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, info):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = info
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+    def invalidate(self, key=None):
+        """删除一条记录；key 为 None 时清空"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+shared_chip_cache = ChipCache()
@@ -0,0 +1,244 @@
+"""配置文件与产品方案
+
+config.json 中除全工位共用的设置（并发数、指标端口等）外，按产品保存多个方案，
+每个方案包含固件表（路径、地址、是否启用）、固件包、波特率和烧录选项，切换产品时直接换用对应方案。
+方案中的项优先于同名的全局设置，如某个产品单独指定 verify。
+
+修改只更新内存，由后台线程在最后一次修改 delay 秒后写盘：先写临时文件再替换，
+写到一半断电或崩溃也不会损坏原文件。旧版（没有 version 字段）的配置在读入时自动迁移到默认方案。
+读入失败时不会用默认配置悄悄覆盖原文件：格式损坏的文件在第一次写盘前改名为 config.json.bad，
+版本更高（由新版程序写入）或无法读取的文件本次运行不再写盘。
+
+    {
+      "version": 2,
+      "active_profile": "默认",
+      "max_workers": 8,
+      "profiles": {
+        "默认": {"firmware_paths": [...], "firmware_addresses": [...], "firmware_enables": [...],
+                 "bundle_path": "", "baud": "2000000", "diff": false, "adaptive_baud": false, ...}
+      }
+    }
+"""
+import copy
+import json
+import os
+import threading
+
+CONFIG_FILE = 'config.json'
+CONFIG_VERSION = 2
+DEFAULT_PROFILE = '默认'
+FIRMWARE_SLOTS = 8
+
+# 属于产品方案的项，其余为全局设置
+PROFILE_KEYS = (
+    'firmware_paths',
+    'firmware_addresses',
+    'firmware_enables',
+    'bundle_path',
+    'baud',
+    'diff',
+    'adaptive_baud',
+    'auto_flash',
+    'verify',
+    'verify_samples',
+    'sparse',
+    'chip_erase',
+    'resume_retries',
+)
+
+
+def default_profile():
+    return {
+        'firmware_paths': [''] * FIRMWARE_SLOTS,
+        'firmware_addresses': ['0x0'] * FIRMWARE_SLOTS,
+        'firmware_enables': [False] * FIRMWARE_SLOTS,
+        'bundle_path': '',
+    }
+
+
+def default_config():
+    return {
+        'version': CONFIG_VERSION,
+        'active_profile': DEFAULT_PROFILE,
+        'profiles': {DEFAULT_PROFILE: default_profile()},
+    }
+
+
+def migrate(config):
+    """把旧版配置升级到当前版本，返回新的字典"""
+    config = copy.deepcopy(config)
+    version = config.get('version', 1)
+    if version > CONFIG_VERSION:
+        raise ValueError(f"配置文件版本 {version} 高于程序支持的 {CONFIG_VERSION}，请升级程序")
+    if version < 2:
+        # 第 1 版只有一套固件表，直接放在顶层
+        profile = default_profile()
+        for key in PROFILE_KEYS:
+            if key in config:
+                profile[key] = config.pop(key)
+        config['profiles'] = {DEFAULT_PROFILE: profile}
+        config['active_profile'] = DEFAULT_PROFILE
+    config['version'] = CONFIG_VERSION
+    if not config.get('profiles'):
+        config['profiles'] = {DEFAULT_PROFILE: default_profile()}
+    if config.get('active_profile') not in config['profiles']:
+        config['active_profile'] = next(iter(config['profiles']))
+    return config
+
+
+class ConfigStore:
+    """线程安全的配置存储，修改后延迟合并写盘
+
+    on_error(exc) 在写盘失败时于写入线程中调用。
+    """
+    def __init__(self, path=CONFIG_FILE, delay=0.5, on_error=None):
+        self.path = path
+        self.delay = delay
+        self.on_error = on_error
+        self.data = default_config()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._pending = False
+        self._thread = None
+        self.read_only = False      # 为 True 时不写盘
+        self._set_aside = False     # 为 True 时写盘前先把损坏的原文件改名保留
+
+    def load(self):
+        """读入配置文件；文件不存在时使用默认配置
+
+        格式错误时抛出 ValueError，内存中保持默认配置，原文件在第一次写盘前改名为 .bad；
+        版本过高时抛出 ValueError、读取失败时抛出 OSError，之后不再写盘。
+        """
+        if not os.path.exists(self.path):
+            return self
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                raw = json.load(f)
+        except ValueError as e:
+            self._set_aside = True
+            raise ValueError(f"{self.path} 格式错误: {e}，保存时原文件将改名为 {self.path}.bad") from e
+        except OSError:
+            self.read_only = True
+            raise
+        if not isinstance(raw, dict):
+            self._set_aside = True
+            raise ValueError(f"{self.path} 格式错误: 顶层不是对象，保存时原文件将改名为 {self.path}.bad")
+        try:
+            data = migrate(raw)
+        except ValueError as e:
+            # 由新版程序写入，保留原文件给新版使用
+            self.read_only = True
+            raise ValueError(f"{e}；本次运行不保存配置修改") from e
+        except (TypeError, AttributeError) as e:
+            self._set_aside = True
+            raise ValueError(f"{self.path} 格式错误: {e}，保存时原文件将改名为 {self.path}.bad") from e
+        with self._lock:
+            self.data = data
+        return self
+
+    def settings(self, profile=None):
+        """全局设置与方案合并后的视图（副本）"""
+        with self._lock:
+            merged = {k: v for k, v in self.data.items() if k not in ('version', 'active_profile', 'profiles')}
+            merged.update(self.data['profiles'][profile or self.data['active_profile']])
+            return copy.deepcopy(merged)
+
+    @property
+    def active(self):
+        with self._lock:
+            return self.data['active_profile']
+
+    def profile_names(self):
+        with self._lock:
+            return list(self.data['profiles'])
+
+    def update_profile(self, **values):
+        """修改当前方案"""
+        with self._lock:
+            self.data['profiles'][self.data['active_profile']].update(copy.deepcopy(values))
+        self.schedule_save()
+
+    def update_global(self, **values):
+        """修改全局设置"""
+        with self._lock:
+            self.data.update(copy.deepcopy(values))
+        self.schedule_save()
+
+    def switch(self, name):
+        """切换当前方案，返回合并后的设置"""
+        with self._lock:
+            if name not in self.data['profiles']:
+                raise KeyError(f"方案不存在: {name}")
+            self.data['active_profile'] = name
+        self.schedule_save()
+        return self.settings()
+
+    def create(self, name, copy_from=None):
+        """新建方案（默认复制当前方案）并切换过去"""
+        name = name.strip()
+        with self._lock:
+            if not name:
+                raise ValueError("方案名称不能为空")
+            if name in self.data['profiles']:
+                raise ValueError(f"方案已存在: {name}")
+            source = self.data['profiles'][copy_from or self.data['active_profile']]
+            self.data['profiles'][name] = copy.deepcopy(source)
+        return self.switch(name)
+
+    def delete(self, name):
+        """删除方案，不能删除最后一个；删除当前方案时切换到剩下的第一个"""
+        with self._lock:
+            if name not in self.data['profiles']:
+                raise KeyError(f"方案不存在: {name}")
+            if len(self.data['profiles']) == 1:
+                raise ValueError("至少保留一个方案")
+            del self.data['profiles'][name]
+            if self.data['active_profile'] == name:
+                self.data['active_profile'] = next(iter(self.data['profiles']))
+        self.schedule_save()
+
+    def schedule_save(self):
+        """请求写盘，delay 秒内的多次修改合并为一次写入"""
+        with self._lock:
+            self._pending = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._dirty.set()
+
+    def flush(self):
+        """立即写入尚未保存的修改（退出前调用）"""
+        self._write()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            # 等到一段时间内没有新的修改再写
+            self._dirty.clear()
+            while self._dirty.wait(self.delay):
+                self._dirty.clear()
+            self._write()
+
+    def _write(self):
+        with self._write_lock:
+            with self._lock:
+                if not self._pending or self.read_only:
+                    return
+                self._pending = False
+                text = json.dumps(self.data, indent=2, ensure_ascii=False)
+            tmp = self.path + '.tmp'
+            try:
+                if self._set_aside:
+                    # 保留读不出来的原文件，便于手工找回其中的方案
+                    if os.path.exists(self.path):
+                        os.replace(self.path, self.path + '.bad')
+                    self._set_aside = False
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except OSError as e:
+                if self.on_error is not None:
+                    self.on_error(e)
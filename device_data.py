@@ -0,0 +1,374 @@
+"""每块板子独有的数据（序列号、校准 NVS 分区）
+
+共用固件之外，每块板子还需要写入按 MAC 分配的序列号和校准数据。
+DeviceDataStage 在读到 MAC 后立即把生成任务交给线程池，
+与 stub 上传、共用固件写入并行，写完共用固件时 NVS 分区通常已经生成好，
+随后在同一个串口会话中写入，生成过程不占用单板周期。
+
+NVS 模板使用 ESP-IDF nvs_partition_gen 的 CSV 格式（key,type,encoding,value），
+value 和文件路径中可以使用占位符：
+    {serial}   分配的序列号        {mac}      aa:bb:cc:dd:ee:ff
+    {mac_hex}  aabbccddeeff        {chip}     芯片型号，如 ESP32-S3
+例如:
+    key,type,encoding,value
+    factory,namespace,,
+    serial_no,data,string,{serial}
+    mac,data,string,{mac}
+    cal,file,binary,calibration/{mac_hex}.bin
+"""
+import base64
+import csv
+import json
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from firmware_cache import FirmwareImage
+
+SERIAL_FILE = 'serials.json'
+
+NVS_PAGE_SIZE = 4096
+NVS_ENTRY_SIZE = 32
+NVS_MAX_ENTRIES = 126
+NVS_FIRST_ENTRY_OFFSET = 64
+NVS_PAGE_ACTIVE = 0xFFFFFFFE
+NVS_PAGE_FULL = 0xFFFFFFFC
+NVS_VERSION2 = 0xFE
+NVS_CHUNK_ANY = 0xFF
+NVS_MAX_KEY_LENGTH = 15
+NVS_MAX_STRING_SIZE = 4000
+
+# NVS 条目类型：(类型码, struct 格式)
+NVS_PRIMITIVES = {
+    'u8': (0x01, '<B'),
+    'i8': (0x11, '<b'),
+    'u16': (0x02, '<H'),
+    'i16': (0x12, '<h'),
+    'u32': (0x04, '<I'),
+    'i32': (0x14, '<i'),
+    'u64': (0x08, '<Q'),
+    'i64': (0x18, '<q'),
+}
+NVS_TYPE_SZ = 0x21
+NVS_TYPE_BLOB_DATA = 0x42
+NVS_TYPE_BLOB_INDEX = 0x48
+
+
+class DeviceDataError(ValueError):
+    """模板错误或生成失败"""
+
+
+def _crc32(data):
+    return zlib.crc32(data, 0xFFFFFFFF) & 0xFFFFFFFF
+
+
+class NvsPartition:
+    """按 ESP-IDF NVS 第 2 版页格式生成分区镜像"""
+    def __init__(self, size):
+        if size % NVS_PAGE_SIZE or size < 3 * NVS_PAGE_SIZE:
+            raise DeviceDataError(f"NVS 分区大小须为 4KB 的整数倍且不小于 0x3000: 0x{size:x}")
+        self.size = size
+        self.pages = []
+        self.entry = NVS_MAX_ENTRIES
+        self.namespaces = {}
+        self.namespace = None
+
+    def _new_page(self):
+        # 保留最后一页为空，NVS 需要一个空页做垃圾回收
+        if (len(self.pages) + 2) * NVS_PAGE_SIZE > self.size:
+            raise DeviceDataError(f"数据超出 NVS 分区大小 0x{self.size:x}")
+        if self.pages:
+            struct.pack_into('<I', self.pages[-1], 0, NVS_PAGE_FULL)
+        page = bytearray(b'\xff' * NVS_PAGE_SIZE)
+        struct.pack_into('<II', page, 0, NVS_PAGE_ACTIVE, len(self.pages))
+        page[8] = NVS_VERSION2
+        struct.pack_into('<I', page, 28, _crc32(bytes(page[4:28])))
+        self.pages.append(page)
+        self.entry = 0
+
+    def _write_entries(self, data, count):
+        """从当前条目开始写入 count 个条目（调用方已确保本页放得下）"""
+        page = self.pages[-1]
+        offset = NVS_FIRST_ENTRY_OFFSET + self.entry * NVS_ENTRY_SIZE
+        page[offset:offset + len(data)] = data
+        for i in range(self.entry, self.entry + count):
+            # 每个条目在状态位图中占 2 位，11 为空，10 为已写入
+            page[32 + i // 4] &= ~(1 << ((i % 4) * 2)) & 0xFF
+        self.entry += count
+
+    def _header(self, ns, type_code, span, key, chunk=NVS_CHUNK_ANY):
+        header = bytearray(b'\xff' * NVS_ENTRY_SIZE)
+        header[0:4] = bytes((ns, type_code, span, chunk))
+        name = key.encode('ascii')
+        header[8:24] = name + b'\x00' * (16 - len(name))
+        return header
+
+    def _seal(self, header):
+        struct.pack_into('<I', header, 4, _crc32(bytes(header[0:4] + header[8:32])))
+        return header
+
+    def _reserve(self, count):
+        if self.entry + count > NVS_MAX_ENTRIES:
+            self._new_page()
+
+    def set_namespace(self, name):
+        self._check_key(name)
+        if name not in self.namespaces:
+            index = len(self.namespaces) + 1
+            self.namespaces[name] = index
+            self._reserve(1)
+            header = self._header(0, NVS_PRIMITIVES['u8'][0], 1, name)
+            header[24] = index
+            self._write_entries(self._seal(header), 1)
+        self.namespace = self.namespaces[name]
+
+    def add(self, key, encoding, value):
+        """写入一个键；value 为整数、字符串或字节串，encoding 与 nvs_partition_gen 一致"""
+        if self.namespace is None:
+            raise DeviceDataError(f"键 {key} 之前没有声明 namespace")
+        self._check_key(key)
+        if encoding in NVS_PRIMITIVES:
+            type_code, fmt = NVS_PRIMITIVES[encoding]
+            try:
+                packed = struct.pack(fmt, int(value, 0) if isinstance(value, str) else value)
+            except (struct.error, ValueError):
+                raise DeviceDataError(f"键 {key} 的值 {value!r} 不是有效的 {encoding}")
+            self._reserve(1)
+            header = self._header(self.namespace, type_code, 1, key)
+            header[24:24 + len(packed)] = packed
+            self._write_entries(self._seal(header), 1)
+        elif encoding == 'string':
+            data = (value if isinstance(value, bytes) else str(value).encode('utf-8')) + b'\x00'
+            if len(data) > NVS_MAX_STRING_SIZE:
+                raise DeviceDataError(f"键 {key} 的字符串超过 {NVS_MAX_STRING_SIZE} 字节")
+            count = (len(data) + NVS_ENTRY_SIZE - 1) // NVS_ENTRY_SIZE
+            # 与 nvs_partition_gen 一致：字符串不能占满一页的最后一个条目
+            self._reserve(count + 2)
+            header = self._header(self.namespace, NVS_TYPE_SZ, count + 1, key)
+            struct.pack_into('<H', header, 24, len(data))
+            struct.pack_into('<I', header, 28, _crc32(data))
+            self._write_entries(self._seal(header), 1)
+            self._write_entries(data, count)
+        elif encoding in ('binary', 'hex2bin', 'base64'):
+            self._add_blob(key, _decode_binary(key, encoding, value))
+        else:
+            raise DeviceDataError(f"键 {key} 的编码 {encoding} 不受支持")
+
+    def _add_blob(self, key, data):
+        """按页拆分为数据块，最后写入块索引"""
+        chunk = 0
+        offset = 0
+        while True:
+            # 本页只剩最后一个条目时放不下任何数据，换到新页，不写空数据块
+            if self.entry >= NVS_MAX_ENTRIES - 1:
+                self._new_page()
+            room = (NVS_MAX_ENTRIES - self.entry - 1) * NVS_ENTRY_SIZE
+            part = data[offset:offset + room]
+            count = (len(part) + NVS_ENTRY_SIZE - 1) // NVS_ENTRY_SIZE
+            header = self._header(self.namespace, NVS_TYPE_BLOB_DATA, count + 1, key, chunk)
+            struct.pack_into('<H', header, 24, len(part))
+            struct.pack_into('<I', header, 28, _crc32(part))
+            self._write_entries(self._seal(header), 1)
+            self._write_entries(part, count)
+            chunk += 1
+            offset += len(part)
+            if offset >= len(data):
+                break
+        self._reserve(1)
+        header = self._header(self.namespace, NVS_TYPE_BLOB_INDEX, 1, key)
+        struct.pack_into('<IBB', header, 24, len(data), chunk, 0)
+        self._write_entries(self._seal(header), 1)
+
+    @staticmethod
+    def _check_key(key):
+        if not key or len(key) > NVS_MAX_KEY_LENGTH or not key.isascii():
+            raise DeviceDataError(f"NVS 键名须为 1-{NVS_MAX_KEY_LENGTH} 个 ASCII 字符: {key!r}")
+
+    def to_bytes(self):
+        data = b''.join(self.pages)
+        return data + b'\xff' * (self.size - len(data))
+
+
+def _decode_binary(key, encoding, value):
+    if isinstance(value, bytes):
+        return value
+    try:
+        if encoding == 'hex2bin':
+            return bytes.fromhex(value)
+        if encoding == 'base64':
+            return base64.b64decode(value, validate=True)
+    except ValueError:
+        raise DeviceDataError(f"键 {key} 的值不是有效的 {encoding}")
+    return value.encode('utf-8')
+
+
+class NvsTemplate:
+    """从 CSV 模板生成 NVS 分区，写入 address 处、大小为 size 的分区"""
+    def __init__(self, path, address=0x9000, size=0x6000):
+        self.path = path
+        self.address = address
+        self.size = size
+        self.base_dir = os.path.dirname(os.path.abspath(path))
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            rows = [row for row in csv.reader(f) if row and not row[0].startswith('#')]
+        if rows and rows[0][0].strip() == 'key':
+            rows = rows[1:]
+        self.rows = []
+        for row in rows:
+            row = [cell.strip() for cell in row] + [''] * (4 - len(row))
+            key, kind, encoding, value = row[:4]
+            if kind not in ('namespace', 'data', 'file'):
+                raise DeviceDataError(f"{path}: 键 {key} 的类型 {kind} 无效")
+            self.rows.append((key, kind, encoding, value))
+        if not self.rows or self.rows[0][1] != 'namespace':
+            raise DeviceDataError(f"{path}: 第一行须为 namespace")
+        # 分区大小错误在开始烧录前暴露
+        NvsPartition(size)
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    def generate(self, context):
+        """按上下文（serial、mac 等）生成分区镜像"""
+        nvs = NvsPartition(self.size)
+        for key, kind, encoding, value in self.rows:
+            try:
+                value = value.format_map(context)
+            except (KeyError, ValueError) as e:
+                raise DeviceDataError(f"键 {key} 的占位符无效: {e}")
+            if kind == 'namespace':
+                nvs.set_namespace(key)
+            elif kind == 'file':
+                path = value if os.path.isabs(value) else os.path.join(self.base_dir, value)
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                except OSError as e:
+                    raise DeviceDataError(f"键 {key} 读取文件失败: {e}")
+                nvs.add(key, encoding, data if encoding == 'binary' else data.decode('utf-8').strip())
+            else:
+                nvs.add(key, encoding, value)
+        return nvs.to_bytes()
+
+
+class SerialAllocator:
+    """按 MAC 分配序列号并持久保存，同一块板子重新烧录时沿用原序列号"""
+    def __init__(self, path=SERIAL_FILE, fmt='{:08d}', start=1):
+        self.path = path
+        self.fmt = fmt
+        self.start = start
+        self._lock = threading.Lock()
+        self._records = None
+
+    def _load(self):
+        """首次访问时读入文件（调用方持有锁）"""
+        if self._records is None:
+            self._records = {'next': self.start, 'devices': {}}
+            if self.path and os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        self._records = json.load(f)
+                except (OSError, ValueError):
+                    raise DeviceDataError(f"序列号文件 {self.path} 损坏，为避免重复分配已停止")
+        return self._records
+
+    def allocate(self, mac):
+        with self._lock:
+            records = self._load()
+            serial = records['devices'].get(mac)
+            if serial is None:
+                serial = self.fmt.format(records['next'])
+                records['next'] += 1
+                records['devices'][mac] = serial
+                self._save()
+            return serial
+
+    def _save(self):
+        """先写临时文件再替换（调用方持有锁）；保存失败时不能继续分配"""
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self._records, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            raise DeviceDataError(f"保存序列号文件失败: {e}")
+
+
+class DeviceData:
+    """一块板子的专属数据：序列号和待写入的 [(地址, FirmwareImage)]"""
+    def __init__(self, serial, images):
+        self.serial = serial
+        self.images = images
+
+
+class DeviceDataStage:
+    """在线程池中按 MAC 生成专属数据，结果按 MAC 缓存，重试时不会重新分配或生成
+
+    templates 为带 address、size、name 属性和 generate(context) 方法的对象列表，
+    可以加入自定义分区的生成器。
+    """
+    def __init__(self, templates, allocator=None, workers=2, max_entries=256):
+        self.templates = list(templates)
+        self.allocator = allocator or SerialAllocator()
+        self.max_entries = max_entries
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='device-data')
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+
+    def regions(self):
+        """专属数据占用的 [(起始地址, 结束地址, 名称)]"""
+        return [(t.address, t.address + t.size, t.name) for t in self.templates]
+
+    def submit(self, mac, chip=None):
+        """开始生成（已在生成或已生成时直接返回同一个 Future）"""
+        with self._lock:
+            future = self._pending.get(mac)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self._pool.submit(self._generate, mac, chip)
+                self._pending[mac] = future
+                while len(self._pending) > self.max_entries:
+                    self._pending.popitem(last=False)
+            else:
+                self._pending.move_to_end(mac)
+            return future
+
+    def _generate(self, mac, chip):
+        serial = self.allocator.allocate(mac)
+        context = {
+            'serial': serial,
+            'mac': mac,
+            'mac_hex': mac.replace(':', ''),
+            'chip': chip or '',
+        }
+        images = []
+        for template in self.templates:
+            data = template.generate(context)
+            images.append((template.address, FirmwareImage(f"{template.name}@{serial}", data)))
+        return DeviceData(serial, images)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+def stage_from_config(config):
+    """由配置（config.json 的 device_data 项或命令行参数组成的字典）创建 DeviceDataStage"""
+    from flash_engine import parse_address
+    if not config or not config.get('nvs_template'):
+        return None
+    template = NvsTemplate(
+        config['nvs_template'],
+        parse_address(config.get('nvs_address', '0x9000')),
+        parse_address(config.get('nvs_size', '0x6000')),
+    )
+    allocator = SerialAllocator(
+        config.get('serial_file', SERIAL_FILE),
+        config.get('serial_format', '{:08d}'),
+        int(config.get('serial_start', 1)),
+    )
+    return DeviceDataStage([template], allocator)
@@ -1,12 +1,23 @@
+# 须最先导入，才能统计其余 import 的耗时
+from startup_profile import EXIT_FLAG, PROFILE
 import tkinter as tk
-from tkinter import filedialog, ttk
-import serial.tools.list_ports
-import threading
-import time
-import json
+from tkinter import filedialog, messagebox, simpledialog, ttk
 import os
-import locale
+import sys
+from baud_selector import AdaptiveBaud
+from config_store import CONFIG_FILE, ConfigStore
+from firmware_watch import FirmwareWatcher
+from hub_throttle import HubThrottle, parse_hub_limit
+from job_scheduler import FlashScheduler
+from log_pipeline import LOG_DIR, LogPump
+from metrics import MetricsRecorder, MetricsServer, default_metrics_path
+from port_monitor import HotplugMonitor
+from port_table import STATE_TEXT, PortTable
+from progress import ProgressBoard
+# esptool、烧录引擎、固件包、NVS 生成和结果数据库在首次使用时才导入，缩短启动时间
 font_size = 12
+# Hub 并发下拉框中非数字选项的文字
+HUB_LIMIT_TEXT = {'off': '不限', 'auto': '自动'}
 # 添加自定义样式和主题
 def set_modern_style(root):
     # 创建自定义样式
@@ -63,9 +74,20 @@ class LogRedirector:
         pass
 
 class LogWindow:
-    def __init__(self, port):
+    def __init__(self, port, pump):
+        # 日志通道可在任意线程创建，窗口控件交给 Tk 线程创建
+        self.port = port
+        self.pump = pump
+        self.channel = pump.open_channel(port)
+        self.window = None
+        self.closed = False
+        pump.root.after(0, self.create_window)
+
+    def create_window(self):
+        if self.closed:
+            return
         self.window = tk.Toplevel()
-        self.window.title(f"端口 {port} 烧录日志")
+        self.window.title(f"端口 {self.port} 烧录日志")
         self.window.geometry("600x450")  # 调整窗口大小
         
         # 设置窗口图标
@@ -100,26 +122,289 @@ class LogWindow:
         self.log_text.pack(fill="both", expand=True, padx=5, pady=5)
         
         scrollbar.config(command=self.log_text.yview)
+        self.pump.attach(self.channel, self.log_text)
         
     def log(self, message):
-        self.log_text.insert("end", message + "\n")
-        self.log_text.see("end")
+        """线程安全，日志由 LogPump 批量刷新到窗口"""
+        self.channel.log(message)
         
     def clear_log(self):
         self.log_text.delete(1.0, tk.END)
+        self.channel.lines.clear()
         
     def destroy(self):
-        self.window.destroy()
+        self.closed = True
+        self.pump.close_channel(self.port)
+        if self.window is not None:
+            try:
+                self.window.destroy()
+            except tk.TclError:
+                pass  # 窗口已被用户关闭
+
+class PortTableView:
+    """虚拟化的端口列表：只为可见的几行创建画布元素，滚动时复用这些元素显示其他端口"""
+    COLUMNS = (('', 30), ('端口', 150), ('USB 位置', 150), ('状态', 80), ('信息', 240))
+    STATE_COLORS = {
+        'queued': '#fff7d6',
+        'running': '#dcebff',
+        'success': '#dff5e1',
+        'failed': '#fbe0e0',
+        'cancelled': '#eeeeee',
+    }
+
+    def __init__(self, parent, table, visible_rows=8, row_height=26, on_open=None):
+        self.table = table
+        self.visible_rows = visible_rows
+        self.row_height = row_height
+        self.on_open = on_open
+        self.top = 0
+        self._version = -1
+        width = sum(w for _, w in self.COLUMNS)
+
+        self.frame = ttk.Frame(parent)
+        header = tk.Canvas(self.frame, width=width, height=row_height, highlightthickness=0, background='#eaeaea')
+        header.grid(row=0, column=0, sticky="ew")
+        x = 0
+        for title, w in self.COLUMNS:
+            header.create_text(x + 6, row_height // 2, text=title, anchor="w", font=('Microsoft YaHei UI', font_size, 'bold'))
+            x += w
+        self.canvas = tk.Canvas(
+            self.frame,
+            width=width,
+            height=row_height * visible_rows,
+            highlightthickness=0,
+            background='#ffffff'
+        )
+        self.canvas.grid(row=1, column=0, sticky="nsew")
+        self.scrollbar = ttk.Scrollbar(self.frame, orient="vertical", command=self.yview)
+        self.scrollbar.grid(row=0, column=1, rowspan=2, sticky="ns")
+        self.frame.columnconfigure(0, weight=1)
+
+        # 每个可见槽位的画布元素和当前显示内容
+        self.slots = []
+        for i in range(visible_rows):
+            y = i * row_height
+            items = {'bg': self.canvas.create_rectangle(0, y, width, y + row_height, outline='#e5e5e5', fill='#ffffff')}
+            x = 0
+            for key, (_, w) in zip(('check', 'device', 'identity', 'state', 'message'), self.COLUMNS):
+                items[key] = self.canvas.create_text(x + 6, y + row_height // 2, text='', anchor="w")
+                x += w
+            self.slots.append({'items': items, 'content': None})
+
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<Double-Button-1>", self.on_double_click)
+        self.canvas.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1))
+        self.canvas.bind("<Button-4>", lambda e: self.scroll(-1))
+        self.canvas.bind("<Button-5>", lambda e: self.scroll(1))
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def yview(self, *args):
+        """滚动条回调"""
+        count = len(self.table)
+        if args[0] == 'moveto':
+            self.set_top(int(round(float(args[1]) * count)))
+        elif args[0] == 'scroll':
+            step = int(args[1]) * (self.visible_rows if args[2] == 'pages' else 1)
+            self.set_top(self.top + step)
+
+    def scroll(self, step):
+        self.set_top(self.top + step * 3)
+
+    def set_top(self, top):
+        top = max(0, min(top, len(self.table) - self.visible_rows))
+        if top != self.top:
+            self.top = top
+            self.render(force=True)
+
+    def row_at(self, y):
+        index = self.top + int(y // self.row_height)
+        rows = self.table.slice(index, 1)
+        return rows[0] if rows else None
+
+    def on_click(self, event):
+        row = self.row_at(event.y)
+        if row is not None:
+            self.table.set_selected(row.device, not row.selected)
+
+    def on_double_click(self, event):
+        row = self.row_at(event.y)
+        if row is not None and self.on_open is not None:
+            self.on_open(row.device)
+
+    def fit(self, column, text):
+        """按列宽截断文字，画布文字不会自动裁剪"""
+        max_chars = max(4, self.COLUMNS[column][1] // (font_size - 2))
+        text = str(text or '')
+        return text if len(text) <= max_chars else text[:max_chars - 1] + '…'
+
+    def render(self, force=False):
+        """表有变化时只重绘可见行，且只修改内容变化的元素；返回是否重绘"""
+        if not force and self.table.version == self._version:
+            return False
+        self._version = self.table.version
+        count = len(self.table)
+        if self.top > max(0, count - self.visible_rows):
+            self.top = max(0, count - self.visible_rows)
+        rows = self.table.slice(self.top, self.visible_rows)
+        for i, slot in enumerate(self.slots):
+            row = rows[i] if i < len(rows) else None
+            content = row.snapshot() if row is not None else None
+            if content == slot['content']:
+                continue
+            slot['content'] = content
+            items = slot['items']
+            if row is None:
+                for key in ('check', 'device', 'identity', 'state', 'message'):
+                    self.canvas.itemconfigure(items[key], text='')
+                self.canvas.itemconfigure(items['bg'], fill='#ffffff')
+                continue
+            self.canvas.itemconfigure(items['check'], text='☑' if row.selected else '☐')
+            self.canvas.itemconfigure(items['device'], text=self.fit(1, row.device))
+            self.canvas.itemconfigure(items['identity'], text=self.fit(2, row.identity))
+            self.canvas.itemconfigure(items['state'], text=STATE_TEXT.get(row.state, row.state))
+            self.canvas.itemconfigure(items['message'], text=self.fit(4, row.message))
+            self.canvas.itemconfigure(items['bg'], fill=self.STATE_COLORS.get(row.state, '#ffffff'))
+        if count:
+            self.scrollbar.set(self.top / count, min(1.0, (self.top + self.visible_rows) / count))
+        else:
+            self.scrollbar.set(0, 1)
+        return True
+
+class ProgressDashboard:
+    """烧录进度看板：每个运行中的端口一行（阶段、进度条、速度、剩余时间），顶部为整站吞吐量
+
+    烧录线程只更新 ProgressBoard，看板按固定帧率读取快照，只修改内容变化的画布元素。
+    停滞的端口排在最前并标红，其余按进度从低到高排列。
+    """
+    PHASE_TEXT = {
+        'load': '加载',
+        'connect': '连接',
+        'stub': '启动 stub',
+        'erase': '整片擦除',
+        'diff': '差分比较',
+        'write': '写入',
+        'verify': '校验',
+        'device_data': '专属数据',
+        'encrypt': '加密',
+        'efuse': '烧写 eFuse',
+        'reset': '复位',
+        'done': '完成',
+        'failed': '失败',
+    }
+    BAR_COLORS = {'write': '#4a90d9', 'done': '#5cb85c', 'failed': '#d9534f', 'stalled': '#d9534f'}
+    WIDTH = 650
+
+    def __init__(self, parent, board, rows=8, row_height=22, fps=10, hubs=None):
+        self.board = board
+        self.hubs = hubs
+        self.row_height = row_height
+        self.interval = 1000 // fps
+        self._version = -1
+        self._content = None
+        self.frame = ttk.Frame(parent)
+        self.summary = ttk.Label(self.frame, text="")
+        self.summary.pack(fill="x")
+        self.canvas = tk.Canvas(self.frame, width=self.WIDTH, height=row_height * rows, highlightthickness=0,
+                                background='#ffffff')
+        self.canvas.pack(fill="x")
+        self.slots = []
+        for i in range(rows):
+            y = i * row_height
+            middle = y + row_height // 2
+            self.slots.append({
+                'content': None,
+                'port': self.canvas.create_text(6, middle, text='', anchor="w"),
+                'phase': self.canvas.create_text(150, middle, text='', anchor="w"),
+                'trough': self.canvas.create_rectangle(240, y + 5, 440, y + row_height - 5, outline='', fill=''),
+                'bar': self.canvas.create_rectangle(240, y + 5, 240, y + row_height - 5, outline='', fill=''),
+                'rate': self.canvas.create_text(450, middle, text='', anchor="w"),
+            })
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+        self.frame.after(self.interval, self.tick)
+
+    def tick(self):
+        try:
+            self.render()
+        finally:
+            self.frame.after(self.interval, self.tick)
+
+    def render(self):
+        """有端口在运行时每帧刷新（速度、剩余时间和停滞状态随时间变化），否则只在进度板变化时刷新"""
+        rows = self.board.snapshot()
+        if self.board.version == self._version and not rows:
+            return False
+        self._version = self.board.version
+        stats = self.board.throughput()
+        summary = (f"运行中 {stats['active']} 个端口，合计 {stats['kbps']:.0f} KB/s，"
+                   f"近 10 分钟 {stats['boards_per_hour']:.0f} 块/小时")
+        if len(rows) > len(self.slots):
+            summary += f"（另有 {len(rows) - len(self.slots)} 个端口未显示）"
+        if self.hubs is not None:
+            # 各 Hub 的运行数/上限和近 10 分钟的合计写入速度
+            for hub, item in sorted(self.hubs.stats().items()):
+                limit = item['limit'] if item['limit'] is not None else '-'
+                summary += f"\nHub {hub}: {item['running']}/{limit} 个端口，{item['kbps']:.0f} KB/s"
+        if summary != self._content:
+            self._content = summary
+            self.summary.config(text=summary)
+        for slot, row in zip(self.slots, rows + [None] * (len(self.slots) - len(rows))):
+            content = self.row_content(row)
+            if content == slot['content']:
+                continue
+            slot['content'] = content
+            self.draw(slot, content)
+        return True
+
+    def row_content(self, row):
+        """一行的显示内容元组，用于比较是否需要重绘"""
+        if row is None:
+            return None
+        event, stalled = row
+        phase = self.PHASE_TEXT.get(event.phase, event.phase)
+        if stalled:
+            phase = f"停滞 ({phase})"
+        if event.phase == 'write' and event.kbps > 0:
+            rate = f"{event.kbps:6.0f} KB/s"
+            if event.eta is not None:
+                rate += f"  剩余 {event.eta:4.0f} 秒"
+        else:
+            rate = f"{event.done // 1024} / {event.total // 1024} KB" if event.total else ''
+        color = self.BAR_COLORS['stalled'] if stalled else self.BAR_COLORS.get(event.phase, '#9bbbe0')
+        # 进度条宽度按像素取整，避免每个数据块都触发重绘
+        return (event.port, phase, int(event.fraction * 200), color, rate, stalled)
+
+    def draw(self, slot, content):
+        canvas = self.canvas
+        if content is None:
+            for key in ('port', 'phase', 'rate'):
+                canvas.itemconfigure(slot[key], text='')
+            canvas.itemconfigure(slot['trough'], fill='')
+            canvas.itemconfigure(slot['bar'], fill='')
+            return
+        port, phase, width, color, rate, stalled = content
+        x0, y0, _, y1 = canvas.coords(slot['trough'])
+        canvas.itemconfigure(slot['port'], text=port)
+        canvas.itemconfigure(slot['phase'], text=phase, fill='#d9534f' if stalled else '#333333')
+        canvas.itemconfigure(slot['trough'], fill='#eeeeee')
+        canvas.coords(slot['bar'], x0, y0, x0 + width, y1)
+        canvas.itemconfigure(slot['bar'], fill=color)
+        canvas.itemconfigure(slot['rate'], text=rate)
 
 class ESP32Flasher:
     def __init__(self, root):
         self.root = root
-        self.config_file = 'config.json'
+        self.config_file = CONFIG_FILE
         self.root.title("ESP32烧录工具")
         self.root.geometry("700x900")  # 调整主窗口大小
         
         # 检查并安装必要的依赖
-        if not self.check_dependencies():
+        with PROFILE.phase('check_dependencies'):
+            dependencies_ok = self.check_dependencies()
+        if not dependencies_ok:
             self.root.withdraw()  # 隐藏主窗口
             self.root.quit()  # 退出程序
             return
@@ -131,79 +416,146 @@ class ESP32Flasher:
             pass
         
         # 应用现代风格
-        set_modern_style(root)
+        with PROFILE.phase('set_modern_style'):
+            set_modern_style(root)
         
         # 初始化基本变量
+        self.log_pump = LogPump(root)
+        self.log_channel = self.log_pump.open_channel('main')
         self.log_windows = {}
-        self.config = {'firmware_paths': [''] * 8, 'firmware_addresses': ['0x0'] * 8, 'firmware_enables': [False] * 8}
+        # 端口 -> 最近一次在该端口开始的烧录任务的标记，延迟关闭日志时确认没有新任务接手
+        self.port_sessions = {}
+        self.bundle = None
+        self.device_data = None
+        self.encryption = None
+        # 配置修改只更新内存，由后台线程合并写盘；self.config 为全局设置与当前方案合并后的视图
+        self.config_store = ConfigStore(self.config_file, on_error=lambda e: self.log(f"保存配置失败: {str(e)}"))
+        self.config = self.config_store.settings()
+        # 配置读入并应用到界面之前，控件的变化不写回方案
+        self.applying_profile = True
+        # 已加载的固件包按路径缓存，切换方案时文件未变就不再重新校验
+        self.bundles = {}
+        
+        # 每条记录写入前重新取文件名，程序跨天运行时写到当天的文件
+        self.metrics = MetricsRecorder(lambda: default_metrics_path(LOG_DIR))
+        self.results = None
+        self.metrics_server = None
+        self.port_table = PortTable()
+        self.port_summary_version = -1
+        self.progress_board = ProgressBoard()
+        self.hotplug = HotplugMonitor(self.on_port_event)
+        self.baud_selector = AdaptiveBaud(identify=self.hotplug.port_info)
+        # 按端口所在的 USB Hub 限制并发，默认只统计不限制
+        self.hub_throttle = HubThrottle(None, identify=self.hotplug.port_info, on_change=self.on_hub_limit_change)
+        self.scheduler = FlashScheduler(self.run_flash_job, max_workers=8, on_change=self.on_job_change,
+                                        throttle=self.hub_throttle)
+        # 固件表中勾选的文件被重新编译覆盖后，写入稳定时在后台重新加载，新任务使用新固件
+        self.firmware_watch = FirmwareWatcher(
+            on_reload=self.on_firmware_reload,
+            on_error=lambda path, e: self.log(f"重新加载固件 {path} 失败: {str(e)}")
+        )
         
         # 创建UI
-        self.create_ui()
+        with PROFILE.phase('create_ui'):
+            self.create_ui()
+        self.log_pump.attach(self.log_channel, self.log_text)
+        
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         
-        # 延迟加载配置和启动监控
-        self.root.after(100, self.delayed_init)
+        # 窗口绘制完成、事件循环空闲后再加载配置、枚举串口
+        self.root.after_idle(self.delayed_init)
 
     def delayed_init(self):
         """延迟初始化，提高启动速度"""
         # 加载配置
-        self.load_config()
+        with PROFILE.phase('load_config'):
+            self.load_config()
         
-        # 初始化串口列表
-        self.refresh_ports()
+        # 启动串口热插拔监控，首次枚举在监控线程中进行，端口列表随事件刷新
+        self.hotplug.start()
+        self.firmware_watch.start()
+        if PROFILE.enabled:
+            self.root.after_idle(self.finish_profile)
         
-        # 启动串口监控
-        self.port_monitor_thread = threading.Thread(target=self.monitor_ports, daemon=True)
-        self.port_monitor_thread.start()
+        # 每个任务的结果和压缩日志写入 logs/results.db，日志窗口关闭后仍可追溯
+        with PROFILE.phase('results_store'):
+            import sqlite3
+            from results_store import ResultsStore
+            try:
+                self.results = ResultsStore(os.path.join(LOG_DIR, 'results.db'))
+            except (OSError, sqlite3.Error) as e:
+                self.log(f"打开结果数据库失败: {str(e)}")
+        
+        # 配置了 device_data 时为每块板子生成序列号和 NVS 分区
+        if self.config.get('device_data'):
+            from device_data import stage_from_config
+            try:
+                self.device_data = stage_from_config(self.config['device_data'])
+                self.log(f"已启用专属数据: {self.config['device_data']['nvs_template']}")
+            except (OSError, ValueError) as e:
+                self.log(f"加载 NVS 模板失败: {str(e)}")
+        
+        # 配置了 encryption 时在主机上预先加密固件，写入后烧写 flash 加密 eFuse
+        if self.config.get('encryption'):
+            from flash_encryption import stage_from_config as encryption_from_config
+            try:
+                self.encryption = encryption_from_config(self.config['encryption'])
+                if self.encryption is not None:
+                    self.log(f"已启用主机端预加密: {self.encryption.describe()}")
+            except (OSError, ValueError) as e:
+                self.log(f"启用 flash 加密失败: {str(e)}")
+        
+        # 配置了 metrics_port 时提供 Prometheus 抓取接口
+        if self.config.get('metrics_port'):
+            try:
+                self.metrics_server = MetricsServer(self.metrics, int(self.config['metrics_port'])).start()
+                self.log(f"指标接口: http://localhost:{self.metrics_server.port}/metrics")
+            except (OSError, ValueError) as e:
+                self.log(f"启动指标接口失败: {str(e)}")
         
         # 重定向标准输出到日志框
-        import sys
         sys.stdout = LogRedirector(self.log)
         sys.stderr = LogRedirector(self.log)
 
-    def monitor_ports(self):
-        """优化串口监控逻辑"""
-        old_ports = set()
-        while True:
-            try:
-                current_ports = set(port.device for port in serial.tools.list_ports.comports())
-                
-                if current_ports != old_ports:
-                    self.root.after(0, lambda: self.handle_port_changes(old_ports, current_ports))
-                    old_ports = current_ports
-                time.sleep(1.5)
-            except Exception:
-                time.sleep(1.5)
-                continue
+    def on_port_event(self, event):
+        """热插拔监控线程的回调：端口表直接更新，其余操作转交 Tk 线程处理"""
+        if event.action == 'add':
+            self.port_table.add(event.port)
+        else:
+            self.port_table.remove(event.device)
+            self.hub_throttle.forget(event.device)
+        self.root.after(0, lambda: self.handle_port_event(event))
 
-    def handle_port_changes(self, old_ports, current_ports):
-        """统一处理端口变化"""
-        for port in (old_ports - current_ports):
-            if port in self.log_windows:
-                self.close_log_window(port)
-        
-        new_ports = current_ports - old_ports
-        if new_ports and self.auto_flash.get():
-            self.handle_new_ports(new_ports)
-        self.refresh_ports()
+    def handle_port_event(self, event):
+        """处理单个端口的插入或移除"""
+        if event.action == 'remove':
+            if event.device in self.log_windows:
+                self.close_log_window(event.device)
+        elif self.auto_flash.get() and not event.initial:
+            # 方案中保存了自动烧录时，启动时已经接在工位上的板子不自动开始，只烧录之后插入的
+            self.handle_new_ports({event.device})
 
-    def handle_new_ports(self, new_ports):
-        """处理新增端口"""
+    def selected_firmwares(self):
+        """已勾选且文件存在的 (固件, 地址) 列表，固件为已加载的 FirmwareImage 或路径；加载了固件包时使用固件包中的固件"""
+        if self.bundle is not None:
+            return self.bundle.firmwares()
         selected_firmwares = []
-        for i in range(4):
+        for i in range(len(self.firmware_paths)):
             if self.firmware_enables[i].get():
                 firmware = self.firmware_paths[i].get()
                 address = self.firmware_addresses[i].get()
                 if firmware and os.path.exists(firmware):
                     selected_firmwares.append((firmware, address))
-        
+        # 换成监视器中已稳定的同一份快照，编译器正在写的文件不会被读到一半
+        return self.firmware_watch.resolve(selected_firmwares)
+
+    def handle_new_ports(self, new_ports):
+        """处理新增端口"""
+        selected_firmwares = self.selected_firmwares()
         if selected_firmwares:
+            options = self.get_flash_options()
             for port in new_ports:
-                thread = threading.Thread(
-                    target=self.flash_process_multi,
-                    args=(port, selected_firmwares),
-                    daemon=True
-                )
-                thread.start()
+                self.submit_flash_job(port, selected_firmwares, options)
 
     def create_ui(self):
         main_frame = ttk.Frame(self.root, padding=10)
@@ -212,43 +564,55 @@ class ESP32Flasher:
         self.port_frame = ttk.LabelFrame(main_frame, text="串口设置", padding=10)
         self.port_frame.pack(fill="x", pady=5)
         
-        port_left_frame = ttk.Frame(self.port_frame)
-        port_left_frame.pack(side="left", fill="both", expand=True)
-        port_right_frame = ttk.Frame(self.port_frame)
-        port_right_frame.pack(side="right", fill="both", expand=True)
-        
-        self.port_comboboxes = []
-        self.port_labels = []
-        for i in range(4):
-            frame = ttk.Frame(port_left_frame)
-            frame.pack(fill="x", pady=4)
-            label = ttk.Label(frame, text=f"串口{i+1}:")
-            label.pack(side="left")
-            self.port_labels.append(label)
-            combobox = ttk.Combobox(frame, width=30)
-            combobox.pack(side="left", padx=5)
-            self.port_comboboxes.append(combobox)
-        for i in range(4, 8):
-            frame = ttk.Frame(port_right_frame)
-            frame.pack(fill="x", pady=4)
-            label = ttk.Label(frame, text=f"串口{i+1}:")
-            label.pack(side="left")
-            self.port_labels.append(label)
-            combobox = ttk.Combobox(frame, width=30)
-            combobox.pack(side="left", padx=5)
-            self.port_comboboxes.append(combobox)
+        # 端口数量不限，列表只绘制可见的行；单击切换是否烧录，双击打开该端口的日志
+        self.port_view = PortTableView(self.port_frame, self.port_table, on_open=self.open_log_window)
+        self.port_view.pack(fill="x")
         
+        port_toolbar = ttk.Frame(self.port_frame)
+        port_toolbar.pack(fill="x", pady=(8, 0))
+        self.port_summary = ttk.Label(port_toolbar, text="")
+        self.port_summary.pack(side="left")
         self.refresh_button = ttk.Button(
-            self.port_frame, 
+            port_toolbar, 
             text="刷新", 
-            command=self.refresh_ports,
+            command=self.rescan_ports,
             style='Accent.TButton'
         )
-        self.refresh_button.pack(pady=8)
+        self.refresh_button.pack(side="right", padx=5)
+        ttk.Button(
+            port_toolbar, 
+            text="全不选", 
+            command=lambda: self.port_table.select_all(False)
+        ).pack(side="right", padx=5)
+        ttk.Button(
+            port_toolbar, 
+            text="全选", 
+            command=lambda: self.port_table.select_all(True)
+        ).pack(side="right", padx=5)
         
         self.firmware_frame = ttk.LabelFrame(main_frame, text="固件设置", padding=10)
         self.firmware_frame.pack(fill="x", pady=8)
         
+        # 每个产品一套方案（固件表、固件包、波特率和烧录选项），切换产品时直接选择方案
+        profile_frame = ttk.Frame(self.firmware_frame)
+        profile_frame.pack(fill="x", pady=4)
+        ttk.Label(profile_frame, text="产品方案:").pack(side="left")
+        self.profile_combobox = ttk.Combobox(profile_frame, width=30, state="readonly")
+        self.profile_combobox.pack(side="left", padx=5)
+        self.profile_combobox.bind("<<ComboboxSelected>>", lambda e: self.switch_profile(self.profile_combobox.get()))
+        ttk.Button(profile_frame, text="新建", command=self.create_profile).pack(side="left", padx=5)
+        ttk.Button(profile_frame, text="删除", command=self.delete_profile).pack(side="left", padx=5)
+        
+        # 固件包加载后替代下面的固件表，固件已在加载时校验并映射到内存
+        bundle_frame = ttk.Frame(self.firmware_frame)
+        bundle_frame.pack(fill="x", pady=4)
+        ttk.Label(bundle_frame, text="固件包:").pack(side="left")
+        self.bundle_path = tk.StringVar()
+        self.bundle_entry = ttk.Entry(bundle_frame, textvariable=self.bundle_path, width=45, state="readonly")
+        self.bundle_entry.pack(side="left", padx=5)
+        ttk.Button(bundle_frame, text="浏览", command=self.browse_bundle).pack(side="left", padx=5)
+        ttk.Button(bundle_frame, text="清除", command=lambda: self.load_bundle('')).pack(side="left", padx=5)
+        
         self.firmware_paths = []
         self.firmware_entries = []
         self.firmware_addresses = []
@@ -276,6 +640,7 @@ class ESP32Flasher:
             self.firmware_entries.append(entry)
             addr_entry = ttk.Entry(frame, width=10)
             addr_entry.insert(0, "0x0")
+            addr_entry.bind("<FocusOut>", lambda e: self.save_config())
             addr_entry.pack(side="left", padx=5)
             self.firmware_addresses.append(addr_entry)
             browse_btn = ttk.Button(
@@ -292,14 +657,56 @@ class ESP32Flasher:
         self.baud_rates = ['115200', '230400', '460800', '921600', '1152000', '1500000', '2000000']
         self.baud_combobox = ttk.Combobox(self.address_frame, width=10, values=self.baud_rates)
         self.baud_combobox.set('2000000')
+        self.baud_combobox.bind("<<ComboboxSelected>>", lambda e: self.save_config())
+        self.baud_combobox.bind("<FocusOut>", lambda e: self.save_config())
         self.baud_combobox.pack(side="left", padx=5)
         self.auto_flash = tk.BooleanVar(value=False)
         self.auto_flash_check = ttk.Checkbutton(
             self.address_frame, 
             text="自动烧录", 
-            variable=self.auto_flash
+            variable=self.auto_flash,
+            command=self.save_config
         )
         self.auto_flash_check.pack(side="left", padx=15)
+        self.diff_flash = tk.BooleanVar(value=False)
+        self.diff_flash_check = ttk.Checkbutton(
+            self.address_frame, 
+            text="差分烧录", 
+            variable=self.diff_flash,
+            command=self.save_config
+        )
+        self.diff_flash_check.pack(side="left", padx=15)
+        self.adaptive_baud = tk.BooleanVar(value=False)
+        self.adaptive_baud_check = ttk.Checkbutton(
+            self.address_frame, 
+            text="自适应波特率", 
+            variable=self.adaptive_baud,
+            command=self.save_config
+        )
+        self.adaptive_baud_check.pack(side="left", padx=15)
+        self.max_workers_label = ttk.Label(self.address_frame, text="并发数:")
+        self.max_workers_label.pack(side="left", padx=5)
+        self.max_workers_spinbox = ttk.Spinbox(
+            self.address_frame, 
+            from_=1, 
+            to=64, 
+            width=5, 
+            command=self.set_max_workers
+        )
+        self.max_workers_spinbox.set(8)
+        self.max_workers_spinbox.bind("<FocusOut>", lambda e: self.set_max_workers())
+        self.max_workers_spinbox.pack(side="left", padx=5)
+        self.hub_limit_label = ttk.Label(self.address_frame, text="每个Hub:")
+        self.hub_limit_label.pack(side="left", padx=5)
+        self.hub_limit_combobox = ttk.Combobox(
+            self.address_frame,
+            values=list(HUB_LIMIT_TEXT.values()) + [str(i) for i in range(1, 9)],
+            width=5,
+            state="readonly"
+        )
+        self.hub_limit_combobox.set(HUB_LIMIT_TEXT['off'])
+        self.hub_limit_combobox.bind("<<ComboboxSelected>>", lambda e: self.set_hub_limit())
+        self.hub_limit_combobox.pack(side="left", padx=5)
         
         self.flash_button = ttk.Button(
             main_frame, 
@@ -309,6 +716,11 @@ class ESP32Flasher:
         )
         self.flash_button.pack(pady=12)
         
+        self.progress_frame = ttk.LabelFrame(main_frame, text="烧录进度", padding=10)
+        self.progress_frame.pack(fill="x", pady=8)
+        self.progress_view = ProgressDashboard(self.progress_frame, self.progress_board, hubs=self.hub_throttle)
+        self.progress_view.pack(fill="x")
+        
         self.log_frame = ttk.LabelFrame(main_frame, text="日志", padding=10)
         self.log_frame.pack(fill="both", expand=True, pady=8)
         log_toolbar = ttk.Frame(self.log_frame)
@@ -335,64 +747,165 @@ class ESP32Flasher:
         self.log_text.pack(side="left", fill="both", expand=True)
         scrollbar.config(command=self.log_text.yview)
         
+        self.root.after(100, self.refresh_port_view)
+
+    def finish_profile(self):
+        """界面可操作后输出启动耗时；带 --profile-exit 时随即退出（供启动基准测试使用）"""
+        report = PROFILE.finish()
+        self.log(PROFILE.format(report))
+        try:
+            PROFILE.save(report, LOG_DIR)
+        except OSError as e:
+            self.log(f"保存启动耗时失败: {str(e)}")
+        if EXIT_FLAG in sys.argv:
+            self.root.after(0, self.root.destroy)
+
+    def refresh_port_view(self):
+        """定时把端口表的变化刷新到界面（只在有变化时重绘可见行）"""
+        self.port_view.render()
+        if self.port_table.version != self.port_summary_version:
+            self.port_summary_version = self.port_table.version
+            counts = self.port_table.counts()
+            busy = counts.get('queued', 0) + counts.get('running', 0)
+            self.port_summary.config(
+                text=f"共 {len(self.port_table)} 个端口，已选 {len(self.port_table.selected_devices())}，"
+                     f"进行中 {busy}，成功 {counts.get('success', 0)}，失败 {counts.get('failed', 0)}"
+            )
+        self.root.after(100, self.refresh_port_view)
+
+    def rescan_ports(self):
+        """手动刷新：在监控线程中重新枚举，结果通过端口事件返回"""
+        self.hotplug.rescan()
         self.refresh_ports()
 
     def refresh_ports(self):
-        ports = [port.device for port in serial.tools.list_ports.comports()]
-        for combobox in self.port_comboboxes:
-            combobox.set('')
-            combobox['values'] = []
-        for i, port in enumerate(ports[:8]):
-            self.port_comboboxes[i]['values'] = [port]
-            self.port_comboboxes[i].set(port)
-        if self.config.get('last_firmware'):
-            self.firmware_path.set(self.config['last_firmware'])
+        """端口表与热插拔监控的当前端口对齐"""
+        self.port_table.sync(self.hotplug.ports())
 
     def load_config(self):
+        """读入配置文件并应用当前方案，旧版配置自动迁移"""
         try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    self.config = json.load(f)
-                    if 'firmware_paths' in self.config:
-                        for i, path in enumerate(self.config['firmware_paths']):
-                            if i < len(self.firmware_paths):
-                                if os.path.exists(path):
-                                    self.firmware_paths[i].set(path)
-                                    self.root.after(100, lambda idx=i: self.firmware_entries[idx].xview_moveto(1.0))
-                                else:
-                                    self.firmware_paths[i].set('')
-                    if 'firmware_addresses' in self.config:
-                        for i, addr in enumerate(self.config['firmware_addresses']):
-                            if i < len(self.firmware_addresses):
-                                self.firmware_addresses[i].delete(0, tk.END)
-                                self.firmware_addresses[i].insert(0, addr or '0x0')
-                    if 'firmware_enables' in self.config:
-                        for i, enabled in enumerate(self.config['firmware_enables']):
-                            if i < len(self.firmware_enables):
-                                self.firmware_enables[i].set(enabled)
-            else:
-                self.config = {
-                    'firmware_paths': [''] * 8,
-                    'firmware_addresses': ['0x0'] * 8,
-                    'firmware_enables': [False] * 8
-                }
-        except Exception as e:
+            self.config_store.load()
+        except (OSError, ValueError) as e:
             self.log(f"加载配置失败: {str(e)}")
-            self.config = {
-                'firmware_paths': [''] * 8,
-                'firmware_addresses': ['0x0'] * 8,
-                'firmware_enables': [False] * 8
-            }
+        self.config = self.config_store.settings()
+        if 'max_workers' in self.config:
+            self.max_workers_spinbox.set(self.config['max_workers'])
+            self.scheduler.set_max_workers(self.config['max_workers'])
+        hub_limit = str(self.config.get('hub_limit', 'off'))
+        try:
+            self.hub_throttle.set_mode(parse_hub_limit(hub_limit))
+            self.hub_limit_combobox.set(HUB_LIMIT_TEXT.get(hub_limit, hub_limit))
+        except ValueError as e:
+            self.log(f"Hub 并发设置无效: {str(e)}")
+        self.apply_profile()
+
+    def apply_profile(self):
+        """把当前方案填入界面控件，不触发保存"""
+        self.applying_profile = True
+        try:
+            self.profile_combobox.config(values=self.config_store.profile_names())
+            self.profile_combobox.set(self.config_store.active)
+            paths = self.config.get('firmware_paths', [])
+            addresses = self.config.get('firmware_addresses', [])
+            enables = self.config.get('firmware_enables', [])
+            for i in range(len(self.firmware_paths)):
+                path = paths[i] if i < len(paths) else ''
+                self.firmware_paths[i].set(path if path and os.path.exists(path) else '')
+                self.root.after(100, lambda idx=i: self.firmware_entries[idx].xview_moveto(1.0))
+                self.firmware_addresses[i].delete(0, tk.END)
+                self.firmware_addresses[i].insert(0, (addresses[i] if i < len(addresses) else '') or '0x0')
+                self.firmware_enables[i].set(bool(enables[i]) if i < len(enables) else False)
+            self.baud_combobox.set(self.config.get('baud', '2000000'))
+            self.diff_flash.set(self.config.get('diff', False))
+            self.adaptive_baud.set(self.config.get('adaptive_baud', False))
+            self.auto_flash.set(self.config.get('auto_flash', False))
+            self.load_bundle(self.config.get('bundle_path', ''), save=False)
+        finally:
+            self.applying_profile = False
+        self.update_firmware_watch()
 
     def save_config(self):
+        """把界面上的设置写回当前方案，实际写盘由配置存储延迟合并完成"""
+        if self.applying_profile:
+            return
+        self.config_store.update_profile(
+            firmware_paths=[path.get() for path in self.firmware_paths],
+            firmware_addresses=[addr.get() for addr in self.firmware_addresses],
+            firmware_enables=[enable.get() for enable in self.firmware_enables],
+            bundle_path=self.bundle_path.get(),
+            baud=self.baud_combobox.get(),
+            diff=self.diff_flash.get(),
+            adaptive_baud=self.adaptive_baud.get(),
+            auto_flash=self.auto_flash.get()
+        )
+        self.config_store.update_global(max_workers=self.scheduler.max_workers, hub_limit=self.hub_limit_value())
+        self.config = self.config_store.settings()
+        self.update_firmware_watch()
+
+    def update_firmware_watch(self):
+        """监视固件表中勾选的文件；使用固件包时不监视"""
+        paths = []
+        if self.bundle is None:
+            paths = [self.firmware_paths[i].get() for i in range(len(self.firmware_paths))
+                     if self.firmware_enables[i].get()]
+        self.firmware_watch.watch(paths)
+
+    def on_firmware_reload(self, changes):
+        """监视线程的回调：只记录被改写的固件，首次加载不记录"""
+        for path, old, new in changes:
+            if old is not None:
+                self.log(f"固件已更新: {path} ({old.sha256[:12]} -> {new.sha256[:12]}, {new.size} 字节)，"
+                         f"之后开始的任务使用新固件")
+
+    def switch_profile(self, name):
+        """切换产品方案；已提交的任务仍使用提交时的固件和选项"""
+        if name == self.config_store.active:
+            return
+        self.save_config()
         try:
-            self.config['firmware_paths'] = [path.get() for path in self.firmware_paths]
-            self.config['firmware_addresses'] = [addr.get() for addr in self.firmware_addresses]
-            self.config['firmware_enables'] = [enable.get() for enable in self.firmware_enables]
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f)
-        except Exception as e:
-            self.log(f"保存配置失败: {str(e)}")
+            self.config = self.config_store.switch(name)
+        except KeyError as e:
+            self.log(str(e))
+            return
+        self.apply_profile()
+        self.log(f"已切换到方案: {name}")
+
+    def create_profile(self):
+        """以当前方案为模板新建方案"""
+        name = simpledialog.askstring("新建方案", "方案名称（如产品型号）:", parent=self.root)
+        if not name:
+            return
+        self.save_config()
+        try:
+            self.config = self.config_store.create(name)
+        except ValueError as e:
+            self.log(f"新建方案失败: {str(e)}")
+            return
+        self.apply_profile()
+        self.log(f"已新建方案: {name.strip()}")
+
+    def delete_profile(self):
+        name = self.config_store.active
+        if not messagebox.askyesno("删除方案", f"确定删除方案“{name}”？", parent=self.root):
+            return
+        try:
+            self.config_store.delete(name)
+        except ValueError as e:
+            self.log(f"删除方案失败: {str(e)}")
+            return
+        self.config = self.config_store.settings()
+        self.apply_profile()
+        self.log(f"已删除方案 {name}，当前方案: {self.config_store.active}")
+
+    def on_close(self):
+        """关闭窗口前写入尚未保存的配置和排队中的烧录结果"""
+        self.save_config()
+        self.config_store.flush()
+        self.firmware_watch.stop()
+        if self.results is not None:
+            self.results.close()
+        self.root.destroy()
 
     def browse_firmware(self, index):
         initial_dir = os.path.dirname(self.firmware_paths[index].get()) or os.getcwd()
@@ -405,297 +918,209 @@ class ESP32Flasher:
             self.root.after(50, lambda: self.firmware_entries[index].xview_moveto(1.0))
             self.save_config()
 
+    def browse_bundle(self):
+        from firmware_bundle import BUNDLE_EXTENSION
+        initial_dir = os.path.dirname(self.bundle_path.get()) or os.getcwd()
+        filename = filedialog.askopenfilename(
+            initialdir=initial_dir,
+            filetypes=[("固件包", "*" + BUNDLE_EXTENSION), ("所有文件", "*.*")]
+        )
+        if filename:
+            self.load_bundle(filename)
+
+    def load_bundle(self, path, save=True):
+        """加载并校验固件包；path 为空时改回使用固件表"""
+        # 正在烧录的任务仍持有旧固件包中的固件，映射随最后一个引用释放
+        self.bundle = None
+        if path:
+            from firmware_bundle import BundleError, FirmwareBundle
+            try:
+                stat = os.stat(path)
+                key = (stat.st_mtime_ns, stat.st_size)
+                cached = self.bundles.get(path)
+                if cached is not None and cached[0] == key:
+                    self.bundle = cached[1]
+                else:
+                    self.bundle = FirmwareBundle(path)
+                    self.bundles[path] = (key, self.bundle)
+                self.log(f"已加载固件包 {path}\n{self.bundle.describe()}")
+            except (OSError, BundleError) as e:
+                self.log(f"加载固件包失败: {e}")
+                path = ''
+        self.bundle_path.set(path)
+        self.root.after(10, lambda: self.bundle_entry.xview_moveto(1.0))
+        if save:
+            self.save_config()
+
     def start_flash(self):
-        selected_ports = [cb.get() for cb in self.port_comboboxes if cb.get()]
+        selected_ports = self.port_table.selected_devices()
         if not selected_ports:
             self.log("错误: 请选择至少一个串口")
             return
-        selected_firmwares = []
-        for i in range(8):
-            if self.firmware_enables[i].get():
-                firmware = self.firmware_paths[i].get()
-                address = self.firmware_addresses[i].get()
-                if firmware and os.path.exists(firmware):
-                    selected_firmwares.append((firmware, address))
+        selected_firmwares = self.selected_firmwares()
         if not selected_firmwares:
             self.log("错误: 请选择至少一个固件")
             return
+        options = self.get_flash_options()
         for port in selected_ports:
-            thread = threading.Thread(
-                target=self.flash_process_multi,
-                args=(port, selected_firmwares),
-                daemon=True
-            )
-            thread.start()
+            self.submit_flash_job(port, selected_firmwares, options)
 
-    def flash_process_multi(self, port, firmwares):
-        # 创建新的日志窗口
-        log_window = LogWindow(port)
-        self.log_windows[port] = log_window
-        
+    def submit_flash_job(self, port, firmwares, options):
+        """把烧录任务交给调度器，同一端口已有任务时不重复提交"""
+        if self.scheduler.active_job(port) is not None:
+            self.log(f"端口 {port} 已有烧录任务在排队或运行，忽略本次请求")
+            return None
+        return self.scheduler.submit(port, firmwares, options)
+
+    def run_flash_job(self, job):
+        """调度器工作线程执行的任务，结束后记录各阶段耗时"""
+        result = self.flash_process_multi(job.port, job.firmwares, job.options, job.cancel_event)
+        self.metrics.record(result, job_id=job.id, attempt=job.attempts)
+        if self.results is not None:
+            self.results.record(result, job_id=job.id, attempt=job.attempts)
+        return result
+
+    def on_job_change(self, job):
+        """任务状态变化时更新端口表并记录到主日志"""
+        result = job.result
+        if job.state == 'running':
+            message = f"第 {job.attempts} 次尝试" if job.attempts > 1 else ''
+        elif job.state == 'success' and result is not None:
+            message = f"{result.chip} {result.mac} 用时 {result.elapsed:.1f} 秒"
+            if result.serial:
+                message = f"{result.serial} " + message
+        else:
+            message = job.error or ''
+        self.port_table.update(job.port, state=job.state, message=message)
+        self.log(f"任务 {job.id} 端口 {job.port}: {STATE_TEXT.get(job.state, job.state)}")
+
+    def set_max_workers(self):
+        """并发数输入框变化时调整调度器上限"""
         try:
-            # 输出重定向类
-            class ThreadSafeOutput:
-                def __init__(self, log_window):
-                    self._log_window = log_window
-                def write(self, text):
-                    if text.strip():
-                        self._log_window.log(text.strip())
-                def flush(self):
-                    pass
-            
-            log_window.log("检测芯片类型...")
-            
-            # 使用子进程执行芯片检测
-            import subprocess
-            cmd = ["python", "-m", "esptool", "--port", port, "chip_id"]
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            startupinfo.wShowWindow = subprocess.SW_HIDE
-            process = subprocess.Popen(
-                cmd, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.STDOUT, 
-                text=True,
-                startupinfo=startupinfo
-            )
-            output = ""
-            for line in process.stdout:
-                log_window.log(line.strip())
-                output += line
-            process.wait()
-            
-            # 解析芯片型号
-            chip_type = None
-            if "Chip is ESP32-S3" in output:
-                chip_type = "ESP32-S3"
-            elif "Chip is ESP32-S2" in output:
-                chip_type = "ESP32-S2"
-            elif "Chip is ESP32-C3" in output:
-                chip_type = "ESP32-C3"
-            elif "Chip is ESP32-C6" in output:
-                chip_type = "ESP32-C6"
-            elif "Chip is ESP32-P4" in output:
-                chip_type = "ESP32-P4"
-            elif "Chip is ESP32" in output:
-                chip_type = "ESP32"
-            
-            if not chip_type:
-                log_window.log("未能识别芯片类型，当前窗口将关闭")
-                self.root.after(500, lambda: self.close_log_window(port))
-                return
-            
-            log_window.log(f"检测到芯片类型: {chip_type}")
-            
-            # 检查是否支持该芯片型号
-            chip_param = self.get_chip_param(chip_type)
-            if not chip_param:
-                log_window.log(f"不支持的芯片类型: {chip_type}，当前窗口将关闭")
-                self.root.after(500, lambda: self.close_log_window(port))
+            max_workers = int(self.max_workers_spinbox.get())
+        except ValueError:
+            return
+        self.scheduler.set_max_workers(max_workers)
+        self.save_config()
+
+    def hub_limit_value(self):
+        """Hub 并发下拉框对应的配置值：'off'、'auto' 或数字"""
+        text = self.hub_limit_combobox.get()
+        for value, label in HUB_LIMIT_TEXT.items():
+            if text == label:
+                return value
+        return text
+
+    def set_hub_limit(self):
+        """Hub 并发设置变化时调整调度器，新的上限对之后启动的任务生效"""
+        self.hub_throttle.set_mode(parse_hub_limit(self.hub_limit_value()))
+        self.scheduler.wake()
+        self.save_config()
+
+    def on_hub_limit_change(self, hub, old, new):
+        """自适应模式调整了某个 Hub 的并发上限（工作线程中调用）"""
+        stats = self.hub_throttle.stats().get(hub, {})
+        self.log(f"Hub {hub} 并发上限 {old} → {new}（合计 {stats.get('kbps', 0):.0f} KB/s，"
+                 f"{stats.get('boards_per_hour', 0):.0f} 块/小时）")
+
+    def get_flash_options(self):
+        """在 Tk 线程中读取烧录选项，供工作线程使用"""
+        from flash_engine import RESUME_RETRIES, VERIFY_SAMPLES
+        options = {
+            'baud': self.baud_combobox.get(),
+            'diff': self.diff_flash.get(),
+            'adaptive_baud': self.adaptive_baud.get(),
+            # 校验方式在 config.json 中设置："verify": "md5" 或 "sample"，"verify_samples": 4
+            'verify': self.config.get('verify', 'md5'),
+            'verify_samples': self.config.get('verify_samples', VERIFY_SAMPLES),
+            # 稀疏写入和整片擦除同样在方案中设置："sparse": true，"chip_erase": "auto"
+            'sparse': self.config.get('sparse', False),
+            'chip_erase': self.config.get('chip_erase', 'off'),
+            # 写入中链路出错后最多恢复的次数："resume_retries": 3，0 表示不恢复
+            'resume_retries': self.config.get('resume_retries', RESUME_RETRIES)
+        }
+        if self.bundle is not None:
+            options.update(self.bundle.engine_options())
+        return options
+
+    def flash_process_multi(self, port, firmwares, options=None, cancel=None):
+        # 日志写入该端口的通道，双击端口列表中的行可打开日志窗口
+        channel = self.log_pump.open_channel(port)
+        session = self.port_sessions[port] = object()
+        
+        options = dict(options or self.get_flash_options())
+        if options.get('adaptive_baud'):
+            # 按 USB 序列号或 Hub 位置记住每个端口的稳定速率
+            options['baud_selector'] = self.baud_selector
+        # 识别缓存按热插拔监控记录的 USB 身份查找，不必每次重新枚举串口
+        options['port_lookup'] = self.hotplug.port_info
+        options['device_data'] = self.device_data
+        options['encryption'] = self.encryption
+        if self.encryption is not None and options.get('verify') == 'off':
+            # 烧写 flash 加密 eFuse 前必须校验密文，方案中关闭了校验时仍用 MD5 校验
+            options['verify'] = 'md5'
+        from flash_engine import FlashEngine
+        engine = FlashEngine(**options)
+        result = engine.flash(port, firmwares, log=channel.log, cancel=cancel, progress=self.progress_board.update)
+        if result.success:
+            channel.log("烧录完成、复位后，窗口即将关闭...")
+            message = f"端口 {port} 烧录完成，用时 {result.elapsed:.1f} 秒，波特率 {result.baud}"
+            if result.recoveries:
+                message += f"，链路中断后恢复 {len(result.recoveries)} 次"
+            if result.encryption:
+                message += f"，flash 加密密钥 {result.encryption['key_id']}"
+            self.log(message)
+            self.port_table.update(port, chip=result.chip, mac=result.mac)
+            self.root.after(500, lambda: self.close_finished_log(port, session))
+        else:
+            self.log(f"错误: 端口 {port} {result.error}")
+            # 失败时自动打开日志窗口，方便查看原因
+            self.root.after(0, lambda: self.open_log_window(port))
+        return result
+
+    def open_log_window(self, port):
+        """打开（或切换到）端口的日志窗口，已有的日志会补显示"""
+        log_window = self.log_windows.get(port)
+        if log_window is not None and log_window.window is not None:
+            try:
+                log_window.window.deiconify()
+                log_window.window.lift()
                 return
+            except tk.TclError:
+                pass
+        self.log_windows[port] = LogWindow(port, self.log_pump)
 
-            flash_params = {
-                'esp32': {
-                    'flash_mode': 'dio',
-                    'flash_freq': '40m',
-                    'flash_size': 'detect'
-                },
-                'esp32s3': {
-                    'flash_mode': 'dio',
-                    'flash_freq': '80m',
-                    'flash_size': '16MB'
-                },
-                'esp32s2': {
-                    'flash_mode': 'dio',
-                    'flash_freq': '80m',
-                    'flash_size': '4MB'
-                },
-                'esp32c3': {
-                    'flash_mode': 'dio',
-                    'flash_freq': '80m',
-                    'flash_size': '4MB'
-                },
-                'esp32c6': {
-                    'flash_mode': 'dio',
-                    'flash_freq': '80m',
-                    'flash_size': '4MB'
-                }
-            }
-            params = flash_params.get(chip_param, flash_params['esp32'])
-            
-            # 对每个固件进行烧录
-            for firmware, address in firmwares:
-                flash_cmd = [
-                    "python", "-m", "esptool",
-                    "--port", port,
-                    "--baud", self.baud_combobox.get(),
-                    "--before", "default_reset",
-                    "--after", "hard_reset",
-                    "write_flash",
-                    address, firmware
-                ]
-                log_window.log(f"执行命令: {' '.join(flash_cmd)}")
-                
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                system_encoding = locale.getpreferredencoding()
-                log_window.log(f"系统编码: {system_encoding}")
-                cmd_str = " ".join(flash_cmd)
-                process = subprocess.Popen(
-                    cmd_str, 
-                    stdout=subprocess.PIPE, 
-                    stderr=subprocess.STDOUT, 
-                    text=True,
-                    startupinfo=startupinfo,
-                    shell=True
-                )
-                for line in process.stdout:
-                    log_window.log(line.strip())
-                process.wait()
-                
-                if process.returncode != 0:
-                    log_window.log(f"烧录失败，返回码: {process.returncode}")
-                    raise Exception(f"烧录失败，返回码: {process.returncode}")
-                
-                log_window.log(f"端口 {port} 固件 {firmware} 烧录完成!")
-
-            log_window.log(f"端口 {port} 所有固件烧录完成!")
-            
-            # 发送复位信号后关闭当前窗口
-            self.send_reset_signal(port)
-            log_window.log("烧录完成、复位后，窗口即将关闭...")
-            self.root.after(500, lambda: self.close_log_window(port))
-                
-        except Exception as e:
-            log_window.log(f"端口 {port} 烧录错误: {str(e)}")
-            self.log(f"错误: {str(e)}")
-
-    def send_reset_signal(self, port):
-        """发送复位信号给ESP32"""
-        try:
-            import serial
-            reset_baud = 115200
-            ser = serial.Serial(port, reset_baud, timeout=1)
-            ser.setDTR(False)
-            time.sleep(0.1)
-            ser.setDTR(True)
-            time.sleep(0.1)
-            ser.close()
-            self.log(f"端口 {port} 复位信号已发送!")
-        except Exception as e:
-            self.log(f"发送复位信号失败: {str(e)}")
-
-    def monitor_ports(self):
-        old_ports = set()
-        while True:
-            current_ports = set(port.device for port in serial.tools.list_ports.comports())
-            removed_ports = old_ports - current_ports
-            for port in removed_ports:
-                if port in self.log_windows:
-                    self.root.after(0, lambda p=port: self.close_log_window(p))
-            new_ports = current_ports - old_ports
-            if new_ports and self.auto_flash.get():
-                selected_firmwares = []
-                for i in range(4):
-                    if self.firmware_enables[i].get():
-                        firmware = self.firmware_paths[i].get()
-                        address = self.firmware_addresses[i].get()
-                        if firmware and os.path.exists(firmware):
-                            selected_firmwares.append((firmware, address))
-                if selected_firmwares:
-                    for port in new_ports:
-                        thread = threading.Thread(
-                            target=self.flash_process_multi,
-                            args=(port, selected_firmwares),
-                            daemon=True
-                        )
-                        thread.start()
-            if current_ports != old_ports:
-                self.root.after(0, self.refresh_ports)
-                old_ports = current_ports
-            time.sleep(1)
+    def close_finished_log(self, port, session):
+        """烧录成功后延迟关闭日志；期间该端口已开始下一块板子（自动烧录或重试）时保留其日志"""
+        if self.port_sessions.get(port) is not session:
+            return
+        del self.port_sessions[port]
+        self.close_log_window(port)
 
     def close_log_window(self, port):
-        """安全地关闭日志窗口"""
+        """安全地关闭日志窗口，并把剩余日志写入磁盘"""
         if port in self.log_windows:
             self.log_windows[port].destroy()
             del self.log_windows[port]
+        else:
+            self.log_pump.close_channel(port)
 
     def log(self, message):
         """线程安全的日志记录方法"""
-        def _log():
-            self.log_text.insert("end", message + "\n")
-            self.log_text.see("end")
-        self.root.after(0, _log)
+        self.log_channel.log(message)
 
     def clear_log(self):
         self.log_text.delete(1.0, tk.END)
-
-    def detect_chip(self, port):
-        try:
-            cmd = ["--port", port, "chip_id"]
-            log_window = self.log_windows.get(port)
-            if not log_window:
-                return None
-            from io import StringIO
-            output_buffer = StringIO()
-            import sys
-            old_stdout = sys.stdout
-            class TeeOutput:
-                def __init__(self, original, buffer):
-                    self.original = original
-                    self.buffer = buffer
-                def write(self, text):
-                    self.original.write(text)
-                    self.buffer.write(text)
-                def flush(self):
-                    self.original.flush()
-            sys.stdout = TeeOutput(old_stdout, output_buffer)
-            try:
-                esptool.main(cmd)
-                output = output_buffer.getvalue()
-            finally:
-                sys.stdout = old_stdout
-            if "Chip is ESP32-S3" in output:
-                return "ESP32-S3"
-            elif "Chip is ESP32-S2" in output:
-                return "ESP32-S2"
-            elif "Chip is ESP32-C3" in output:
-                return "ESP32-C3"
-            elif "Chip is ESP32-C6" in output:
-                return "ESP32-C6"
-            elif "Chip is ESP32-P4" in output:
-                return "ESP32-P4"
-            elif "Chip is ESP32" in output:
-                return "ESP32"
-            else:
-                log_window.log("未能识别芯片类型")
-                return None
-        except Exception as e:
-            if log_window:
-                log_window.log(f"芯片检测失败: {str(e)}")
-            return None
-
-    def get_chip_param(self, chip_type):
-        """将检测到的芯片类型转换为对应的参数"""
-        chip_map = {
-            'ESP32': 'esp32',
-            'ESP32-S3': 'esp32s3',
-            'ESP32-S2': 'esp32s2',
-            'ESP32-C3': 'esp32c3',
-            'ESP32-C6': 'esp32c6',
-            'ESP32-P4': 'esp32p4'
-        }
-        return chip_map.get(chip_type)
+        self.log_channel.lines.clear()
 
     def check_dependencies(self):
-        try:
-            import esptool
+        """只检查 esptool 是否可用，不在启动时导入"""
+        import importlib.util
+        if importlib.util.find_spec('esptool') is not None:
             return True
-        except ImportError:
+        else:
             import tkinter.messagebox as messagebox
             import subprocess
-            import sys
             result = messagebox.askyesno(
                 "依赖检查",
                 "未安装必要的依赖 esptool，是否立即安装？"
@@ -723,6 +1148,11 @@ class ESP32Flasher:
                 return False
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = ESP32Flasher(root)
+    # 预加密的进程池在 pyinstaller 打包后的程序中也能启动
+    import multiprocessing
+    multiprocessing.freeze_support()
+    with PROFILE.phase('tk_root'):
+        root = tk.Tk()
+    with PROFILE.phase('ESP32Flasher'):
+        app = ESP32Flasher(root)
     root.mainloop()
@@ -0,0 +1,312 @@
+"""固件包
+
+把一组固件、烧录地址、flash 参数、目标芯片和 SHA-256 打包成一个文件，
+加载时一次性校验（地址对齐、区间重叠、容量、芯片与 FLASH_PARAMS 是否匹配、
+引导程序头与 flash 参数是否一致、摘要），之后烧录不再逐次检查文件。
+
+文件格式为不压缩（ZIP_STORED）的 zip，可用任何解压工具查看：
+    manifest.json       芯片、flash 参数和固件列表
+    images/<序号>_<名称>  按 4 字节填充后的固件数据
+加载时整个文件只读映射到内存，各固件直接引用映射中的区域，所有端口共用同一份数据。
+
+命令行:
+    python firmware_bundle.py build app.espbundle --chip esp32s3 0x0 bootloader.bin 0x8000 partitions.bin 0x10000 app.bin
+    python firmware_bundle.py info app.espbundle
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import zipfile
+
+from firmware_cache import FirmwareImage, pad_image
+from flash_engine import FLASH_PARAMS, FLASH_SECTOR_SIZE, parse_address
+
+BUNDLE_FORMAT = 1
+BUNDLE_EXTENSION = '.espbundle'
+MANIFEST_NAME = 'manifest.json'
+
+FLASH_MODES = {'qio': 0, 'qout': 1, 'dio': 2, 'dout': 3}
+FLASH_FREQS = ('80m', '60m', '48m', '40m', '30m', '26m', '24m', '20m', '16m', '15m', '12m')
+# flash 容量及其在镜像头中的编码（高 4 位）
+FLASH_SIZES = {
+    '1MB': 0x00,
+    '2MB': 0x10,
+    '4MB': 0x20,
+    '8MB': 0x30,
+    '16MB': 0x40,
+    '32MB': 0x50,
+    '64MB': 0x60,
+    '128MB': 0x70,
+}
+# 引导程序在 flash 中的地址
+BOOTLOADER_OFFSETS = {
+    'esp32': 0x1000,
+    'esp32s2': 0x1000,
+    'esp32s3': 0x0,
+    'esp32c3': 0x0,
+    'esp32c6': 0x0,
+}
+ESP_IMAGE_MAGIC = 0xE9
+
+
+class BundleError(ValueError):
+    """固件包格式错误或校验失败"""
+
+
+def flash_size_bytes(size):
+    return int(size[:-2]) * 1024 * 1024
+
+
+# 每个固件条目的必填字段及其类型
+IMAGE_FIELDS = (
+    ('name', str),
+    ('member', str),
+    ('address', (str, int)),
+    ('size', int),
+    ('sha256', str),
+)
+
+
+def _check_entry(entry, index):
+    """固件条目须为对象，必填字段齐全且类型正确"""
+    if not isinstance(entry, dict):
+        raise BundleError(f"第 {index + 1} 个固件条目不是对象")
+    for key, types in IMAGE_FIELDS:
+        value = entry.get(key)
+        # bool 是 int 的子类，不能当作地址或大小
+        if not isinstance(value, types) or isinstance(value, bool):
+            raise BundleError(f"第 {index + 1} 个固件条目的 {key} 缺失或类型错误: {value!r}")
+    if entry['size'] < 0:
+        raise BundleError(f"固件 {entry['name']} 的大小无效: {entry['size']}")
+
+
+def validate_manifest(manifest):
+    """校验 manifest 中的芯片、flash 参数和固件地址，返回补全默认值后的 manifest"""
+    if not isinstance(manifest, dict):
+        raise BundleError("manifest 不是对象")
+    if manifest.get('format') != BUNDLE_FORMAT:
+        raise BundleError(f"不支持的固件包版本: {manifest.get('format')}")
+    chip = manifest.get('chip')
+    if not isinstance(chip, str) or chip not in FLASH_PARAMS:
+        raise BundleError(f"不支持的目标芯片: {chip}，可选: {', '.join(FLASH_PARAMS)}")
+    defaults = FLASH_PARAMS[chip]
+    manifest = dict(manifest)
+    for key in ('flash_mode', 'flash_freq', 'flash_size'):
+        manifest[key] = manifest.get(key) or defaults[key]
+        if not isinstance(manifest[key], str):
+            raise BundleError(f"{key} 类型错误: {manifest[key]!r}")
+    if manifest['flash_mode'] not in FLASH_MODES:
+        raise BundleError(f"无效的 flash 模式: {manifest['flash_mode']}")
+    if manifest['flash_freq'] not in FLASH_FREQS:
+        raise BundleError(f"无效的 flash 频率: {manifest['flash_freq']}")
+    if manifest['flash_size'] != 'detect' and manifest['flash_size'] not in FLASH_SIZES:
+        raise BundleError(f"无效的 flash 容量: {manifest['flash_size']}")
+
+    images = manifest.get('images') or []
+    if not isinstance(images, list):
+        raise BundleError("manifest 中的 images 不是列表")
+    if not images:
+        raise BundleError("固件包中没有固件")
+    extents = []
+    for index, entry in enumerate(images):
+        _check_entry(entry, index)
+        try:
+            address = parse_address(entry['address'])
+        except (KeyError, ValueError):
+            raise BundleError(f"固件 {entry.get('name')} 的烧录地址无效: {entry.get('address')}")
+        if address % FLASH_SECTOR_SIZE:
+            raise BundleError(f"固件 {entry['name']} 的地址 0x{address:x} 未按 4KB 扇区对齐")
+        extents.append((address, address + entry['size'], entry['name']))
+    extents.sort()
+    for (start, end, name), (next_start, _, next_name) in zip(extents, extents[1:]):
+        if end > next_start:
+            raise BundleError(f"固件 {name} (0x{start:x}-0x{end:x}) 与 {next_name} (0x{next_start:x}) 重叠")
+    if manifest['flash_size'] != 'detect':
+        limit = flash_size_bytes(manifest['flash_size'])
+        start, end, name = extents[-1]
+        if end > limit:
+            raise BundleError(f"固件 {name} 结束于 0x{end:x}，超出 flash 容量 {manifest['flash_size']}")
+    return manifest
+
+
+def check_bootloader_header(manifest, address, data):
+    """引导程序镜像头中的 flash 模式、频率和容量须与 manifest 一致"""
+    if BOOTLOADER_OFFSETS.get(manifest['chip']) != address or len(data) < 4 or data[0] != ESP_IMAGE_MAGIC:
+        return
+    mode = FLASH_MODES[manifest['flash_mode']]
+    if data[2] != mode:
+        names = {v: k for k, v in FLASH_MODES.items()}
+        raise BundleError(
+            f"引导程序的 flash 模式为 {names.get(data[2], data[2])}，与固件包设置的 {manifest['flash_mode']} 不一致"
+        )
+    if manifest['flash_size'] != 'detect' and data[3] & 0xF0 != FLASH_SIZES[manifest['flash_size']]:
+        raise BundleError(f"引导程序头中的 flash 容量与固件包设置的 {manifest['flash_size']} 不一致")
+    # 频率编码（低 4 位）因芯片而异，使用 esptool 的对照表
+    from esptool.targets import CHIP_DEFS
+    freqs = CHIP_DEFS[manifest['chip']].FLASH_FREQUENCY
+    if manifest['flash_freq'] not in freqs:
+        raise BundleError(f"{manifest['chip']} 不支持 flash 频率 {manifest['flash_freq']}，可选: {', '.join(freqs)}")
+    if data[3] & 0x0F != freqs[manifest['flash_freq']]:
+        names = {v: k for k, v in freqs.items()}
+        raise BundleError(
+            f"引导程序的 flash 频率为 {names.get(data[3] & 0x0F, data[3] & 0x0F)}，"
+            f"与固件包设置的 {manifest['flash_freq']} 不一致"
+        )
+
+
+class FirmwareBundle:
+    """已加载并校验的固件包，images 直接引用只读内存映射"""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._load()
+        except Exception:
+            self.close()
+            raise
+
+    def _load(self):
+        try:
+            archive = zipfile.ZipFile(self._file)
+        except zipfile.BadZipFile as e:
+            raise BundleError(f"不是有效的固件包: {e}")
+        with archive:
+            try:
+                manifest = json.loads(archive.read(MANIFEST_NAME).decode('utf-8'))
+            except (KeyError, ValueError) as e:
+                raise BundleError(f"读取 {MANIFEST_NAME} 失败: {e}")
+            self.manifest = validate_manifest(manifest)
+            self.images = []
+            view = memoryview(self._map)
+            for entry in self.manifest['images']:
+                try:
+                    info = archive.getinfo(entry['member'])
+                except KeyError:
+                    raise BundleError(f"固件包中缺少 {entry.get('member')}")
+                if info.compress_type != zipfile.ZIP_STORED:
+                    raise BundleError(f"{entry['member']} 经过压缩，无法直接映射")
+                data = view[self._data_offset(info):self._data_offset(info) + info.file_size]
+                if len(data) != entry['size'] or len(data) % 4:
+                    raise BundleError(f"{entry['member']} 的大小与 manifest 不符")
+                if hashlib.sha256(data).hexdigest() != entry['sha256']:
+                    raise BundleError(f"{entry['member']} 的 SHA-256 校验失败")
+                address = parse_address(entry['address'])
+                check_bootloader_header(self.manifest, address, data)
+                image = FirmwareImage(f"{self.path}:{entry['name']}", data)
+                self.images.append((image, address))
+
+    def _data_offset(self, info):
+        """由本地文件头计算成员数据在文件中的偏移"""
+        header = self._map[info.header_offset:info.header_offset + 30]
+        if header[:4] != b'PK\x03\x04':
+            raise BundleError(f"{info.filename} 的文件头损坏")
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        return info.header_offset + 30 + name_len + extra_len
+
+    @property
+    def chip(self):
+        return self.manifest['chip']
+
+    @property
+    def flash_size(self):
+        return self.manifest['flash_size']
+
+    def firmwares(self):
+        """供 FlashEngine.flash 使用的 [(FirmwareImage, 地址)] 列表"""
+        return list(self.images)
+
+    def engine_options(self):
+        """烧录时需附加的引擎参数：限定目标芯片和 flash 容量"""
+        return {'target_chip': self.chip, 'flash_size': self.flash_size}
+
+    def describe(self):
+        lines = [f"芯片 {self.chip}, flash {self.manifest['flash_mode']} "
+                 f"{self.manifest['flash_freq']} {self.flash_size}"]
+        for image, address in self.images:
+            lines.append(f"  0x{address:08x}  {image.size:>9} 字节  {image.sha256[:16]}  {image.path}")
+        return '\n'.join(lines)
+
+    def close(self):
+        """释放内存映射；仍在使用的固件会阻止释放"""
+        self.images = []
+        try:
+            if getattr(self, '_map', None) is not None:
+                self._map.close()
+        except BufferError:
+            pass
+        self._file.close()
+
+
+def build_bundle(path, chip, firmwares, flash_mode=None, flash_freq=None, flash_size=None):
+    """由 [(地址, 文件路径)] 生成固件包，生成前按加载时的规则校验"""
+    entries = []
+    members = []
+    for index, (address, source) in enumerate(firmwares):
+        with open(source, 'rb') as f:
+            data = pad_image(f.read())
+        name = os.path.basename(source)
+        member = f"images/{index}_{name}"
+        entries.append({
+            'name': name,
+            'member': member,
+            'address': '0x%x' % parse_address(address),
+            'size': len(data),
+            'sha256': hashlib.sha256(data).hexdigest(),
+        })
+        members.append((member, data))
+    manifest = validate_manifest({
+        'format': BUNDLE_FORMAT,
+        'chip': chip,
+        'flash_mode': flash_mode,
+        'flash_freq': flash_freq,
+        'flash_size': flash_size,
+        'images': entries,
+    })
+    for entry, (_, data) in zip(entries, members):
+        check_bootloader_header(manifest, parse_address(entry['address']), data)
+    tmp = path + '.tmp'
+    with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2, ensure_ascii=False))
+        for member, data in members:
+            archive.writestr(member, data)
+    os.replace(tmp, path)
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ESP32 固件包工具")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="生成固件包")
+    build.add_argument('output', help="输出文件（建议扩展名 .espbundle）")
+    build.add_argument('--chip', required=True, choices=sorted(FLASH_PARAMS), help="目标芯片")
+    build.add_argument('--flash-mode', default=None, choices=sorted(FLASH_MODES))
+    build.add_argument('--flash-freq', default=None, choices=FLASH_FREQS)
+    build.add_argument('--flash-size', default=None, choices=list(FLASH_SIZES) + ['detect'])
+    build.add_argument('images', nargs='+', metavar='ADDRESS FILE', help="依次给出地址和文件")
+    info = commands.add_parser('info', help="校验并显示固件包内容")
+    info.add_argument('bundle')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'build':
+            if len(args.images) % 2:
+                parser.error("地址和文件须成对给出")
+            pairs = list(zip(args.images[::2], args.images[1::2]))
+            build_bundle(args.output, args.chip, pairs, args.flash_mode, args.flash_freq, args.flash_size)
+            args.bundle = args.output
+        bundle = FirmwareBundle(args.bundle)
+        print(bundle.describe())
+        bundle.close()
+    except (OSError, BundleError) as e:
+        sys.stderr.write(f"错误: {e}\n")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
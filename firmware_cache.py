@@ -0,0 +1,195 @@
+"""固件缓存
+
+同一个固件在所有端口、所有任务之间只读取、压缩、计算摘要一次。
+缓存以内容 SHA-256 为键，按路径的 (大小, 修改时间) 判断文件是否变化，
+总内存超过上限时按最近最少使用的顺序淘汰。
+"""
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+
+def pad_image(data):
+    """按 4 字节对齐，用 0xFF 填充（与 esptool 一致）"""
+    if len(data) % 4:
+        data += b'\xff' * (4 - len(data) % 4)
+    return data
+
+
+class FirmwareImage:
+    """一个已加载的固件：填充后的数据、压缩数据和摘要，创建后只读"""
+    def __init__(self, path, data, compress_level=9):
+        data = pad_image(data)
+        self.path = path
+        self.data = data
+        self.size = len(data)
+        self.md5 = hashlib.md5(data).hexdigest()
+        self.sha256 = hashlib.sha256(data).hexdigest()
+        self.compressed = zlib.compress(data, compress_level)
+        self.compress_level = compress_level
+        self._blocks = {}
+        self._region_md5s = {}
+        self._sector_maps = {}
+        self._ranges = OrderedDict()
+
+    @property
+    def memory_size(self):
+        return len(self.data) + len(self.compressed)
+
+    def blocks(self, block_size):
+        """按加载器的块大小切分压缩数据，返回 [(压缩块, 解压后长度)]，结果按块大小缓存
+
+        解压后长度用于估算每块的写入超时，预先算好后各端口不必再逐块解压。
+        """
+        blocks = self._blocks.get(block_size)
+        if blocks is None:
+            view = memoryview(self.compressed)
+            decompress = zlib.decompressobj()
+            blocks = []
+            for i in range(0, len(view), block_size):
+                block = view[i:i + block_size]
+                blocks.append((block, len(decompress.decompress(block))))
+            self._blocks[block_size] = blocks
+        return blocks
+
+    def region_md5s(self, region_size):
+        """按 region_size 分区计算的 MD5 列表，最后一个分区可能不足整区"""
+        md5s = self._region_md5s.get(region_size)
+        if md5s is None:
+            view = memoryview(self.data)
+            md5s = [hashlib.md5(view[i:i + region_size]).hexdigest()
+                    for i in range(0, self.size, region_size)]
+            self._region_md5s[region_size] = md5s
+        return md5s
+
+    def populated_extents(self, sector_size):
+        """含非 0xFF 数据的扇区区间 [(起始, 结束)]（相邻扇区合并，最后一段可能不足整扇区），结果按扇区大小缓存"""
+        extents = self._sector_maps.get(sector_size)
+        if extents is None:
+            view = memoryview(self.data)
+            blank = b'\xff' * sector_size
+            extents = []
+            for start in range(0, self.size, sector_size):
+                end = min(start + sector_size, self.size)
+                if view[start:end] == blank[:end - start]:
+                    continue
+                if extents and extents[-1][1] == start:
+                    extents[-1] = (extents[-1][0], end)
+                else:
+                    extents.append((start, end))
+            self._sector_maps[sector_size] = extents
+        return extents
+
+    def compressed_range(self, start, end, max_entries=256):
+        """压缩 data[start:end]，结果缓存以便多个端口写入相同的差异区间"""
+        key = (start, end)
+        compressed = self._ranges.get(key)
+        if compressed is None:
+            compressed = zlib.compress(memoryview(self.data)[start:end], self.compress_level)
+            self._ranges[key] = compressed
+            if len(self._ranges) > max_entries:
+                self._ranges.popitem(last=False)
+        return compressed
+
+
+class FirmwareCache:
+    """线程安全的固件缓存，可被所有并发烧录任务共享"""
+    def __init__(self, max_bytes=512 * 1024 * 1024, compress_level=9):
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+        self._lock = threading.Lock()
+        self._images = OrderedDict()    # sha256 -> FirmwareImage
+        self._paths = {}                # 路径 -> ((大小, 修改时间), sha256)
+        self._building = {}             # 路径 -> 正在加载时使用的锁
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """返回 path 对应的 FirmwareImage，文件未变化时直接使用缓存"""
+        signature = self._signature(path)
+        image = self._lookup(path, signature)
+        if image is not None:
+            return image
+        with self._lock:
+            build_lock = self._building.setdefault(path, threading.Lock())
+        # 同一文件只允许一个线程加载，其余线程等待后直接命中缓存
+        with build_lock:
+            image = self._lookup(path, signature)
+            if image is not None:
+                return image
+            with open(path, 'rb') as f:
+                data = pad_image(f.read())
+            sha256 = hashlib.sha256(data).hexdigest()
+            with self._lock:
+                image = self._images.get(sha256)
+            if image is None:
+                image = FirmwareImage(path, data, self.compress_level)
+            with self._lock:
+                self.misses += 1
+                self._store(path, signature, image)
+            return image
+
+    def invalidate(self, path=None):
+        """丢弃某个路径（或全部）的缓存"""
+        with self._lock:
+            if path is None:
+                self._paths.clear()
+                self._images.clear()
+                self._bytes = 0
+                return
+            entry = self._paths.pop(path, None)
+            if entry and not any(sha == entry[1] for _, sha in self._paths.values()):
+                image = self._images.pop(entry[1], None)
+                if image is not None:
+                    self._bytes -= image.memory_size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'images': len(self._images),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _signature(self, path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns)
+
+    def _lookup(self, path, signature):
+        with self._lock:
+            entry = self._paths.get(path)
+            if entry is None or entry[0] != signature:
+                return None
+            image = self._images.get(entry[1])
+            if image is None:
+                return None
+            self._images.move_to_end(entry[1])
+            self.hits += 1
+            return image
+
+    def _store(self, path, signature, image):
+        """登记缓存并按内存上限淘汰（调用方持有锁）"""
+        old = self._paths.get(path)
+        self._paths[path] = (signature, image.sha256)
+        if image.sha256 not in self._images:
+            self._images[image.sha256] = image
+            self._bytes += image.memory_size
+        self._images.move_to_end(image.sha256)
+        if old and old[1] != image.sha256 and not any(sha == old[1] for _, sha in self._paths.values()):
+            stale = self._images.pop(old[1], None)
+            if stale is not None:
+                self._bytes -= stale.memory_size
+        # 至少保留刚加载的固件，即使它本身超过上限
+        while self._bytes > self.max_bytes and len(self._images) > 1:
+            sha256, evicted = self._images.popitem(last=False)
+            self._bytes -= evicted.memory_size
+            for key in [p for p, (_, sha) in self._paths.items() if sha == sha256]:
+                del self._paths[key]
+
+
+# 所有烧录任务共享的默认缓存
+shared_cache = FirmwareCache()
@@ -0,0 +1,345 @@
+"""固件文件监视与热更新
+
+产线上开着烧录工具的同时，固件经常被重新编译覆盖。以前任务在开始时按路径读文件，
+可能读到编译器写了一半的文件，也可能同一批板子里前后混着新旧两版。
+这里在后台线程监视正在使用的固件文件（Linux 上用 inotify 监视所在目录，其他系统或 inotify 不可用时定时比较大小和修改时间）：
+
+    - 文件变化后等待写入稳定（settle 秒内大小、修改时间不再变化）才重新加载
+    - 只重新计算变化的那个固件的哈希、压缩数据和空白扇区表，其余固件仍用缓存
+    - 同一轮变化的所有文件都加载完成后一次性切换为新的快照；多个文件先后写完时不会出现新旧混用
+
+新任务提交时用 resolve() 把路径换成当前快照中的 FirmwareImage，已在运行的任务继续使用提交时的旧快照。
+"""
+import ctypes
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from firmware_cache import shared_cache
+
+# 加载后预先计算的空白扇区表和分块（与 flash_engine.FLASH_SECTOR_SIZE、stub 的 FLASH_WRITE_SIZE 一致）
+SECTOR_SIZE = 0x1000
+BLOCK_SIZE = 0x4000
+# 文件消失超过 settle 的这么多倍后不再等待它，保留旧快照，同一轮的其他文件照常切换
+MISSING_GRACE = 5
+
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def file_signature(path):
+    """(大小, 修改时间)，文件不存在时返回 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+class PollingWatchSource:
+    """定时比较文件的大小和修改时间，适用于所有平台"""
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._signatures = {}
+
+    def set_paths(self, paths):
+        self._signatures = {path: self._signatures.get(path, file_signature(path)) for path in paths}
+
+    def wait(self, timeout):
+        """等待最多 timeout 秒，返回期间发生变化的路径集合"""
+        time.sleep(min(timeout, self.interval))
+        changed = set()
+        for path, old in list(self._signatures.items()):
+            signature = file_signature(path)
+            if signature != old:
+                self._signatures[path] = signature
+                changed.add(path)
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatchSource:
+    """Linux inotify：监视固件所在的目录，编译器原地改写、先删后建或写临时文件再改名都能收到事件
+
+    目录不存在或被删除、移走（构建系统清理输出目录）时，其中的文件改为按 poll_interval 轮询大小和修改时间，
+    每次轮询同时尝试重新添加监视，目录重新出现后恢复用事件通知。
+    """
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVE_SELF
+
+    def __init__(self, poll_interval=0.5):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self.poll_interval = poll_interval
+        self._wds = {}          # 监视描述符 -> 目录
+        self._paths = set()
+        self._signatures = {}   # 所在目录没有监视的文件 -> 最近一次看到的签名
+
+    def set_paths(self, paths):
+        self._paths = set(paths)
+        directories = {os.path.dirname(path) for path in self._paths}
+        for wd, directory in list(self._wds.items()):
+            if directory not in directories:
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self._wds[wd]
+        for path in list(self._signatures):
+            if path not in self._paths:
+                del self._signatures[path]
+        self._add_watches()
+
+    def _add_watches(self):
+        """为还没有监视的目录添加监视，添加失败的目录中的文件记下签名改为轮询"""
+        watched = set(self._wds.values())
+        for directory in {os.path.dirname(path) for path in self._paths} - watched:
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd >= 0:
+                self._wds[wd] = directory
+                watched.add(directory)
+        for path in self._paths:
+            if os.path.dirname(path) not in watched:
+                self._signatures.setdefault(path, file_signature(path))
+
+    def _poll(self):
+        """重新尝试添加监视，返回轮询的文件中签名变化的路径；目录恢复监视后不再轮询其中的文件"""
+        self._add_watches()
+        watched = set(self._wds.values())
+        changed = set()
+        for path, old in list(self._signatures.items()):
+            signature = file_signature(path)
+            if signature != old:
+                changed.add(path)
+            if os.path.dirname(path) in watched:
+                del self._signatures[path]
+            else:
+                self._signatures[path] = signature
+        return changed
+
+    def _unwatch(self, wd):
+        """目录的监视失效，其中的文件在重新监视之前改为轮询"""
+        directory = self._wds.pop(wd, None)
+        if directory is None:
+            return
+        for path in self._paths:
+            if os.path.dirname(path) == directory:
+                self._signatures.setdefault(path, file_signature(path))
+
+    def wait(self, timeout):
+        """等待最多 timeout 秒，返回期间发生变化的路径集合；事件队列溢出时视为全部变化"""
+        if self._signatures:
+            timeout = min(timeout, self.poll_interval)
+        changed = self._read_events(timeout)
+        if self._signatures:
+            changed |= self._poll()
+        return changed
+
+    def _read_events(self, timeout):
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except (OSError, ValueError):
+            return set()
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0')
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                return set(self._paths)
+            if mask & IN_MOVE_SELF:
+                # 目录被移走后监视仍跟着原目录，路径已对不上，主动移除
+                if wd in self._wds:
+                    self._libc.inotify_rm_watch(self.fd, wd)
+                self._unwatch(wd)
+                continue
+            if mask & IN_IGNORED:
+                # 目录被删除，之后由轮询检查并重新添加监视
+                self._unwatch(wd)
+                continue
+            directory = self._wds.get(wd)
+            if directory is not None and name:
+                path = os.path.join(directory, os.fsdecode(name))
+                if path in self._paths:
+                    changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def default_watch_source():
+    """Linux 上优先使用 inotify，失败时退回轮询"""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatchSource()
+        except (OSError, AttributeError):
+            pass
+    return PollingWatchSource()
+
+
+class FirmwareWatcher:
+    """监视一组固件文件，维护已加载固件的快照
+
+    on_reload(changes) 在监视线程中调用，changes 为 [(路径, 旧 FirmwareImage 或 None, 新 FirmwareImage)]；
+    on_error(path, error) 在文件读取失败时调用。GUI 需自行切换回 Tk 线程。
+    """
+    def __init__(self, cache=None, on_reload=None, on_error=None, settle=1.0, source=None):
+        self.cache = cache or shared_cache
+        self.on_reload = on_reload
+        self.on_error = on_error
+        self.settle = settle
+        self.source = source
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._images = {}       # 绝对路径 -> 当前快照中的 FirmwareImage
+        self._wanted = set()
+        self._dirty = False
+        self._pending = {}      # 绝对路径 -> [最近一次看到的签名, 签名最后变化的时间]
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.source is None:
+            self.source = default_watch_source()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def watch(self, paths):
+        """设置要监视的固件路径（替换之前的设置），新路径在后台加载"""
+        wanted = {os.path.abspath(path) for path in paths if path}
+        with self._lock:
+            if wanted != self._wanted:
+                self._wanted = wanted
+                self._dirty = True
+
+    def resolve(self, firmwares):
+        """把 [(路径, 地址)] 中的路径换成同一份快照中的 FirmwareImage；尚未加载的保留路径，由烧录引擎按路径读取"""
+        with self._lock:
+            images = dict(self._images)
+        resolved = []
+        for path, address in firmwares:
+            if isinstance(path, str):
+                path = images.get(os.path.abspath(path), path)
+            resolved.append((path, address))
+        return resolved
+
+    def snapshot(self):
+        """(快照编号, {路径: FirmwareImage})"""
+        with self._lock:
+            return self.generation, dict(self._images)
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                with self._lock:
+                    dirty, self._dirty = self._dirty, False
+                    wanted = set(self._wanted)
+                if dirty:
+                    self._update_paths(wanted)
+                if self._pending and self._settled(time.monotonic()):
+                    self._reload()
+                timeout = min(self.settle / 2, 0.5) if self._pending else 0.5
+                changed = self.source.wait(timeout)
+                now = time.monotonic()
+                for path in changed & wanted:
+                    # 写入过程中会持续收到事件，每次都重新计时
+                    self._pending[path] = [file_signature(path), now]
+        finally:
+            self.source.close()
+
+    def _update_paths(self, wanted):
+        self.source.set_paths(wanted)
+        with self._lock:
+            for path in list(self._images):
+                if path not in wanted:
+                    del self._images[path]
+            loaded = set(self._images)
+        for path in list(self._pending):
+            if path not in wanted:
+                del self._pending[path]
+        for path in wanted - loaded:
+            # 新加入的文件如果修改时间已经足够早，下一轮即可直接加载
+            self._pending.setdefault(path, [file_signature(path), float('-inf')])
+
+    def _settled(self, now):
+        """本轮变化的文件是否都已写完：签名 settle 秒内没有变化，修改时间也早于 settle 秒前"""
+        wall = time.time()
+        for path, entry in self._pending.items():
+            signature = file_signature(path)
+            if signature != entry[0]:
+                entry[0], entry[1] = signature, now
+            if now - entry[1] < self.settle:
+                return False
+            if signature is None:
+                if now - entry[1] < self.settle * MISSING_GRACE:
+                    return False
+            elif wall - signature[1] / 1e9 < self.settle:
+                return False
+        return True
+
+    def _reload(self):
+        """加载本轮变化的全部文件，全部成功后一次性切换快照"""
+        loaded = {}
+        for path, entry in list(self._pending.items()):
+            if entry[0] is None:
+                continue
+            try:
+                image = self.cache.get(path)
+            except OSError as e:
+                del self._pending[path]
+                if self.on_error is not None:
+                    try:
+                        self.on_error(path, e)
+                    except Exception:
+                        pass
+                continue
+            if file_signature(path) != entry[0]:
+                # 读取期间文件又被改写，等它再次稳定
+                entry[0], entry[1] = file_signature(path), time.monotonic()
+                return
+            image.populated_extents(SECTOR_SIZE)
+            image.blocks(BLOCK_SIZE)
+            loaded[path] = image
+        self._pending.clear()
+        changes = []
+        with self._lock:
+            for path, image in loaded.items():
+                if path not in self._wanted:
+                    continue
+                old = self._images.get(path)
+                if old is not image:
+                    self._images[path] = image
+                    changes.append((path, old, image))
+            if changes:
+                self.generation += 1
+        if changes and self.on_reload is not None:
+            try:
+                self.on_reload(changes)
+            except Exception:
+                pass
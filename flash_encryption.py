@@ -0,0 +1,436 @@
+"""主机端预加密（flash 加密量产）
+
+启用 flash 加密的产品原本写入明文，首次上电时由引导程序在片上逐块加密，每块板子在产线上多耗十几秒。
+这里在主机上按 espsecure 的算法把固件表中的明文固件加密为密文，写入后在同一个串口会话中烧写
+密钥和加密使能 eFuse，板子复位后直接以加密方式启动：
+
+    - batch：整批板子共用一个密钥文件（需预先用 genkey 生成），每个固件只加密一次
+    - device：每块板子一个随机密钥，按 MAC 保存在 key_dir 下；同一块板子重新烧录时沿用原密钥
+
+加密在进程池中进行，结果按 (密钥, 加密方式, 固件 SHA-256, 地址) 缓存。device 模式下预先生成
+ahead 份“密钥 + 密文”，板子读到 MAC 时直接领取一份，单板周期中不再等待加密。
+
+ESP32 使用带地址调整的 AES-256（FLASH_CRYPT_CONFIG=0xF），其余芯片使用 XTS-AES
+（32 字节密钥为 XTS-AES-128；ESP32-S2/S3 可用 64 字节密钥，即 XTS-AES-256）。
+eFuse 烧写不可撤销，只在全部固件写入并校验通过后进行。
+
+示例:
+    python flash_encryption.py genkey batch.key
+    python flash_encryption.py encrypt --chip esp32c3 --key batch.key 0x10000 app.bin app-enc.bin
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from firmware_cache import FirmwareImage
+
+ENCRYPTION_MODES = ('batch', 'device')
+KEY_DIR = 'flash_keys'
+# ESP32 的 FLASH_CRYPT_CONFIG，与 espsecure 的默认值一致
+FLASH_CRYPT_CONFIG = 0xF
+# 密文不可压缩，只用最快的压缩级别，避免在压缩上浪费时间
+CIPHER_COMPRESS_LEVEL = 1
+
+
+class EncryptionError(ValueError):
+    """密钥或配置错误"""
+
+
+class ChipScheme:
+    """一种芯片的加密方式和需要烧写的 eFuse"""
+    def __init__(self, scheme, key_sizes, counter, default_block, purposes=None):
+        self.scheme = scheme                # 'esp32' 或 'xts'
+        self.key_sizes = key_sizes          # 可用的密钥长度（字节）
+        self.counter = counter              # 加密使能计数器，置位的位数为奇数时启用
+        self.default_block = default_block
+        self.purposes = purposes or {}      # 密钥长度 -> KEY_PURPOSE
+
+    def burn_commands(self, key_path, key_size, block=None):
+        """espefuse 的命令行参数：烧写密钥并启用 flash 加密"""
+        block = block or self.default_block
+        if self.scheme == 'esp32':
+            commands = ['burn_key', block, key_path]
+            enable = ['burn_efuse', self.counter, '1', 'FLASH_CRYPT_CONFIG', str(FLASH_CRYPT_CONFIG)]
+        else:
+            commands = ['burn_key', block, key_path, self.purposes[key_size]]
+            enable = ['burn_efuse', self.counter, '1']
+        return commands, enable
+
+
+_XTS_128 = {32: 'XTS_AES_128_KEY'}
+_XTS_256 = {32: 'XTS_AES_128_KEY', 64: 'XTS_AES_256_KEY'}
+
+CHIP_SCHEMES = {
+    'esp32': ChipScheme('esp32', (32,), 'FLASH_CRYPT_CNT', 'flash_encryption'),
+    'esp32s2': ChipScheme('xts', (32, 64), 'SPI_BOOT_CRYPT_CNT', 'BLOCK_KEY0', _XTS_256),
+    'esp32s3': ChipScheme('xts', (32, 64), 'SPI_BOOT_CRYPT_CNT', 'BLOCK_KEY0', _XTS_256),
+    'esp32c3': ChipScheme('xts', (32,), 'SPI_BOOT_CRYPT_CNT', 'BLOCK_KEY0', _XTS_128),
+    'esp32c6': ChipScheme('xts', (32,), 'SPI_BOOT_CRYPT_CNT', 'BLOCK_KEY0', _XTS_128),
+    'esp32p4': ChipScheme('xts', (32, 64), 'SPI_BOOT_CRYPT_CNT', 'BLOCK_KEY0', _XTS_256),
+}
+
+
+def chip_scheme(chip):
+    scheme = CHIP_SCHEMES.get(chip)
+    if scheme is None:
+        raise EncryptionError(f"芯片 {chip} 不支持主机端预加密")
+    return scheme
+
+
+def key_id(key):
+    """密钥的短指纹，用于日志、结果和缓存键，不暴露密钥本身"""
+    return hashlib.sha256(key).hexdigest()[:16]
+
+
+def pad_block(data):
+    """加密数据须为 16 字节的整数倍，用 0xFF 补齐（不用随机数，同一密钥下的密文可重复）"""
+    data = bytes(data)
+    if len(data) % 16:
+        data += b'\xff' * (16 - len(data) % 16)
+    return data
+
+
+def encrypt_data(data, address, key, scheme):
+    """按 espsecure encrypt_flash_data 的算法加密（在工作进程中执行）"""
+    import espsecure
+    output = io.BytesIO()
+    # espsecure 会打印密钥长度等信息，工作进程中不需要
+    with contextlib.redirect_stdout(io.StringIO()):
+        if scheme == 'esp32':
+            espsecure._flash_encryption_operation_esp32(
+                output, io.BytesIO(data), address, io.BytesIO(key), FLASH_CRYPT_CONFIG, False)
+        else:
+            espsecure._flash_encryption_operation_aes_xts(output, io.BytesIO(data), address, io.BytesIO(key), False)
+    return output.getvalue()
+
+
+def read_key(path):
+    with open(path, 'rb') as f:
+        key = f.read()
+    if len(key) not in (32, 64):
+        raise EncryptionError(f"密钥文件 {path} 长度为 {len(key)} 字节，应为 32 或 64 字节")
+    return key
+
+
+def write_key(path, key):
+    """先写临时文件再替换，权限只对当前用户可读写"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = path + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class KeyStore:
+    """按 MAC 保存的密钥（device 模式）：key_dir/<mac_hex>.key；
+    以及本站为各 MAC 烧写过的密钥指纹（两种模式都记录）：key_dir/<mac_hex>.burned"""
+    def __init__(self, directory=KEY_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def path(self, mac, suffix='.key'):
+        return os.path.join(self.directory, mac.replace(':', '').lower() + suffix)
+
+    def get(self, mac):
+        path = self.path(mac)
+        if not os.path.exists(path):
+            return None
+        return read_key(path)
+
+    def put(self, mac, key):
+        """登记新密钥；该 MAC 已有密钥时返回原密钥，保证一块板子只对应一个密钥"""
+        with self._lock:
+            existing = self.get(mac)
+            if existing is not None:
+                return existing
+            try:
+                write_key(self.path(mac), key)
+            except OSError as e:
+                raise EncryptionError(f"保存 {mac} 的密钥失败: {e}")
+            return key
+
+    def burned(self, mac):
+        """本站为该 MAC 烧写过的密钥指纹，没有记录时返回 None"""
+        try:
+            with open(self.path(mac, '.burned'), 'r', encoding='utf-8') as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def record_burn(self, mac, key):
+        """记录即将为该 MAC 烧写的密钥；记录失败时不能烧写"""
+        try:
+            write_key(self.path(mac, '.burned'), key_id(key).encode())
+        except OSError as e:
+            raise EncryptionError(f"保存 {mac} 的烧写记录失败: {e}")
+
+
+class EncryptedImages:
+    """一块板子要写入的密文：[(地址, FirmwareImage)]，以及所用的密钥"""
+    def __init__(self, key, images, new_key):
+        self.key = key
+        self.key_id = key_id(key)
+        self.images = images
+        self.new_key = new_key
+
+
+class _Cipher:
+    """进程池中的一次加密，首次取结果时包装为 FirmwareImage"""
+    def __init__(self, future, name):
+        self.future = future
+        self.name = name
+        self.image = None
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self.image.memory_size if self.image is not None else 0
+
+    def get(self):
+        with self._lock:
+            if self.image is None:
+                self.image = FirmwareImage(self.name, self.future.result(), CIPHER_COMPRESS_LEVEL)
+            return self.image
+
+
+class EncryptionStage:
+    """主机端预加密和 eFuse 烧写，由 FlashEngine 在烧录会话中调用
+
+    mode 为 ENCRYPTION_MODES 之一；batch 模式使用 key_file，device 模式按 MAC 把密钥保存在 keys 中。
+    plain 为保持明文写入的地址（如不加密的 NVS、SPIFFS 分区）。chip 为预计的芯片型号（如固件包的目标芯片），
+    未给出时以最近一块板子的型号为准，在此之前 device 模式不预先加密。
+    """
+    def __init__(self, mode, key_file=None, keys=None, key_size=32, key_block=None, plain=(), chip=None,
+                 workers=2, ahead=4, max_bytes=256 * 1024 * 1024):
+        if mode not in ENCRYPTION_MODES:
+            raise EncryptionError(f"无效的加密方式: {mode}")
+        if key_size not in (32, 64):
+            raise EncryptionError(f"密钥长度应为 32 或 64 字节: {key_size}")
+        self.mode = mode
+        self.key_size = key_size
+        self.key_block = key_block
+        self.plain = set(plain)
+        self.chip = chip
+        self.ahead = ahead
+        self.max_bytes = max_bytes
+        self.keys = keys or KeyStore()
+        self.key_file = key_file
+        self.batch_key = None
+        if mode == 'batch':
+            if not key_file:
+                raise EncryptionError("batch 模式需要指定密钥文件")
+            # 整批密钥要烧进每块板子，不能因为路径写错就悄悄换成一个新密钥
+            if not os.path.exists(key_file):
+                raise EncryptionError(f"密钥文件 {key_file} 不存在，请先用 python flash_encryption.py genkey {key_file} 生成")
+            self.batch_key = read_key(key_file)
+            self.key_size = len(self.batch_key)
+        # spawn：不从带着串口和界面线程的进程 fork，各平台行为一致
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self._lock = threading.Lock()
+        self._ciphers = OrderedDict()   # (密钥指纹, 加密方式, SHA-256, 地址) -> _Cipher
+        self._reserve = deque()         # device 模式预先准备的 (密钥, 加密方式, 固件签名)
+
+    def describe(self):
+        if self.mode == 'batch':
+            return f"整批密钥 {key_id(self.batch_key)}（{self.key_file}）"
+        return f"每板独立密钥（保存在 {self.keys.directory}）"
+
+    def prefetch(self, images, chip=None):
+        """在板子连接之前开始加密：batch 模式加密整批共用的密文，device 模式补足 ahead 份预备密钥"""
+        chip = chip or self.chip
+        if chip is None or chip not in CHIP_SCHEMES:
+            return
+        scheme = CHIP_SCHEMES[chip]
+        if self.mode == 'batch':
+            self._encrypt_all(self.batch_key, scheme, images)
+            return
+        signature = self._signature(scheme, images)
+        with self._lock:
+            # 固件或芯片变化后旧的预备密钥作废
+            while self._reserve and self._reserve[0][1:] != signature:
+                self._reserve.popleft()
+            missing = self.ahead - len(self._reserve)
+            keys = [os.urandom(self._device_key_size(scheme)) for _ in range(max(missing, 0))]
+            for key in keys:
+                self._reserve.append((key,) + signature)
+        for key in keys:
+            self._encrypt_all(key, scheme, images)
+
+    def submit(self, mac, chip, images):
+        """为读到 MAC 的板子准备密文，返回 EncryptedImages；device 模式下新密钥在返回前已保存"""
+        scheme = chip_scheme(chip)
+        self.chip = chip
+        for address, image in images:
+            if address % 16 and address not in self.plain:
+                raise EncryptionError(f"加密固件 {image.path} 的地址 0x{address:x} 不是 16 的整数倍")
+        new_key = False
+        if self.mode == 'batch':
+            key = self.batch_key
+            if len(key) not in scheme.key_sizes:
+                raise EncryptionError(f"{chip} 不支持 {len(key) * 8} 位密钥")
+        else:
+            key = self.keys.get(mac)
+            if key is None:
+                key = self.keys.put(mac, self._take_reserve(scheme, images))
+                new_key = True
+        ciphers = self._encrypt_all(key, scheme, images)
+        encrypted = []
+        for address, image in images:
+            cipher = ciphers.get(address)
+            encrypted.append((address, cipher.get() if cipher is not None else image))
+        self.prefetch(images, chip)
+        return EncryptedImages(key, encrypted, new_key)
+
+    def _take_reserve(self, scheme, images):
+        signature = self._signature(scheme, images)
+        with self._lock:
+            while self._reserve:
+                entry = self._reserve.popleft()
+                if entry[1:] == signature:
+                    return entry[0]
+        return os.urandom(self._device_key_size(scheme))
+
+    def _device_key_size(self, scheme):
+        return self.key_size if self.key_size in scheme.key_sizes else 32
+
+    def _signature(self, scheme, images):
+        return (scheme.scheme, tuple((address, image.sha256) for address, image in images))
+
+    def _encrypt_all(self, key, scheme, images):
+        """提交 images 中需要加密的固件（已缓存的直接复用），返回 {地址: _Cipher}"""
+        ident = key_id(key)
+        ciphers = {}
+        with self._lock:
+            for address, image in images:
+                if address in self.plain:
+                    continue
+                cache_key = (ident, scheme.scheme, image.sha256, address)
+                cipher = self._ciphers.get(cache_key)
+                if cipher is None or (cipher.future.done() and cipher.future.exception() is not None):
+                    future = self._pool.submit(encrypt_data, pad_block(image.data), address, key, scheme.scheme)
+                    cipher = _Cipher(future, f"{image.path} (加密 {ident})")
+                    self._ciphers[cache_key] = cipher
+                self._ciphers.move_to_end(cache_key)
+                ciphers[address] = cipher
+            # 按内存上限淘汰最久未用的密文，至少保留本次用到的
+            total = sum(cipher.size for cipher in self._ciphers.values())
+            for cache_key in list(self._ciphers):
+                if total <= self.max_bytes:
+                    break
+                cipher = self._ciphers[cache_key]
+                if cipher in ciphers.values():
+                    continue
+                total -= cipher.size
+                del self._ciphers[cache_key]
+        return ciphers
+
+    def burned_for(self, mac):
+        """本站是否记录过为该 MAC 烧写该板应使用的密钥（整批密钥或该板已分配的密钥）"""
+        key = self.batch_key if self.mode == 'batch' else self.keys.get(mac)
+        return key is not None and self.keys.burned(mac) == key_id(key)
+
+    def inspect(self, esp, chip):
+        """读取 eFuse：返回 (flash 加密是否已启用, 密钥块是否空闲)"""
+        import espefuse
+        scheme = chip_scheme(chip)
+        efuses, _ = espefuse.get_efuses(esp, do_not_confirm=True)
+        enabled = bin(efuses[scheme.counter].get_raw()).count('1') % 2 == 1
+        block = efuses.blocks[efuses.get_index_block_by_name(self.key_block or scheme.default_block)]
+        free = block.is_readable() and block.get_bitstring().all(False)
+        purpose = getattr(block, 'key_purpose_name', None)
+        if purpose:
+            free = free and efuses[purpose].get_raw() == 0
+        return enabled, free
+
+    def burn(self, esp, chip, mac, key, burn_key=True):
+        """烧写密钥和加密使能 eFuse（不可撤销）；密钥只在临时目录中短暂落盘，烧写后删除
+
+        烧写密钥前先记录到 keys，烧写中途断开时下次凭记录只补烧使能位；没有记录的已占用密钥块一律不动。
+        """
+        import espefuse
+        scheme = chip_scheme(chip)
+        if burn_key:
+            self.keys.record_burn(mac, key)
+        directory = tempfile.mkdtemp(prefix='flash-key-')
+        try:
+            key_path = os.path.join(directory, 'key.bin')
+            write_key(key_path, key)
+            key_commands, enable = scheme.burn_commands(key_path, len(key), self.key_block)
+            commands = ['--do-not-confirm'] + (key_commands if burn_key else []) + enable
+            espefuse.main(commands, esp=esp)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def stage_from_config(config, chip=None):
+    """由配置（config.json 的 encryption 项或命令行参数组成的字典）创建 EncryptionStage"""
+    from flash_engine import parse_address
+    if not config or not config.get('mode') or config['mode'] == 'off':
+        return None
+    return EncryptionStage(
+        config['mode'],
+        key_file=config.get('key_file'),
+        keys=KeyStore(config.get('key_dir', KEY_DIR)),
+        key_size=int(config.get('key_bits', 256)) // 8,
+        key_block=config.get('key_block'),
+        plain=[parse_address(address) for address in config.get('plain', [])],
+        chip=config.get('chip') or chip,
+        workers=int(config.get('workers', 2)),
+        ahead=int(config.get('ahead', 4)),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="flash 加密密钥生成和主机端加密")
+    sub = parser.add_subparsers(dest='command', required=True)
+    genkey = sub.add_parser('genkey', help='生成随机密钥文件')
+    genkey.add_argument('output')
+    genkey.add_argument('--bits', type=int, choices=(256, 512), default=256)
+    encrypt = sub.add_parser('encrypt', help='用密钥加密一个固件')
+    encrypt.add_argument('--chip', required=True, choices=sorted(CHIP_SCHEMES))
+    encrypt.add_argument('--key', required=True)
+    encrypt.add_argument('address')
+    encrypt.add_argument('input')
+    encrypt.add_argument('output')
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'genkey':
+            if os.path.exists(args.output):
+                raise EncryptionError(f"{args.output} 已存在，不覆盖")
+            write_key(args.output, os.urandom(args.bits // 8))
+            print(json.dumps({'key': args.output, 'key_id': key_id(read_key(args.output))}))
+            return 0
+        key = read_key(args.key)
+        scheme = chip_scheme(args.chip)
+        if len(key) not in scheme.key_sizes:
+            raise EncryptionError(f"{args.chip} 不支持 {len(key) * 8} 位密钥")
+        with open(args.input, 'rb') as f:
+            data = pad_block(f.read())
+        with open(args.output, 'wb') as f:
+            f.write(encrypt_data(data, int(args.address, 0), key, scheme.scheme))
+        return 0
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"{e}\n")
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
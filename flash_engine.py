@@ -0,0 +1,1037 @@
+"""进程内烧录引擎
+
+每块板子只打开一次串口：检测芯片、上传一次 stub、依次写入所有固件、
+用片上 MD5 校验（可选随机回读抽样），最后复位。结果以结构化对象返回，不再解析 esptool 的输出文本。
+各阶段耗时用 time.perf_counter 计量，记录在 FlashResult.phases 中（单位秒）。
+"""
+import hashlib
+import random
+import sys
+import threading
+import time
+
+from chip_info import CHIP_MAP, ChipInfo, get_chip_param, shared_chip_cache  # noqa: F401
+from firmware_cache import FirmwareImage, shared_cache
+from port_monitor import find_port
+from progress import JobProgress
+
+# 各芯片默认的 flash 参数
+FLASH_PARAMS = {
+    'esp32': {
+        'flash_mode': 'dio',
+        'flash_freq': '40m',
+        'flash_size': 'detect'
+    },
+    'esp32s3': {
+        'flash_mode': 'dio',
+        'flash_freq': '80m',
+        'flash_size': '16MB'
+    },
+    'esp32s2': {
+        'flash_mode': 'dio',
+        'flash_freq': '80m',
+        'flash_size': '4MB'
+    },
+    'esp32c3': {
+        'flash_mode': 'dio',
+        'flash_freq': '80m',
+        'flash_size': '4MB'
+    },
+    'esp32c6': {
+        'flash_mode': 'dio',
+        'flash_freq': '80m',
+        'flash_size': '4MB'
+    }
+}
+
+ROM_BAUD = 115200
+FLASH_SECTOR_SIZE = 0x1000
+# 差分烧录时比较 MD5 的分区大小，必须是扇区大小的整数倍
+DIFF_REGION_SIZE = 0x10000
+# 校验方式：off 不校验，md5 整个固件片上 MD5，sample 另外随机回读若干扇区逐字节比较
+VERIFY_MODES = ('off', 'md5', 'sample')
+VERIFY_SAMPLES = 4
+# 校验失败时最多定位的不一致区间数
+MAX_MISMATCH_RANGES = 8
+# 整片擦除：off 不擦除，auto 在稀疏写入可跳过的空白达到 flash 容量的 CHIP_ERASE_RATIO 时擦除，on 总是擦除
+CHIP_ERASE_MODES = ('off', 'auto', 'on')
+CHIP_ERASE_RATIO = 0.5
+# 写入中链路出错后的恢复次数（每个任务），以及重新连接前的等待时间（秒，每次翻倍，不超过上限）
+RESUME_RETRIES = 3
+RESUME_BACKOFF = 0.5
+RESUME_BACKOFF_MAX = 8.0
+
+
+def parse_address(address):
+    """解析烧录地址，支持 0x 前缀的十六进制和十进制"""
+    if isinstance(address, int):
+        return address
+    return int(str(address).strip(), 0)
+
+
+class FlashError(Exception):
+    """烧录失败，phase 记录出错的阶段，校验失败时 ranges 为不一致的 [(起始地址, 结束地址)]"""
+    def __init__(self, message, phase=None, ranges=None):
+        super().__init__(message)
+        self.phase = phase
+        self.ranges = ranges
+
+
+def format_ranges(ranges):
+    return ', '.join(f"0x{start:08x}-0x{end:08x}" for start, end in ranges)
+
+
+class _OutputRouter:
+    """按线程转发 stdout，使 esptool 的打印进入各自端口的日志"""
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self._local = threading.local()
+
+    def set_sink(self, sink):
+        self._local.sink = sink
+
+    def write(self, text):
+        sink = getattr(self._local, 'sink', None)
+        if sink is None:
+            return self.fallback.write(text)
+        if text.strip():
+            # 回调自身若再打印到 stdout，则直接交给原始输出，避免递归
+            self._local.sink = None
+            try:
+                sink(text.strip())
+            finally:
+                self._local.sink = sink
+        return len(text)
+
+    def flush(self):
+        if getattr(self._local, 'sink', None) is None:
+            self.fallback.flush()
+
+    def isatty(self):
+        return False
+
+
+_router_lock = threading.Lock()
+
+
+def _get_router():
+    """安装（或复用）stdout 路由器"""
+    with _router_lock:
+        if not isinstance(sys.stdout, _OutputRouter):
+            sys.stdout = _OutputRouter(sys.stdout)
+        return sys.stdout
+
+
+def default_loader_factory(port, baud=ROM_BAUD, connect_mode='default_reset', chip=None):
+    """打开串口并返回已连接的 esptool 加载器对象
+
+    chip 为已知的芯片参数名（如 esp32s3）时直接按该型号连接，跳过自动识别；
+    型号不符时 esptool 会报错。
+    """
+    if chip is None:
+        from esptool.cmds import detect_chip
+        return detect_chip(port=port, baud=baud, connect_mode=connect_mode)
+    from esptool.targets import CHIP_DEFS
+    esp = CHIP_DEFS[chip](port, baud)
+    try:
+        esp.connect(connect_mode)
+    except Exception:
+        esp._port.close()
+        raise
+    return esp
+
+
+class ImageResult:
+    """单个固件的烧录结果"""
+    def __init__(self, path, address):
+        self.path = path
+        self.address = address
+        self.size = 0
+        self.compressed_size = 0
+        self.written = 0
+        self.skipped = 0
+        self.blank = 0
+        self.sent = 0
+        self.md5 = None
+        self.sha256 = None
+        self.verified = False
+        self.sampled = 0
+        self.diff_time = 0.0
+        self.write_time = 0.0
+        self.verify_time = 0.0
+        self.elapsed = 0.0
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'address': '0x%x' % self.address,
+            'size': self.size,
+            'compressed_size': self.compressed_size,
+            'written': self.written,
+            'skipped': self.skipped,
+            'blank': self.blank,
+            'sent': self.sent,
+            'md5': self.md5,
+            'sha256': self.sha256,
+            'verified': self.verified,
+            'sampled': self.sampled,
+            'write_time': round(self.write_time, 4),
+            'verify_time': round(self.verify_time, 4),
+            'elapsed': round(self.elapsed, 3),
+        }
+
+
+class WriteCheckpoint:
+    """一个固件的写入进度，链路中断恢复后从已确认的位置续写
+
+    position 为加载器已应答的数据写到的偏移；stub 先应答后写入，最后几块可能并未真正写入，
+    恢复时用片上 MD5 确认后得到 confirmed（与固件一致的前缀长度，按扇区对齐）。
+    """
+    def __init__(self, address, image):
+        self.address = address
+        self.image = image
+        self.result = None      # ImageResult，首次写入时创建
+        self.started = None
+        self.extents = None     # 需要写入的区间（差分、稀疏写入的结果），None 表示整个固件
+        self.blank = []         # 只需擦除的空白区间
+        self.blank_done = False
+        self.position = 0
+        self.confirmed = 0
+
+    def remaining(self):
+        """确认的前缀之后仍需写入的区间；尚未恢复过时与 extents 相同"""
+        if not self.confirmed:
+            return self.extents
+        targets = self.extents if self.extents is not None else [(0, self.image.size)]
+        return [(max(start, self.confirmed), end) for start, end in targets if end > self.confirmed]
+
+
+class FlashResult:
+    """一块板子的完整烧录结果"""
+    def __init__(self, port):
+        self.port = port
+        self.chip = None
+        self.chip_param = None
+        self.chip_info = None
+        self.chip_cached = False
+        self.description = None
+        self.mac = None
+        self.serial = None
+        self.flash_size = None
+        self.baud = None
+        self.baud_steps = 0
+        self.success = False
+        self.error = None
+        self.error_phase = None
+        self.mismatch = None
+        self.images = []
+        self.phases = {}
+        # 写入中每次链路出错后的恢复记录
+        self.recoveries = []
+        # 主机端预加密：方式、密钥指纹、本次是否烧写了 eFuse
+        self.encryption = None
+        self.log = []
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    @property
+    def bytes_written(self):
+        """写入 flash 的字节数（解压后）"""
+        return sum(image.written for image in self.images)
+
+    @property
+    def bytes_sent(self):
+        """经串口发送的压缩数据字节数"""
+        return sum(image.sent for image in self.images)
+
+    @property
+    def write_kbps(self):
+        """写入阶段的有效速度（KB/s，按解压后字节计）"""
+        write_time = self.phases.get('write', 0.0)
+        return self.bytes_written / 1024.0 / write_time if write_time > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            'port': self.port,
+            'chip': self.chip,
+            'description': self.description,
+            'revision': self.chip_info.revision if self.chip_info else None,
+            'mac': self.mac,
+            'serial': self.serial,
+            'flash_id': self.chip_info.to_dict()['flash_id'] if self.chip_info else None,
+            'flash_size': self.flash_size,
+            'chip_cached': self.chip_cached,
+            'baud': self.baud,
+            'baud_steps': self.baud_steps,
+            'success': self.success,
+            'error': self.error,
+            'error_phase': self.error_phase,
+            'mismatch': format_ranges(self.mismatch) if self.mismatch else None,
+            'images': [image.to_dict() for image in self.images],
+            'recoveries': self.recoveries,
+            'encryption': self.encryption,
+            'phases': {k: round(v, 4) for k, v in self.phases.items()},
+            'bytes_written': self.bytes_written,
+            'bytes_sent': self.bytes_sent,
+            'write_kbps': round(self.write_kbps, 1),
+            'started': self.started,
+            'elapsed': round(self.elapsed, 3),
+        }
+
+
+class FlashEngine:
+    """在单个串口会话内完成一块板子的全部烧录步骤
+
+    loader_factory(port, baud, chip=None) 返回已连接的加载器对象，默认使用 esptool，
+    测试时可替换为连接模拟串口引导程序的实现；识别缓存命中时以 chip 传入已知的芯片参数名。
+    识别结果按 port_lookup(port) 得到的 USB 身份缓存在 chip_cache 中。
+    固件通过 cache 读取，默认与其他任务共享同一个压缩缓存。
+    diff 为 True 时先比较设备上各分区的 MD5，只擦写内容不同的分区。
+    verify 为 VERIFY_MODES 之一（True 等同 md5，False 等同 off）；sample 模式下在 MD5 之外
+    随机回读 verify_samples 个扇区。校验失败时用分段 MD5 定位并回读，报告精确的不一致区间。
+    before / after 与 esptool 的同名参数一致，无 DTR/RTS 的串口（如 pty）使用 no_reset。
+    adaptive_baud 为 True 时 baud 作为上限，起始速率由 baud_selector 按端口的历史记录选择，
+    链路出错时逐级降速并重写当前固件。
+    target_chip 和 flash_size 由固件包给出：连接到其他型号的芯片时中止，
+    并以固件包的 flash 容量配置 stub（检测到的容量更小时中止）。
+    device_data 为 DeviceDataStage 时，读到 MAC 后即开始生成该板的专属数据（序列号、NVS 分区），
+    在共用固件之后于同一会话中写入。
+    sparse 为 True 时只发送含非 0xFF 数据的扇区，空白扇区改用擦除命令，不再传输和写入填充数据；
+    chip_erase 为 CHIP_ERASE_MODES 之一，整片擦除后空白扇区连擦除也可省去（会清除 flash 上的全部数据）。
+    写入中链路出错（同步失败、短暂断开）时最多恢复 resume_retries 次：自适应模式下先降速，
+    否则等待 resume_backoff 秒（逐次翻倍）后重新连接，用片上 MD5 确认已写入的部分，从第一个未确认的扇区续写。
+    encryption 为 EncryptionStage 时写入主机端加密后的密文，全部写入并校验后在同一会话中烧写密钥和加密使能 eFuse。
+    """
+    def __init__(self, baud=2000000, loader_factory=None, verify=True, cache=None,
+                 diff=False, diff_region_size=DIFF_REGION_SIZE, before='default_reset', after='hard_reset',
+                 adaptive_baud=False, baud_selector=None, chip_cache=None, port_lookup=None,
+                 target_chip=None, flash_size=None, device_data=None, verify_samples=VERIFY_SAMPLES,
+                 sparse=False, chip_erase='off', resume_retries=RESUME_RETRIES, resume_backoff=RESUME_BACKOFF,
+                 encryption=None):
+        self.baud = int(baud)
+        self.device_data = device_data
+        self.encryption = encryption
+        self.target_chip = target_chip
+        self.flash_size = flash_size if flash_size != 'detect' else None
+        self.baud_selector = None
+        if adaptive_baud or baud_selector is not None:
+            if baud_selector is None:
+                from baud_selector import shared_selector as baud_selector
+            self.baud_selector = baud_selector
+        self.before = before
+        self.after = after
+        self.loader_factory = loader_factory or (
+            lambda port, baud, chip=None: default_loader_factory(port, baud, self.before, chip)
+        )
+        self.chip_cache = chip_cache or shared_chip_cache
+        self.port_lookup = port_lookup or find_port
+        if verify is True:
+            verify = 'md5'
+        elif not verify:
+            verify = 'off'
+        if verify not in VERIFY_MODES:
+            raise ValueError(f"无效的校验方式: {verify}")
+        if encryption is not None and verify == 'off':
+            # eFuse 烧写不可撤销，必须先确认 flash 上的密文与主机加密结果一致
+            raise ValueError("flash 加密需要写入后校验，不能与 --verify off 同时使用")
+        self.verify = verify
+        self.verify_samples = int(verify_samples)
+        self.cache = cache or shared_cache
+        self.diff = diff
+        self.diff_region_size = diff_region_size
+        if chip_erase is True:
+            chip_erase = 'on'
+        elif not chip_erase:
+            chip_erase = 'off'
+        if chip_erase not in CHIP_ERASE_MODES:
+            raise ValueError(f"无效的整片擦除方式: {chip_erase}")
+        if chip_erase == 'on' and diff:
+            raise ValueError("差分烧录依赖 flash 上的原有数据，不能与整片擦除同时使用")
+        self.sparse = sparse
+        self.chip_erase = chip_erase
+        self.resume_retries = int(resume_retries)
+        self.resume_backoff = float(resume_backoff)
+
+    def flash(self, port, firmwares, log=None, cancel=None, progress=None):
+        """烧录 firmwares 中的 (路径, 地址) 列表，返回 FlashResult
+
+        路径也可以是已加载的 FirmwareImage（如固件包中的固件），此时不再读取文件。
+
+        cancel 为 threading.Event，置位后在下一个数据块之前中止。
+        progress(ProgressEvent) 在阶段切换和每个数据块写入后于烧录线程中调用，应尽快返回。
+        """
+        result = FlashResult(port)
+        tracker = JobProgress(port, progress)
+        sink = log or (lambda message: None)
+
+        def log(message):
+            # 同时保留在结果中，供结果库压缩保存
+            result.log.append(time.strftime('%H:%M:%S ') + message)
+            sink(message)
+
+        router = _get_router()
+        router.set_sink(log)
+        esp = None
+        phase = 'load'
+        started = time.perf_counter()
+        try:
+            t = time.perf_counter()
+            images = self._load_images(firmwares)
+            if self.device_data is not None:
+                self._check_regions(images)
+            for address, image in images:
+                tracker.add_total(image.size)
+            if self.encryption is not None:
+                # 连接、上传 stub 期间在进程池中预先加密
+                self.encryption.prefetch(images, self.target_chip)
+            result.phases['load'] = time.perf_counter() - t
+
+            phase = 'connect'
+            tracker.set_phase(phase)
+            t = time.perf_counter()
+            key = self._port_key(port)
+            esp = self._connect(port, key, log)
+            self._identify(esp, key, result, log)
+            result.phases['connect'] = time.perf_counter() - t
+            log(f"检测到芯片类型: {result.chip} ({result.description}), MAC: {result.mac}")
+            if not result.chip_param:
+                raise FlashError(f"不支持的芯片类型: {result.chip}", 'connect')
+            if self.target_chip and result.chip_param != self.target_chip:
+                raise FlashError(f"芯片类型 {result.chip} 与固件包的目标芯片 {self.target_chip} 不一致", 'connect')
+            pending = None
+            if self.device_data is not None and result.mac:
+                # 与 stub 上传和共用固件写入并行生成
+                pending = self.device_data.submit(result.mac, result.chip)
+
+            phase = 'stub'
+            tracker.set_phase(phase)
+            t = time.perf_counter()
+            esp = esp.run_stub()
+            result.baud = ROM_BAUD
+            baud = self.baud
+            if self.baud_selector is not None:
+                baud = self.baud_selector.start_baud(port, self.baud)
+            if baud > ROM_BAUD:
+                self._change_baud(esp, baud, result, log)
+            self._configure_flash(esp, result)
+            self.chip_cache.put(key, result.chip_info)
+            result.phases['stub'] = time.perf_counter() - t
+
+            encrypted = None
+            if self.encryption is not None:
+                phase = 'encrypt'
+                tracker.set_phase(phase)
+                t = time.perf_counter()
+                encrypted, burn_key = self._prepare_encryption(esp, images, result, log)
+                images = encrypted.images
+                result.phases['encrypt'] = time.perf_counter() - t
+
+            erased = False
+            if self._use_chip_erase(images, result):
+                phase = 'erase'
+                tracker.set_phase(phase)
+                t = time.perf_counter()
+                log("整片擦除 flash...")
+                esp.erase_flash()
+                erased = True
+                result.phases['erase'] = time.perf_counter() - t
+                log(f"整片擦除完成，用时 {result.phases['erase']:.1f} 秒")
+
+            phase = 'write'
+            esp = self._write_images(esp, images, result, log, cancel, erased, tracker)
+
+            if self.device_data is not None:
+                phase = 'device_data'
+                tracker.set_phase(phase)
+                if pending is None:
+                    raise FlashError("未读取到 MAC，无法生成专属数据", phase)
+                t = time.perf_counter()
+                try:
+                    data = pending.result()
+                except Exception as e:
+                    raise FlashError(f"生成专属数据失败: {e}", phase)
+                result.phases['device_data'] = time.perf_counter() - t
+                result.serial = data.serial
+                log(f"序列号: {data.serial}")
+                phase = 'write'
+                for address, image in data.images:
+                    tracker.add_total(image.size)
+                esp = self._write_images(esp, data.images, result, log, cancel, erased, tracker)
+
+            if encrypted is not None and burn_key is not None:
+                phase = 'efuse'
+                tracker.set_phase(phase)
+                t = time.perf_counter()
+                log("固件已写入并校验，烧写 flash 加密 eFuse...")
+                try:
+                    self.encryption.burn(esp, result.chip_param, result.mac, encrypted.key, burn_key)
+                except Exception as e:
+                    raise FlashError(f"烧写 eFuse 失败: {e}", phase)
+                result.encryption['burned'] = True
+                result.phases['efuse'] = time.perf_counter() - t
+                log(f"已启用 flash 加密（密钥 {encrypted.key_id}），用时 {result.phases['efuse']:.1f} 秒")
+
+            phase = 'reset'
+            tracker.set_phase(phase)
+            t = time.perf_counter()
+            # stub 下不能直接发送 flash_finish，否则加载器会退出
+            esp.flash_begin(0, 0)
+            esp.flash_defl_finish(False)
+            if self.after == 'hard_reset':
+                esp.hard_reset()
+            result.phases['reset'] = time.perf_counter() - t
+
+            result.success = True
+            log(f"端口 {port} 所有固件烧录完成!")
+        except Exception as e:
+            result.error = str(e)
+            result.error_phase = getattr(e, 'phase', None) or phase
+            result.mismatch = getattr(e, 'ranges', None)
+            log(f"端口 {port} 烧录错误({result.error_phase}): {result.error}")
+        finally:
+            if esp is not None:
+                try:
+                    esp._port.close()
+                except Exception:
+                    pass
+            router.set_sink(None)
+            result.elapsed = time.perf_counter() - started
+            tracker.finish(result.success)
+        if self.baud_selector is not None and result.baud:
+            try:
+                self.baud_selector.report(port, result.baud, result.success, result.baud_steps > 0)
+            except Exception:
+                pass
+        return result
+
+    def _load_images(self, firmwares):
+        """从缓存取得全部固件，在打开串口之前发现文件错误"""
+        images = []
+        for path, address in firmwares:
+            try:
+                address = parse_address(address)
+            except ValueError:
+                raise FlashError(f"无效的烧录地址: {address}", 'load')
+            if isinstance(path, FirmwareImage):
+                images.append((address, path))
+                continue
+            try:
+                image = self.cache.get(path)
+            except OSError as e:
+                raise FlashError(f"读取固件失败: {e}", 'load')
+            images.append((address, image))
+        return images
+
+    def _prepare_encryption(self, esp, images, result, log):
+        """读取 eFuse 状态并取得该板的密文，返回 (EncryptedImages, burn_key)
+
+        burn_key 为 None 表示芯片已启用 flash 加密、不再烧写 eFuse；False 表示密钥块已写过（上次烧写中断），
+        只烧写使能位。在写入任何数据之前发现密钥块被占用等问题。
+        """
+        stage = self.encryption
+        if not result.mac:
+            raise FlashError("未读取到 MAC，无法分配加密密钥", 'encrypt')
+        try:
+            enabled, free = stage.inspect(esp, result.chip_param)
+        except Exception as e:
+            raise FlashError(f"读取 eFuse 失败: {e}", 'encrypt')
+        # 密钥块不可回读，只有本站记录过为这块板子烧写当前密钥时才认为块中是该密钥
+        recorded = stage.burned_for(result.mac)
+        if enabled and not recorded:
+            raise FlashError("芯片已启用 flash 加密，但本站没有为该板烧写当前密钥的记录", 'encrypt')
+        if not enabled and not free and not recorded:
+            raise FlashError("密钥 eFuse 块已被占用，且本站没有为该板烧写当前密钥的记录", 'encrypt')
+        try:
+            encrypted = stage.submit(result.mac, result.chip_param, images)
+        except Exception as e:
+            raise FlashError(f"加密固件失败: {e}", 'encrypt')
+        result.encryption = {'mode': stage.mode, 'key_id': encrypted.key_id, 'new_key': encrypted.new_key,
+                             'burned': False}
+        if enabled:
+            log(f"芯片已启用 flash 加密，按密钥 {encrypted.key_id} 写入密文")
+            return encrypted, None
+        if not free:
+            log(f"密钥块已写入，沿用密钥 {encrypted.key_id}，只烧写使能位")
+            return encrypted, False
+        log(f"使用{'新' if encrypted.new_key else ''}密钥 {encrypted.key_id} 写入密文")
+        return encrypted, True
+
+    def _check_regions(self, images):
+        """共用固件不能覆盖专属数据分区"""
+        for address, image in images:
+            for start, end, name in self.device_data.regions():
+                if address < end and start < address + image.size:
+                    raise FlashError(f"固件 {image.path} 与专属数据分区 {name} (0x{start:x}-0x{end:x}) 重叠", 'load')
+
+    def _use_chip_erase(self, images, result):
+        """是否先整片擦除：auto 模式下按稀疏写入可跳过的空白字节数与 flash 容量比较"""
+        if self.chip_erase == 'on':
+            return True
+        if self.chip_erase == 'off' or self.diff or not self.sparse:
+            return False
+        from esptool.util import flash_size_bytes
+        blank = sum(
+            image.size - sum(end - start for start, end in image.populated_extents(FLASH_SECTOR_SIZE))
+            for address, image in images if address % FLASH_SECTOR_SIZE == 0
+        )
+        return blank >= CHIP_ERASE_RATIO * flash_size_bytes(result.flash_size)
+
+    def _write_images(self, esp, images, result, log, cancel, erased=False, tracker=None):
+        """依次写入 [(地址, 固件)]，返回之后使用的加载器（恢复时可能已重新连接）
+
+        链路出错时由 _recover 降速或重新连接，再从当前固件第一个未确认的扇区续写。
+        """
+        tracker = tracker or JobProgress(result.port)
+        original = esp
+        try:
+            for address, image in images:
+                done = tracker.done
+                checkpoint = WriteCheckpoint(address, image)
+                while True:
+                    t = time.perf_counter()
+                    try:
+                        image_result = self._write_image(esp, address, image, log, cancel, erased, tracker,
+                                                         checkpoint)
+                        break
+                    except FlashError:
+                        raise
+                    except Exception as e:
+                        # 失败的写入耗时也计入写入阶段
+                        result.phases['write'] = result.phases.get('write', 0.0) + time.perf_counter() - t
+                        esp = self._recover(esp, checkpoint, result, log, e, cancel)
+                        tracker.rewind(done)
+                self._account(result, image_result)
+        except BaseException:
+            # 调用方只会关闭原来的串口
+            if esp is not original:
+                try:
+                    esp._port.close()
+                except Exception:
+                    pass
+            raise
+        return esp
+
+    def _account(self, result, image_result):
+        """登记一个写完的固件并累计各阶段耗时"""
+        result.images.append(image_result)
+        if self.diff:
+            result.phases['diff'] = result.phases.get('diff', 0.0) + image_result.diff_time
+        result.phases['write'] = result.phases.get('write', 0.0) + image_result.write_time
+        if self.verify != 'off':
+            result.phases['verify'] = result.phases.get('verify', 0.0) + image_result.verify_time
+
+    def _port_key(self, port):
+        """端口的 USB 身份，用作识别缓存的键"""
+        try:
+            info = self.port_lookup(port)
+        except Exception:
+            info = None
+        return info.identity() if info is not None else f"port:{port}"
+
+    def _connect(self, port, key, log):
+        """连接引导程序；缓存中有该端口的芯片型号时直接按型号连接"""
+        cached = self.chip_cache.get(key)
+        if cached is not None and cached.chip_param:
+            log(f"按上次识别的芯片类型 {cached.chip} 连接...")
+            try:
+                return self.loader_factory(port, ROM_BAUD, chip=cached.chip_param)
+            except Exception as e:
+                self.chip_cache.invalidate(key)
+                log(f"按 {cached.chip} 连接失败({e})，重新检测芯片类型")
+        log("检测芯片类型...")
+        return self.loader_factory(port, ROM_BAUD)
+
+    def _identify(self, esp, key, result, log):
+        """读取 MAC；与缓存一致时沿用缓存的识别结果，否则重新读取型号、版本和特性"""
+        mac = esp.read_mac()
+        mac = ':'.join('%02x' % b for b in mac) if mac else None
+        cached = self.chip_cache.get(key)
+        if cached is not None and cached.chip == esp.CHIP_NAME and cached.mac == mac:
+            info = cached
+            result.chip_cached = True
+        else:
+            if cached is not None:
+                log(f"MAC 已变化（上次 {cached.mac}），重新识别芯片")
+                self.chip_cache.invalidate(key)
+            info = ChipInfo.from_loader(esp, mac)
+        self.chip_cache.record(result.chip_cached)
+        result.chip_info = info
+        result.chip = info.chip
+        result.chip_param = info.chip_param
+        result.description = info.description
+        result.mac = info.mac
+
+    def _change_baud(self, esp, baud, result, log):
+        """切换到 baud；自适应模式下确认链路可用，失败时逐级降速"""
+        while True:
+            try:
+                esp.change_baud(baud)
+                if self.baud_selector is not None:
+                    esp.read_reg(esp.CHIP_DETECT_MAGIC_REG_ADDR)
+                result.baud = baud
+                return
+            except Exception as e:
+                lower = self.baud_selector.lower(baud) if self.baud_selector is not None else None
+                if lower is None:
+                    raise
+                log(f"波特率 {baud} 不稳定({str(e) or type(e).__name__})，降到 {lower}")
+                result.baud_steps += 1
+                baud = lower
+                # 超时后 esptool 的 SLIP 读取器已失效，需重建
+                esp.flush_input()
+
+    def _step_down(self, esp, result, log, error):
+        """写入过程中链路出错：在当前连接内降一级速率，返回 True 表示可以继续写入"""
+        if self.baud_selector is None:
+            return False
+        lower = self.baud_selector.lower(result.baud)
+        if lower is None:
+            return False
+        log(f"写入出错({str(error) or type(error).__name__})，波特率从 {result.baud} 降到 {lower} 后继续写入")
+        result.baud_steps += 1
+        esp.flush_input()
+        self._change_baud(esp, lower, result, log)
+        return True
+
+    def _recover(self, esp, checkpoint, result, log, error, cancel=None):
+        """写入过程中链路出错：降速或重新连接，确认已写入的前缀，返回可继续使用的加载器
+
+        每次尝试（包括失败的尝试）都记入 result.recoveries，用完 resume_retries 次后抛出最后的错误。
+        """
+        # 降速只在第一次尝试：降速后仍无法确认说明板子已复位或断开，之后都重新连接
+        in_session = True
+        while True:
+            if len(result.recoveries) >= self.resume_retries:
+                raise error
+            attempt = len(result.recoveries) + 1
+            recovery = {
+                'attempt': attempt,
+                'error': str(error) or type(error).__name__,
+                'address': '0x%x' % checkpoint.address,
+                'position': checkpoint.position,
+                'baud': result.baud,
+            }
+            result.recoveries.append(recovery)
+            t = time.perf_counter()
+            try:
+                stepped = False
+                if in_session:
+                    in_session = False
+                    try:
+                        stepped = self._step_down(esp, result, log, error)
+                    except Exception:
+                        # 当前连接已不可用
+                        pass
+                if stepped:
+                    recovery['method'] = 'baud'
+                else:
+                    recovery['method'] = 'reconnect'
+                    esp = self._reconnect(esp, result, log, attempt, cancel)
+                confirmed = self._confirm(esp, checkpoint)
+            except FlashError:
+                raise
+            except Exception as e:
+                recovery['failed'] = str(e) or type(e).__name__
+                recovery['seconds'] = round(time.perf_counter() - t, 3)
+                log(f"第 {attempt} 次恢复失败: {recovery['failed']}")
+                error = e
+                continue
+            recovery['resumed'] = confirmed
+            recovery['seconds'] = round(time.perf_counter() - t, 3)
+            log(f"已确认 0x{checkpoint.address:08x} 起的 {confirmed} 字节与固件一致，"
+                f"从 0x{checkpoint.address + confirmed:08x} 续写")
+            return esp
+
+    def _reconnect(self, esp, result, log, attempt, cancel=None):
+        """关闭串口，退避等待后重新连接同一块板子，恢复 stub、波特率和 flash 参数"""
+        try:
+            esp._port.close()
+        except Exception:
+            pass
+        delay = min(self.resume_backoff * 2 ** (attempt - 1), RESUME_BACKOFF_MAX)
+        log(f"链路中断，{delay:.1f} 秒后重新连接（第 {attempt} 次恢复）...")
+        if cancel is None:
+            time.sleep(delay)
+        elif cancel.wait(delay):
+            raise FlashError("任务已取消", 'cancelled')
+        baud = result.baud
+        esp = self.loader_factory(result.port, ROM_BAUD, chip=result.chip_param)
+        try:
+            mac = esp.read_mac()
+            mac = ':'.join('%02x' % b for b in mac) if mac else None
+            if mac != result.mac:
+                raise FlashError(f"重新连接后 MAC 为 {mac}，与之前的 {result.mac} 不同，板子可能已更换", 'write')
+            esp = esp.run_stub()
+            result.baud = ROM_BAUD
+            if baud > ROM_BAUD:
+                self._change_baud(esp, baud, result, log)
+            self._configure_flash(esp, result)
+        except BaseException:
+            try:
+                esp._port.close()
+            except Exception:
+                pass
+            raise
+        return esp
+
+    def _confirm(self, esp, checkpoint):
+        """用片上 MD5 找出已写入且与固件一致的最长前缀（按扇区），作为续写起点返回
+
+        写入的区间之外（差分未变化、空白扇区）flash 上的内容本来就与固件一致，因此可以直接比较整段前缀。
+        """
+        image = checkpoint.image
+        if checkpoint.address % FLASH_SECTOR_SIZE:
+            # 地址未按扇区对齐时无法从中间开始擦写
+            checkpoint.confirmed = checkpoint.position = 0
+            return 0
+        data = memoryview(image.data)
+        low = checkpoint.confirmed
+        if checkpoint.position >= image.size:
+            high = image.size
+        else:
+            high = checkpoint.position // FLASH_SECTOR_SIZE * FLASH_SECTOR_SIZE
+
+        def matches(end):
+            # [0, low) 已确认，只需比较 [low, end)
+            return esp.flash_md5sum(checkpoint.address + low, end - low) == hashlib.md5(data[low:end]).hexdigest()
+
+        if high > low:
+            if matches(high):
+                low = high
+            else:
+                # 已应答的最后几块可能没写入，二分查找第一个不一致的扇区
+                while high - low > FLASH_SECTOR_SIZE:
+                    middle = low + max((high - low) // 2 // FLASH_SECTOR_SIZE, 1) * FLASH_SECTOR_SIZE
+                    if matches(middle):
+                        low = middle
+                    else:
+                        high = middle
+        checkpoint.confirmed = checkpoint.position = low
+        return low
+
+    def _configure_flash(self, esp, result):
+        """检测 flash 容量并告知 stub，以便写入超过默认大小的区域；识别缓存命中时不再读取 flash ID"""
+        from esptool.cmds import DETECTED_FLASH_SIZES
+        from esptool.util import flash_size_bytes
+        info = result.chip_info
+        if info.flash_size is None and not esp.secure_download_mode:
+            info.flash_id = esp.flash_id()
+            info.flash_size = DETECTED_FLASH_SIZES.get(info.flash_id >> 16)
+        flash_size = info.flash_size
+        if self.flash_size:
+            if flash_size and flash_size_bytes(flash_size) < flash_size_bytes(self.flash_size):
+                raise FlashError(f"检测到的 flash 容量 {flash_size} 小于固件包要求的 {self.flash_size}", 'stub')
+            flash_size = self.flash_size
+        elif flash_size is None:
+            flash_size = FLASH_PARAMS.get(result.chip_param, {}).get('flash_size')
+            if flash_size in (None, 'detect'):
+                flash_size = '4MB'
+        result.flash_size = flash_size
+        esp.flash_set_parameters(flash_size_bytes(flash_size))
+
+    def _write_image(self, esp, address, image, log, cancel=None, erased=False, tracker=None, checkpoint=None):
+        """压缩写入一个固件并用片上 MD5 校验；erased 表示 flash 已整片擦除
+
+        checkpoint 记录写入进度，链路中断恢复后以同一个 checkpoint 再次调用时从已确认的位置续写，
+        差分比较和空白扇区擦除不再重复。
+        """
+        tracker = tracker or JobProgress(None)
+        checkpoint = checkpoint or WriteCheckpoint(address, image)
+        image_result = checkpoint.result
+        if image_result is None:
+            image_result = checkpoint.result = ImageResult(image.path, address)
+            image_result.size = image.size
+            image_result.compressed_size = len(image.compressed)
+            image_result.md5 = image.md5
+            image_result.sha256 = image.sha256
+            checkpoint.started = time.perf_counter()
+            if self.diff:
+                tracker.set_phase('diff')
+                checkpoint.extents = self._diff_extents(esp, address, image)
+                image_result.diff_time = time.perf_counter() - checkpoint.started
+            if self.sparse and address % FLASH_SECTOR_SIZE == 0:
+                checkpoint.extents, checkpoint.blank = self._sparse_extents(image, checkpoint.extents)
+        tracker.set_phase('write')
+        t = time.perf_counter()
+        if not checkpoint.blank_done:
+            # 空白扇区不传输数据，只擦除；整片擦除过则无需处理
+            if not erased:
+                for start, end in checkpoint.blank:
+                    size = (end - start + FLASH_SECTOR_SIZE - 1) // FLASH_SECTOR_SIZE * FLASH_SECTOR_SIZE
+                    esp.erase_region(address + start, size)
+            checkpoint.blank_done = True
+        image_result.blank = sum(end - start for start, end in checkpoint.blank)
+        extents = checkpoint.remaining()
+        if extents is not None:
+            tracker.skip(image.size - sum(end - start for start, end in extents))
+        if extents is None:
+            log(f"写入 0x{address:08x}: {image.size} 字节 (压缩后 {len(image.compressed)})")
+            self._write_blocks(esp, address, image.size, len(image.compressed),
+                               image.blocks(esp.FLASH_WRITE_SIZE), cancel, tracker, checkpoint)
+            image_result.written = image.size
+            image_result.sent += len(image.compressed)
+        else:
+            block_size = esp.FLASH_WRITE_SIZE
+            label = "续写区间" if checkpoint.confirmed else "写入差异区间"
+            for start, end in extents:
+                compressed = image.compressed_range(start, end)
+                log(f"{label} 0x{address + start:08x}-0x{address + end:08x}: "
+                    f"{end - start} 字节 (压缩后 {len(compressed)})")
+                blocks = [(compressed[i:i + block_size], None)
+                          for i in range(0, len(compressed), block_size)]
+                self._write_blocks(esp, address + start, end - start, len(compressed), blocks, cancel, tracker,
+                                   checkpoint)
+                image_result.sent += len(compressed)
+            # 续写时已确认的部分不再发送，但同样计入写入量
+            image_result.written = (sum(end - start for start, end in checkpoint.extents)
+                                    if checkpoint.extents is not None else image.size)
+            image_result.skipped = image.size - image_result.written - image_result.blank
+            if self.diff:
+                log(f"差分烧录: 跳过 {image_result.skipped} 字节，写入 {image_result.written} 字节")
+            if self.sparse:
+                log(f"稀疏写入: 跳过空白 {image_result.blank} 字节（{'已整片擦除' if erased else '仅擦除'}），"
+                    f"写入 {image_result.written} 字节")
+        checkpoint.position = image.size
+        image_result.write_time = time.perf_counter() - t
+
+        if self.verify != 'off':
+            tracker.set_phase('verify')
+            t = time.perf_counter()
+            self._verify_image(esp, address, image, image_result, log)
+            image_result.verified = True
+            image_result.verify_time = time.perf_counter() - t
+        image_result.elapsed = time.perf_counter() - checkpoint.started
+        log(f"固件 {image.path} 烧录完成，用时 {image_result.elapsed:.1f} 秒")
+        return image_result
+
+    def _verify_image(self, esp, address, image, image_result, log):
+        """片上 MD5 校验，sample 模式下再随机回读若干扇区；不一致时定位区间后抛出 FlashError"""
+        flash_md5 = esp.flash_md5sum(address, image.size)
+        if flash_md5 != image.md5:
+            ranges = self._locate_mismatch(esp, address, image)
+            raise FlashError(
+                f"固件 {image.path} 校验失败: 文件 MD5 {image.md5}, flash MD5 {flash_md5}, "
+                f"不一致区间 {format_ranges(ranges) or '未能定位'}",
+                'verify', ranges
+            )
+        if self.verify != 'sample' or self.verify_samples <= 0:
+            return
+        sectors = (image.size + FLASH_SECTOR_SIZE - 1) // FLASH_SECTOR_SIZE
+        for index in sorted(random.sample(range(sectors), min(self.verify_samples, sectors))):
+            start = index * FLASH_SECTOR_SIZE
+            end = min(start + FLASH_SECTOR_SIZE, image.size)
+            mismatch = self._compare_readback(esp, address, image, start, end)
+            image_result.sampled += end - start
+            if mismatch:
+                ranges = [(address + mismatch[0], address + mismatch[1])]
+                raise FlashError(
+                    f"固件 {image.path} 回读校验失败: 不一致区间 {format_ranges(ranges)}", 'verify', ranges
+                )
+        log(f"回读抽样 {image_result.sampled} 字节一致")
+
+    def _locate_mismatch(self, esp, address, image):
+        """对半分段比较片上 MD5，到单个扇区时回读，返回不一致的 [(起始地址, 结束地址)]"""
+        ranges = []
+        data = memoryview(image.data)
+        pending = [(0, image.size)]
+        while pending and len(ranges) < MAX_MISMATCH_RANGES:
+            start, end = pending.pop()
+            if end - start > FLASH_SECTOR_SIZE:
+                middle = start + max((end - start) // 2 // FLASH_SECTOR_SIZE, 1) * FLASH_SECTOR_SIZE
+                # 先处理前半段，区间按地址顺序产生
+                for part in ((middle, end), (start, middle)):
+                    if esp.flash_md5sum(address + part[0], part[1] - part[0]) != \
+                            hashlib.md5(data[part[0]:part[1]]).hexdigest():
+                        pending.append(part)
+                continue
+            mismatch = self._compare_readback(esp, address, image, start, end)
+            if mismatch is None:
+                continue
+            first, last = address + mismatch[0], address + mismatch[1]
+            if ranges and ranges[-1][1] == first:
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+        return ranges
+
+    def _compare_readback(self, esp, address, image, start, end):
+        """回读 [start, end) 并与固件比较，返回不一致的 (起始偏移, 结束偏移)，一致时返回 None"""
+        flash = esp.read_flash(address + start, end - start)
+        expected = image.data[start:end]
+        if flash == expected:
+            return None
+        length = min(len(flash), len(expected))
+        first = next((i for i in range(length) if flash[i] != expected[i]), length)
+        last = next((i for i in range(length - 1, -1, -1) if flash[i] != expected[i]), length - 1)
+        return start + first, start + max(last + 1, first + 1)
+
+    def _write_blocks(self, esp, address, size, compressed_size, blocks, cancel=None, tracker=None, checkpoint=None):
+        """发送一段压缩数据，blocks 为 [(压缩块, 解压后长度或 None)]；每块应答后更新 checkpoint 的写入位置"""
+        from esptool.loader import DEFAULT_TIMEOUT, ERASE_WRITE_TIMEOUT_PER_MB, timeout_per_mb
+        esp.flash_defl_begin(size, compressed_size, address)
+        timeout = DEFAULT_TIMEOUT
+        # 解压长度未知时按整段的平均压缩率估算
+        average = size * esp.FLASH_WRITE_SIZE // max(compressed_size, 1)
+        remaining = size
+        for seq, (block, uncompressed_size) in enumerate(blocks):
+            if cancel is not None and cancel.is_set():
+                raise FlashError("任务已取消", 'cancelled')
+            if uncompressed_size is None:
+                uncompressed_size = average
+            block_timeout = max(
+                DEFAULT_TIMEOUT,
+                timeout_per_mb(ERASE_WRITE_TIMEOUT_PER_MB, uncompressed_size)
+            )
+            esp.flash_defl_block(bytes(block), seq, timeout=timeout)
+            # stub 收到数据即应答，写入与下一块的接收并行，下一次等待需按本块写入时间计算
+            timeout = block_timeout
+            # 估算的块长度合计可能与实际不同，以整段长度为准
+            written = min(uncompressed_size, remaining) if seq < len(blocks) - 1 else remaining
+            remaining -= written
+            if tracker is not None:
+                tracker.advance(written)
+            if checkpoint is not None:
+                checkpoint.position = address + size - remaining - checkpoint.address
+        # 最后一次读寄存器会等到最后一块真正写入 flash 后才应答
+        esp.read_reg(esp.CHIP_DETECT_MAGIC_REG_ADDR, timeout=timeout)
+
+    def _sparse_extents(self, image, targets=None):
+        """把要写入的区间（默认整个固件）按扇区表拆分为 (含数据的区间, 空白区间)"""
+        if targets is None:
+            targets = [(0, image.size)]
+        populated = image.populated_extents(FLASH_SECTOR_SIZE)
+        extents, blank = [], []
+        for start, end in targets:
+            position = start
+            for data_start, data_end in populated:
+                first, last = max(data_start, start), min(data_end, end)
+                if first >= last:
+                    continue
+                if first > position:
+                    blank.append((position, first))
+                extents.append((first, last))
+                position = last
+            if position < end:
+                blank.append((position, end))
+        return extents, blank
+
+    def _diff_extents(self, esp, address, image):
+        """比较设备与固件各分区的 MD5，返回需要写入的 [(起始, 结束)] 偏移区间
+
+        地址未按扇区对齐时无法只擦写部分分区，返回 None 表示整片写入。
+        """
+        if address % FLASH_SECTOR_SIZE:
+            return None
+        region = self.diff_region_size
+        extents = []
+        for index, host_md5 in enumerate(image.region_md5s(region)):
+            start = index * region
+            end = min(start + region, image.size)
+            if esp.flash_md5sum(address + start, end - start) == host_md5:
+                continue
+            # 相邻的差异分区合并为一次写入
+            if extents and extents[-1][1] == start:
+                extents[-1] = (extents[-1][0], end)
+            else:
+                extents.append((start, end))
+        return extents
@@ -0,0 +1,591 @@
+"""多机烧录：协调端与烧录代理
+
+一台电脑能接的 Hub 有限，产线可以在多台电脑上各运行一个烧录代理（agent），
+由一个协调端（coordinator）通过 TCP 下发同一个固件包和烧录策略，汇总每块板子的结果和整体产能。
+
+- 代理按 SHA-256 缓存收到的固件包（bundle_cache/），同一个固件包只传输一次；
+- 协议为按行分隔的 JSON 消息，固件包内容紧跟在 bundle 消息之后按字节发送；
+- --simulate N 让代理使用 N 个模拟设备（见 benchmarks/fake_esp_rom.py），
+  可以在一台 Linux 电脑上启动多个代理进程测试整个流程；
+- 代理默认只监听本机回环地址，监听其他地址时必须用 --token 设置令牌，否则局域网内任何人都能下发固件并烧录。
+
+示例:
+    python flash_fleet.py agent --listen 9200 --host 0.0.0.0 --token 产线令牌
+    python flash_fleet.py agent --listen 9201 --simulate 4
+    python flash_fleet.py coordinator --bundle app.espbundle --agent 10.0.0.11:9200 --agent 10.0.0.12:9200 --auto
+"""
+import argparse
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+from flasher_cli import HeadlessStation
+from hub_throttle import parse_hub_limit
+
+PROTOCOL_VERSION = 1
+DEFAULT_AGENT_PORT = 9200
+DEFAULT_AGENT_HOST = '127.0.0.1'
+BUNDLE_CACHE_DIR = 'bundle_cache'
+# 代理接收的固件包上限（字节），防止一条消息让代理分配任意大的缓冲区
+MAX_BUNDLE_SIZE = 256 * 1024 * 1024
+# 固件包按块写入缓存文件
+RECEIVE_CHUNK = 1024 * 1024
+SHA256_PATTERN = re.compile(r'[0-9a-f]{64}')
+# 协调端下发给代理的烧录选项
+POLICY_OPTIONS = ('baud', 'diff', 'verify', 'verify_samples', 'adaptive_baud', 'sparse', 'chip_erase', 'resume_retries')
+
+
+class FleetError(Exception):
+    """协议错误或代理拒绝请求"""
+
+
+def is_loopback(host):
+    """监听地址是否只能从本机访问"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def send_message(stream, message, payload=None):
+    """发送一行 JSON，payload 为紧随其后的原始字节"""
+    stream.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+    if payload:
+        stream.write(payload)
+    stream.flush()
+
+
+def read_message(stream):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("连接已关闭")
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise FleetError(f"无效的消息: {line[:80]!r}")
+
+
+def check_sha256(value):
+    """对端发来的固件包哈希须为 64 个小写十六进制字符，才能用作缓存文件名"""
+    if not isinstance(value, str) or not SHA256_PATTERN.fullmatch(value):
+        raise FleetError(f"无效的固件包哈希: {str(value)[:80]!r}")
+    return value
+
+
+class BundleStore:
+    """按 SHA-256 保存收到的固件包，加载后的固件包在内存中共用"""
+    def __init__(self, directory=BUNDLE_CACHE_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._loaded = {}
+
+    def path(self, sha256):
+        return os.path.join(self.directory, check_sha256(sha256) + '.espbundle')
+
+    def hashes(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(name[:-len('.espbundle')] for name in names if name.endswith('.espbundle'))
+
+    def has(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def receive(self, sha256, stream, size):
+        """从连接中读取 size 字节的固件包，边读边写入临时文件并计算哈希，校验通过后再替换"""
+        path = self.path(sha256)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = path + '.tmp'
+        digest = hashlib.sha256()
+        try:
+            with open(tmp, 'wb') as f:
+                remaining = size
+                while remaining:
+                    chunk = stream.read(min(remaining, RECEIVE_CHUNK))
+                    if not chunk:
+                        raise ConnectionError("接收固件包时连接中断")
+                    digest.update(chunk)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if digest.hexdigest() != sha256:
+                raise FleetError("固件包传输后 SHA-256 不一致")
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def load(self, sha256):
+        """加载并校验固件包，同一个哈希只加载一次"""
+        from firmware_bundle import FirmwareBundle
+        with self._lock:
+            bundle = self._loaded.get(sha256)
+            if bundle is None:
+                bundle = self._loaded[sha256] = FirmwareBundle(self.path(sha256))
+            return bundle
+
+
+class AgentStation(HeadlessStation):
+    """代理上的烧录站：结果不写标准输出，而是发回协调端"""
+    def __init__(self, send, agent, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.send = send
+        self.agent = agent
+
+    def emit(self, record, job):
+        record['type'] = 'result'
+        record['agent'] = self.agent
+        # 过程日志随结果发回，由协调端写入结果数据库
+        if job.result is not None:
+            record['log'] = job.result.log
+        self.send(record)
+
+
+class FlashAgent:
+    """烧录代理：接受协调端连接，按下发的固件包和策略烧录本机串口，逐块板子回报结果
+
+    simulate 大于 0 时不使用真实串口，而是启动对应数量的模拟设备。
+    同一时间只服务一个协调端。监听回环以外的地址时必须设置 token。
+    """
+    def __init__(self, listen=DEFAULT_AGENT_PORT, host=DEFAULT_AGENT_HOST, store=None, name=None, token=None,
+                 simulate=0, verbose=False, max_bundle_size=MAX_BUNDLE_SIZE):
+        if not token and not is_loopback(host):
+            raise FleetError(f"监听 {host} 时必须用 --token 设置令牌，否则网络上任何人都能下发固件并烧录")
+        self.listen = listen
+        self.host = host
+        self.store = store or BundleStore()
+        self.name = name or f"{socket.gethostname()}:{listen}"
+        self.token = token
+        self.verbose = verbose
+        self.max_bundle_size = max_bundle_size
+        if simulate:
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+            from fake_esp_rom import FakeStation
+            self.simulator = FakeStation(simulate).start()
+        else:
+            self.simulator = None
+        self._busy = threading.Lock()
+
+    def ports(self):
+        if self.simulator is not None:
+            return self.simulator.ports
+        from port_monitor import list_ports
+        return [info.device for info in list_ports()]
+
+    def serve_forever(self):
+        server = socket.create_server((self.host, self.listen))
+        self.log(f"代理 {self.name} 等待协调端连接，端口 {self.listen}")
+        try:
+            while True:
+                conn, address = server.accept()
+                threading.Thread(target=self.handle, args=(conn, address), daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            if self.simulator is not None:
+                self.simulator.stop()
+
+    def log(self, message):
+        sys.stderr.write(f"[{self.name}] {message}\n")
+
+    def handle(self, conn, address):
+        stream = conn.makefile('rwb')
+        writer = threading.Lock()
+
+        def send(message, payload=None):
+            with writer:
+                send_message(stream, message, payload)
+
+        try:
+            hello = read_message(stream)
+            if hello.get('type') != 'hello' or hello.get('version') != PROTOCOL_VERSION:
+                raise FleetError("协议版本不一致")
+            token = str(hello.get('token') or '').encode('utf-8')
+            if self.token and not hmac.compare_digest(token, self.token.encode('utf-8')):
+                raise FleetError("令牌错误")
+            if not self._busy.acquire(blocking=False):
+                raise FleetError("已有协调端连接")
+            try:
+                send({'type': 'hello', 'agent': self.name, 'ports': self.ports(), 'bundles': self.store.hashes()})
+                self.log(f"协调端 {address[0]} 已连接")
+                self._session(stream, send)
+            finally:
+                self._busy.release()
+        except (ConnectionError, OSError) as e:
+            self.log(f"协调端 {address[0]} 断开: {e}")
+        except Exception as e:
+            try:
+                send({'type': 'error', 'error': str(e)})
+            except OSError:
+                pass
+            self.log(f"会话错误: {e}")
+        finally:
+            conn.close()
+
+    def _session(self, stream, send):
+        """在持有 _busy 时调用；本次会话创建的烧录站只在这里关闭，被拒绝的连接不会影响正在运行的任务"""
+        from firmware_bundle import BundleError
+        stop = threading.Event()
+        runner = None
+        stations = []
+        try:
+            while True:
+                message = read_message(stream)
+                kind = message.get('type')
+                if kind == 'bundle':
+                    sha256 = check_sha256(message.get('sha256'))
+                    size = message.get('size')
+                    if not isinstance(size, int) or isinstance(size, bool) or not 0 < size <= self.max_bundle_size:
+                        raise FleetError(f"固件包大小无效或超过上限 {self.max_bundle_size} 字节: {size!r}")
+                    self.store.receive(sha256, stream, size)
+                    self.log(f"已缓存固件包 {sha256[:12]} ({size} 字节)")
+                    send({'type': 'bundle_ok', 'sha256': sha256})
+                elif kind == 'job':
+                    if runner is not None:
+                        raise FleetError("本次连接已有任务在运行")
+                    try:
+                        bundle = self.store.load(check_sha256(message.get('bundle')))
+                    except (OSError, BundleError) as e:
+                        raise FleetError(f"加载固件包失败: {e}")
+                    runner = threading.Thread(target=self._run_job, args=(message, bundle, send, stop, stations),
+                                              daemon=True)
+                    runner.start()
+                elif kind == 'stop':
+                    break
+                else:
+                    raise FleetError(f"未知消息类型: {kind}")
+        finally:
+            stop.set()
+            for station in stations:
+                station.scheduler.shutdown()
+            if runner is not None:
+                # 等正在烧录的板子结束后才释放 _busy，下一个协调端不会和旧任务抢同一批串口
+                runner.join()
+
+    def _run_job(self, message, bundle, send, stop, stations):
+        """运行一个任务；无论成功还是出错都回报 done 或 error，协调端不会一直等待"""
+        try:
+            options = {key: message['options'][key] for key in POLICY_OPTIONS if key in message.get('options', {})}
+            options.update(bundle.engine_options())
+            if self.simulator is not None:
+                options.update({'before': 'no_reset', 'after': 'no_reset'})
+            station = AgentStation(
+                send,
+                self.name,
+                bundle.firmwares(),
+                options,
+                max_workers=message.get('workers') or 8,
+                retries=message.get('retries', 0),
+                verbose=self.verbose,
+                hub_limit=parse_hub_limit(message.get('hub_limit')),
+            )
+            stations.append(station)
+            try:
+                ports = message.get('ports') or self.ports()
+                if message.get('auto') and self.simulator is None:
+                    station.run_forever(message.get('ports'), stop=stop)
+                else:
+                    for _ in range(max(1, message.get('rounds', 1))):
+                        if stop.is_set():
+                            break
+                        station.run_once(ports)
+            finally:
+                station.scheduler.shutdown()
+            send({'type': 'done', 'agent': self.name, 'failures': station.failures})
+        except Exception as e:
+            self.log(f"任务出错: {e}")
+            try:
+                send({'type': 'error', 'error': str(e)})
+            except OSError:
+                pass
+
+
+class AgentLink:
+    """协调端到一个代理的连接与统计"""
+    def __init__(self, address):
+        host, _, port = address.rpartition(':')
+        self.address = (host or address, int(port) if host else DEFAULT_AGENT_PORT)
+        self.name = address
+        self.ports = []
+        self.sock = None
+        self.stream = None
+        self.success = 0
+        self.failed = 0
+        self.bytes_written = 0
+        self.cycle_time = 0.0
+        self.first = None
+        self.last = None
+        self.done = False
+        self.error = None
+
+    def record(self, message):
+        now = time.time()
+        self.first = self.first or now
+        self.last = now
+        if message.get('state') == 'success':
+            self.success += 1
+            self.bytes_written += message.get('bytes_written', 0)
+            self.cycle_time += message.get('elapsed', 0.0)
+        else:
+            self.failed += 1
+
+
+class FleetCoordinator:
+    """把固件包和烧录策略推送给多个代理，汇总结果
+
+    每个结果以一行 JSON 写到 out（带 agent 字段），汇总信息写到标准错误。
+    """
+    def __init__(self, agents, bundle_path, options=None, ports=None, auto=False, rounds=1,
+                 workers=None, retries=0, token=None, out=None, summary_interval=10, results=None,
+                 hub_limit=None):
+        self.links = [AgentLink(address) for address in agents]
+        self.bundle_path = bundle_path
+        self.options = dict(options or {})
+        self.ports = ports
+        self.auto = auto
+        self.rounds = rounds
+        self.workers = workers
+        self.retries = retries
+        self.hub_limit = hub_limit
+        self.token = token
+        self.out = out or sys.stdout
+        self.summary_interval = summary_interval
+        self.results = results
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.started = None
+
+    def run(self):
+        """连接全部代理并下发任务；单次模式下所有代理完成后返回是否全部成功"""
+        from firmware_bundle import FirmwareBundle
+        # 先在本机校验一次，避免把有问题的固件包发给所有代理
+        FirmwareBundle(self.bundle_path).close()
+        with open(self.bundle_path, 'rb') as f:
+            data = f.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+        self.started = time.time()
+        threads = [threading.Thread(target=self._serve, args=(link, data, sha256), daemon=True)
+                   for link in self.links]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(self.summary_interval / len(threads))
+                if any(thread.is_alive() for thread in threads):
+                    self.print_summary()
+        except KeyboardInterrupt:
+            self._stopping = True
+            for link in self.links:
+                self._stop(link)
+        self.print_summary()
+        return all(link.error is None and link.failed == 0 for link in self.links)
+
+    def _serve(self, link, data, sha256):
+        try:
+            link.sock = socket.create_connection(link.address, timeout=10)
+            link.sock.settimeout(None)
+            link.stream = link.sock.makefile('rwb')
+            send_message(link.stream, {'type': 'hello', 'version': PROTOCOL_VERSION, 'token': self.token})
+            hello = read_message(link.stream)
+            if hello.get('type') == 'error':
+                raise FleetError(hello.get('error'))
+            link.name = hello.get('agent', link.name)
+            link.ports = hello.get('ports', [])
+            if sha256 not in hello.get('bundles', []):
+                self.log(f"向 {link.name} 发送固件包 ({len(data)} 字节)")
+                send_message(link.stream, {'type': 'bundle', 'sha256': sha256, 'size': len(data)}, data)
+                reply = read_message(link.stream)
+                if reply.get('type') != 'bundle_ok':
+                    raise FleetError(reply.get('error') or f"代理返回 {reply.get('type')}")
+            else:
+                self.log(f"{link.name} 已缓存固件包，跳过传输")
+            send_message(link.stream, {
+                'type': 'job',
+                'bundle': sha256,
+                'options': {key: self.options[key] for key in POLICY_OPTIONS if key in self.options},
+                'ports': self.ports,
+                'auto': self.auto,
+                'rounds': self.rounds,
+                'workers': self.workers,
+                'retries': self.retries,
+                'hub_limit': self.hub_limit,
+            })
+            self.log(f"{link.name}: {len(link.ports)} 个端口开始烧录")
+            while True:
+                message = read_message(link.stream)
+                kind = message.get('type')
+                if kind == 'result':
+                    link.record(message)
+                    log = message.pop('log', None)
+                    if self.results is not None:
+                        self.results.record_dict(message, log)
+                    with self._lock:
+                        self.out.write(json.dumps(message, ensure_ascii=False) + '\n')
+                        self.out.flush()
+                elif kind == 'done':
+                    link.done = True
+                    break
+                elif kind == 'error':
+                    raise FleetError(message.get('error'))
+        except (OSError, ConnectionError, FleetError, ValueError) as e:
+            if not self._stopping:
+                link.error = str(e) or type(e).__name__
+                self.log(f"{link.name}: {link.error}")
+        finally:
+            self._stop(link)
+
+    def _stop(self, link):
+        if link.sock is None:
+            return
+        try:
+            send_message(link.stream, {'type': 'stop'})
+        except OSError:
+            pass
+        try:
+            link.sock.close()
+        except OSError:
+            pass
+
+    def log(self, message):
+        sys.stderr.write(message + '\n')
+
+    def summary(self):
+        """各代理和总体的成功数、失败数与产能（块/小时）"""
+        elapsed = max(time.time() - (self.started or time.time()), 1e-6)
+        rows = []
+        for link in self.links:
+            rows.append({
+                'agent': link.name,
+                'ports': len(link.ports),
+                'success': link.success,
+                'failed': link.failed,
+                'boards_per_hour': round(link.success * 3600 / elapsed, 1),
+                'avg_cycle': round(link.cycle_time / link.success, 2) if link.success else None,
+                'mb_written': round(link.bytes_written / 1024 / 1024, 2),
+                'error': link.error,
+            })
+        total = {
+            'agent': '合计',
+            'ports': sum(row['ports'] for row in rows),
+            'success': sum(row['success'] for row in rows),
+            'failed': sum(row['failed'] for row in rows),
+            'boards_per_hour': round(sum(link.success for link in self.links) * 3600 / elapsed, 1),
+            'avg_cycle': None,
+            'mb_written': round(sum(row['mb_written'] for row in rows), 2),
+            'error': None,
+        }
+        if total['success']:
+            total['avg_cycle'] = round(sum(link.cycle_time for link in self.links) / total['success'], 2)
+        return rows + [total]
+
+    def print_summary(self):
+        lines = [f"{'代理':<24}{'端口':>6}{'成功':>8}{'失败':>8}{'块/小时':>10}{'平均周期':>10}{'写入MB':>10}"]
+        for row in self.summary():
+            cycle = f"{row['avg_cycle']:.2f}" if row['avg_cycle'] is not None else '-'
+            lines.append(f"{row['agent']:<24}{row['ports']:>6}{row['success']:>8}{row['failed']:>8}"
+                         f"{row['boards_per_hour']:>10}{cycle:>10}{row['mb_written']:>10}"
+                         + (f"  {row['error']}" if row['error'] else ''))
+        self.log('\n'.join(lines))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ESP32 多机烧录")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    agent = commands.add_parser('agent', help="运行烧录代理")
+    agent.add_argument('--listen', type=int, default=DEFAULT_AGENT_PORT, help="监听端口")
+    agent.add_argument('--host', default=DEFAULT_AGENT_HOST,
+                       help="监听地址，默认只监听本机；监听其他地址（如 0.0.0.0）时必须指定 --token")
+    agent.add_argument('--name', default=None, help="代理名称，默认为 主机名:端口")
+    agent.add_argument('--cache-dir', default=BUNDLE_CACHE_DIR, help="固件包缓存目录")
+    agent.add_argument('--max-bundle-size', type=int, default=MAX_BUNDLE_SIZE // (1024 * 1024),
+                       help="接收的固件包大小上限（MB）")
+    agent.add_argument('--token', default=None, help="协调端须提供的令牌，监听非回环地址时必填")
+    agent.add_argument('--simulate', type=int, default=0, help="使用 N 个模拟设备代替真实串口（仅 Linux / macOS）")
+    agent.add_argument('--verbose', '-v', action='store_true', help="把烧录过程日志输出到标准错误")
+
+    coordinator = commands.add_parser('coordinator', help="向代理下发固件包并汇总结果")
+    coordinator.add_argument('--agent', action='append', required=True, help="代理地址 host:port，可重复指定")
+    coordinator.add_argument('--bundle', required=True, help="固件包（由 firmware_bundle.py 生成）")
+    coordinator.add_argument('--port', action='append', default=None, help="只烧录代理上的这些串口，默认全部")
+    coordinator.add_argument('--auto', action='store_true', help="代理持续监控串口，插入设备后自动烧录，Ctrl+C 结束")
+    coordinator.add_argument('--rounds', type=int, default=1, help="单次模式下每个端口烧录的轮数")
+    coordinator.add_argument('--baud', type=int, default=2000000, help="烧录波特率")
+    coordinator.add_argument('--workers', type=int, default=None, help="每个代理的最大并发任务数")
+    coordinator.add_argument('--retries', type=int, default=0, help="失败后自动重试次数")
+    coordinator.add_argument('--hub-limit', default=None, help="代理按 USB Hub 限制并发：auto 自动调整，数字为每个 Hub 的上限")
+    coordinator.add_argument('--adaptive-baud', action='store_true', help="自适应波特率")
+    coordinator.add_argument('--diff', action='store_true', help="差分烧录")
+    coordinator.add_argument('--sparse', action='store_true', help="稀疏写入，跳过 0xFF 空白扇区")
+    coordinator.add_argument('--chip-erase', default='off', choices=('off', 'auto', 'on'), help="写入前整片擦除")
+    coordinator.add_argument('--resume-retries', type=int, default=3, help="写入中链路出错后续写的次数")
+    coordinator.add_argument('--verify', default='md5', choices=('off', 'md5', 'sample'), help="写入后的校验方式")
+    coordinator.add_argument('--verify-samples', type=int, default=4, help="sample 模式下每个固件回读的扇区数")
+    coordinator.add_argument('--token', default=None, help="代理要求的令牌")
+    coordinator.add_argument('--results-db', default=None, help="把所有代理的结果写入该 SQLite 数据库")
+    coordinator.add_argument('--summary-interval', type=float, default=10, help="汇总信息的输出间隔（秒）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'agent':
+        try:
+            agent = FlashAgent(args.listen, args.host, BundleStore(args.cache_dir), args.name, args.token,
+                               args.simulate, args.verbose, args.max_bundle_size * 1024 * 1024)
+        except FleetError as e:
+            sys.stderr.write(f"错误: {e}\n")
+            return 2
+        agent.serve_forever()
+        return 0
+    from firmware_bundle import BundleError
+    try:
+        hub_limit = parse_hub_limit(args.hub_limit)
+    except ValueError as e:
+        sys.stderr.write(f"错误: --hub-limit 无效: {e}\n")
+        return 2
+    options = {
+        'baud': args.baud,
+        'diff': args.diff,
+        'verify': args.verify,
+        'verify_samples': args.verify_samples,
+        'adaptive_baud': args.adaptive_baud,
+        'sparse': args.sparse,
+        'chip_erase': args.chip_erase,
+        'resume_retries': args.resume_retries,
+    }
+    results = None
+    try:
+        if args.results_db:
+            from results_store import ResultsStore
+            results = ResultsStore(args.results_db)
+        coordinator = FleetCoordinator(args.agent, args.bundle, options, args.port, args.auto, args.rounds,
+                                       args.workers, args.retries, args.token,
+                                       summary_interval=args.summary_interval, results=results,
+                                       hub_limit=hub_limit)
+        return 0 if coordinator.run() else 1
+    except (OSError, BundleError, sqlite3.Error) as e:
+        sys.stderr.write(f"错误: {e}\n")
+        return 2
+    finally:
+        if results is not None:
+            results.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+"""无界面烧录入口
+
+与图形界面共用同一套烧录引擎和任务调度器，不加载 tkinter，适合产线工控机和 MES 调用。
+每块板子烧录结束后向标准输出打印一行 JSON 结果，过程日志写到标准错误。
+
+示例:
+    python flasher_cli.py --port COM3 --port COM4 --firmware 0x0 app.bin
+    python flasher_cli.py --config config.json --auto
+    python flasher_cli.py --bundle app.espbundle --auto
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from config_store import CONFIG_FILE, ConfigStore
+from flash_engine import CHIP_ERASE_MODES, RESUME_RETRIES, VERIFY_MODES, VERIFY_SAMPLES, FlashEngine
+from hub_throttle import HubThrottle, parse_hub_limit
+from job_scheduler import FINISHED_STATES, FlashScheduler
+from port_monitor import HotplugMonitor
+
+# 与 flash_encryption.ENCRYPTION_MODES 一致；可选功能的模块只在启用时加载，减少启动时间
+ENCRYPTION_MODES = ('batch', 'device')
+
+
+def firmwares_from_config(config):
+    """从配置（当前方案）的固件表中取出已启用的 (路径, 地址) 列表"""
+    firmwares = []
+    paths = config.get('firmware_paths', [])
+    addresses = config.get('firmware_addresses', [])
+    enables = config.get('firmware_enables', [])
+    for i, path in enumerate(paths):
+        if i < len(enables) and enables[i] and path:
+            address = addresses[i] if i < len(addresses) else '0x0'
+            firmwares.append((path, address or '0x0'))
+    return firmwares
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ESP32 无界面批量烧录")
+    parser.add_argument('--config', default=None, help="读取固件表和并发数的配置文件 (默认 config.json)")
+    parser.add_argument('--profile', default=None, help="使用配置文件中的该产品方案 (默认为图形界面当前选中的方案)")
+    parser.add_argument('--port', action='append', default=[], help="要烧录的串口，可重复指定")
+    parser.add_argument('--firmware', nargs=2, action='append', default=[], metavar=('ADDRESS', 'FILE'),
+                        help="固件地址和路径，可重复指定；指定后忽略配置文件中的固件表")
+    parser.add_argument('--bundle', default=None,
+                        help="固件包（由 firmware_bundle.py 生成），指定后忽略 --firmware 和配置文件中的固件表")
+    parser.add_argument('--nvs-template', default=None,
+                        help="按该 CSV 模板为每块板子生成 NVS 分区（序列号、MAC、校准数据），与共用固件在同一会话写入")
+    parser.add_argument('--nvs-address', default=None, help="NVS 分区地址 (默认 0x9000)")
+    parser.add_argument('--nvs-size', default=None, help="NVS 分区大小 (默认 0x6000)")
+    parser.add_argument('--serial-format', default=None, help="序列号格式，如 SN{:08d}")
+    parser.add_argument('--serial-file', default=None, help="按 MAC 记录已分配序列号的文件 (默认 serials.json)")
+    parser.add_argument('--encrypt', default=None, choices=ENCRYPTION_MODES,
+                        help="主机端预加密后写入并在同一会话烧写 flash 加密 eFuse（不可撤销）：batch 整批共用密钥，device 每板独立密钥")
+    parser.add_argument('--encryption-key', default=None, help="batch 模式的密钥文件，先用 flash_encryption.py genkey 生成")
+    parser.add_argument('--key-dir', default=None, help="device 模式按 MAC 保存密钥的目录 (默认 flash_keys)")
+    parser.add_argument('--baud', type=int, default=None, help="烧录波特率 (默认取方案中的 baud，没有时 2000000)")
+    parser.add_argument('--workers', type=int, default=None, help="最大并发任务数")
+    parser.add_argument('--retries', type=int, default=0, help="失败后自动重试次数")
+    parser.add_argument('--adaptive-baud', action='store_true', default=None,
+                        help="自适应波特率：--baud 作为上限，出错时逐级降速，并按 USB 序列号或 Hub 位置记住稳定速率")
+    parser.add_argument('--diff', action='store_true', default=None, help="差分烧录，只写入内容变化的区域")
+    parser.add_argument('--sparse', action='store_true', default=None,
+                        help="稀疏写入：只传输含数据的扇区，0xFF 空白扇区只擦除不写入")
+    parser.add_argument('--chip-erase', default=None, choices=CHIP_ERASE_MODES,
+                        help="写入前整片擦除（清除 flash 上全部数据）：auto 在稀疏写入可跳过的空白足够多时擦除，on 总是擦除")
+    parser.add_argument('--resume-retries', type=int, default=None,
+                        help="写入中链路出错（同步失败、短暂断开）后重新连接并从已确认的位置续写的次数，0 表示不恢复")
+    parser.add_argument('--verify', default=None, choices=VERIFY_MODES,
+                        help="写入后的校验方式：off 不校验，md5 片上 MD5（默认），sample 另外随机回读若干扇区")
+    parser.add_argument('--verify-samples', type=int, default=None, help="sample 模式下每个固件回读的扇区数")
+    parser.add_argument('--no-verify', action='store_true', help="跳过写入后的校验，等同 --verify off")
+    parser.add_argument('--hub-limit', default=None,
+                        help="按 USB Hub 限制并发：off 不限制，auto 按实测吞吐自动调整，数字为每个 Hub 的固定上限"
+                             "（默认取 config.json 中的 hub_limit）")
+    parser.add_argument('--auto', action='store_true', help="持续监控串口，插入设备后自动烧录")
+    parser.add_argument('--metrics-file', default=None,
+                        help="把每次烧录的阶段耗时追加到该文件（.csv 为 CSV，其他为 JSONL）")
+    parser.add_argument('--results-db', default=None,
+                        help="把每次烧录的结果和压缩日志写入该 SQLite 数据库，可用 results_store.py 查询良率")
+    parser.add_argument('--metrics-port', type=int, default=None, help="在该端口提供 Prometheus 指标接口 /metrics")
+    parser.add_argument('--verbose', '-v', action='store_true', help="把烧录过程日志输出到标准错误")
+    return parser.parse_args(argv)
+
+
+def load_config(path, profile=None):
+    """全局设置与方案合并后的配置；未指定 path 且默认文件不存在时返回默认方案"""
+    if path is not None and not os.path.exists(path):
+        raise OSError(f"配置文件不存在: {path}")
+    store = ConfigStore(path or CONFIG_FILE).load()
+    if profile is not None and profile not in store.profile_names():
+        raise ValueError(f"方案不存在: {profile}，可选: {', '.join(store.profile_names())}")
+    return store.settings(profile)
+
+
+class HeadlessStation:
+    """无界面的烧录站：提交任务并以 JSON 行输出结果"""
+    def __init__(self, firmwares, options, max_workers=8, retries=0, verbose=False, out=None, metrics=None,
+                 results=None, hub_limit=None):
+        self.firmwares = firmwares
+        self.options = options
+        self.verbose = verbose
+        self.out = out or sys.stdout
+        self._out_lock = threading.Lock()
+        self.failures = 0
+        self.metrics = metrics
+        self.results = results
+        self.hub_throttle = None
+        self.firmware_watch = None
+        if hub_limit is not None:
+            self.hub_throttle = HubThrottle(hub_limit, max_per_hub=max_workers, on_change=self.on_hub_limit_change)
+        self.scheduler = FlashScheduler(
+            self.run_job, max_workers=max_workers, max_retries=retries, on_change=self.on_job_change,
+            throttle=self.hub_throttle
+        )
+        self.engine = FlashEngine(**options)
+
+    def run_job(self, job):
+        result = self.engine.flash(job.port, job.firmwares, log=self.make_log(job.port), cancel=job.cancel_event)
+        if self.metrics is not None:
+            self.metrics.record(result, job_id=job.id, attempt=job.attempts)
+        if self.results is not None:
+            self.results.record(result, job_id=job.id, attempt=job.attempts)
+        return result
+
+    def make_log(self, port):
+        if not self.verbose:
+            return None
+        def log(message):
+            sys.stderr.write(f"[{port}] {message}\n")
+        return log
+
+    def on_hub_limit_change(self, hub, old, new):
+        if self.verbose:
+            stats = self.hub_throttle.stats().get(hub, {})
+            sys.stderr.write(f"Hub {hub} 并发上限 {old} -> {new}（{stats.get('boards_per_hour', 0):.0f} 块/小时）\n")
+
+    def on_job_change(self, job):
+        if job.state not in FINISHED_STATES:
+            return
+        record = job.result.to_dict() if job.result is not None else {'port': job.port, 'success': False}
+        record['job_id'] = job.id
+        record['state'] = job.state
+        record['attempts'] = job.attempts
+        if job.state != 'success':
+            record.setdefault('error', job.error)
+        with self._out_lock:
+            if job.state != 'success':
+                self.failures += 1
+            self.emit(record, job)
+
+    def emit(self, record, job):
+        """输出一条任务结果（调用方持有输出锁）"""
+        self.out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.out.flush()
+
+    def on_firmware_reload(self, changes):
+        for path, old, new in changes:
+            if old is not None:
+                sys.stderr.write(f"固件已更新: {path} ({old.sha256[:12]} -> {new.sha256[:12]})\n")
+
+    def submit(self, port):
+        if self.scheduler.active_job(port) is None:
+            firmwares = self.firmwares
+            if self.firmware_watch is not None:
+                firmwares = self.firmware_watch.resolve(firmwares)
+            return self.scheduler.submit(port, firmwares, self.options)
+        return None
+
+    def run_once(self, ports):
+        """烧录指定端口一次，全部结束后返回"""
+        jobs = [self.submit(port) for port in ports]
+        while not all(job is None or job.state in FINISHED_STATES for job in jobs):
+            time.sleep(0.1)
+        return self.failures == 0
+
+    def run_forever(self, ports=None, stop=None):
+        """持续监控热插拔事件，新设备插入即提交任务，直到 Ctrl+C 或 stop 置位"""
+        wanted = set(ports or [])
+        def on_event(event):
+            if event.action == 'remove' and self.hub_throttle is not None:
+                self.hub_throttle.forget(event.device)
+            if event.action == 'add' and (not wanted or event.device in wanted):
+                if self.verbose:
+                    sys.stderr.write(f"检测到新设备: {event.device}\n")
+                self.submit(event.device)
+        monitor = HotplugMonitor(on_event)
+        if self.hub_throttle is not None:
+            # 直接使用热插拔监控记录的 USB 位置，不必每次枚举串口
+            self.hub_throttle.identify = monitor.port_info
+        paths = [path for path, _ in self.firmwares if isinstance(path, str)]
+        if paths:
+            # 长时间运行时固件可能被重新编译，写入稳定后新插入的板子使用新固件
+            from firmware_watch import FirmwareWatcher
+            self.firmware_watch = FirmwareWatcher(
+                on_reload=self.on_firmware_reload,
+                on_error=lambda path, e: sys.stderr.write(f"重新加载固件 {path} 失败: {e}\n")
+            )
+            self.firmware_watch.watch(paths)
+            self.firmware_watch.start()
+        monitor.start()
+        stop = stop or threading.Event()
+        try:
+            # 分段等待，Windows 上 Ctrl+C 才能及时生效
+            while not stop.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            monitor.stop()
+            if self.firmware_watch is not None:
+                self.firmware_watch.stop()
+            self.scheduler.shutdown()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        config = load_config(args.config, args.profile)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"加载配置失败: {e}\n")
+        return 2
+    try:
+        hub_limit = parse_hub_limit(args.hub_limit if args.hub_limit is not None else config.get('hub_limit', 'off'))
+    except ValueError as e:
+        sys.stderr.write(f"错误: --hub-limit 无效: {e}\n")
+        return 2
+    if not args.port and not args.auto:
+        sys.stderr.write("错误: 请用 --port 指定串口，或使用 --auto 自动烧录\n")
+        return 2
+    # 没有在命令行指定的烧录选项取方案中的值，方案中也没有时用默认值
+    def option(name, default):
+        value = getattr(args, name)
+        return value if value is not None else config.get(name, default)
+
+    try:
+        options = {
+            'baud': int(option('baud', 2000000)),
+            'diff': bool(option('diff', False)),
+            'verify': 'off' if args.no_verify else option('verify', 'md5'),
+            'verify_samples': int(option('verify_samples', VERIFY_SAMPLES)),
+            'adaptive_baud': bool(option('adaptive_baud', False)),
+            'sparse': bool(option('sparse', False)),
+            'chip_erase': option('chip_erase', 'off'),
+            'resume_retries': int(option('resume_retries', RESUME_RETRIES))
+        }
+    except (TypeError, ValueError) as e:
+        sys.stderr.write(f"错误: 方案中的烧录选项无效: {e}\n")
+        return 2
+    if options['verify'] not in VERIFY_MODES:
+        sys.stderr.write(f"错误: 无效的校验方式: {options['verify']}\n")
+        return 2
+    if args.bundle:
+        from firmware_bundle import BundleError, FirmwareBundle
+        try:
+            bundle = FirmwareBundle(args.bundle)
+        except (OSError, BundleError) as e:
+            sys.stderr.write(f"加载固件包失败: {e}\n")
+            return 2
+        firmwares = bundle.firmwares()
+        options.update(bundle.engine_options())
+        if args.verbose:
+            sys.stderr.write(bundle.describe() + '\n')
+    else:
+        if args.firmware:
+            firmwares = [(path, address) for address, path in args.firmware]
+        else:
+            firmwares = firmwares_from_config(config)
+        missing = [path for path, _ in firmwares if not os.path.exists(path)]
+        if not firmwares or missing:
+            sys.stderr.write("错误: 请选择至少一个固件\n" if not firmwares else f"错误: 固件不存在: {missing}\n")
+            return 2
+
+    # 命令行参数优先于 config.json 中的 device_data 项
+    device_config = dict(config.get('device_data') or {})
+    for key in ('nvs_template', 'nvs_address', 'nvs_size', 'serial_format', 'serial_file'):
+        if getattr(args, key) is not None:
+            device_config[key] = getattr(args, key)
+    options['device_data'] = None
+    if device_config.get('nvs_template'):
+        from device_data import stage_from_config
+        try:
+            options['device_data'] = stage_from_config(device_config)
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f"加载 NVS 模板失败: {e}\n")
+            return 2
+    encryption_config = dict(config.get('encryption') or {})
+    for key, value in (('mode', args.encrypt), ('key_file', args.encryption_key), ('key_dir', args.key_dir)):
+        if value is not None:
+            encryption_config[key] = value
+    options['encryption'] = None
+    if encryption_config.get('mode') not in (None, '', 'off'):
+        from flash_encryption import stage_from_config
+        try:
+            options['encryption'] = stage_from_config(encryption_config, options.get('target_chip'))
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f"启用 flash 加密失败: {e}\n")
+            return 2
+    if options['encryption'] is not None and options['verify'] == 'off':
+        sys.stderr.write("错误: flash 加密需要写入后校验，不能与 --verify off / --no-verify 同时使用\n")
+        return 2
+    if options['encryption'] is not None and args.verbose:
+        sys.stderr.write(f"主机端预加密: {options['encryption'].describe()}\n")
+
+    metrics = None
+    if args.metrics_file or args.metrics_port is not None:
+        from metrics import MetricsRecorder, MetricsServer
+        metrics = MetricsRecorder(args.metrics_file)
+    if args.metrics_port is not None:
+        try:
+            MetricsServer(metrics, args.metrics_port).start()
+        except OSError as e:
+            sys.stderr.write(f"启动指标接口失败: {e}\n")
+            return 2
+    results = None
+    if args.results_db:
+        import sqlite3
+
+        from results_store import ResultsStore
+        try:
+            results = ResultsStore(args.results_db)
+        except (OSError, sqlite3.Error) as e:
+            sys.stderr.write(f"打开结果数据库失败: {e}\n")
+            return 2
+    station = HeadlessStation(
+        firmwares,
+        options,
+        max_workers=args.workers or config.get('max_workers', 8),
+        retries=args.retries,
+        verbose=args.verbose,
+        metrics=metrics,
+        results=results,
+        hub_limit=hub_limit
+    )
+    try:
+        if args.auto:
+            station.run_forever(args.port)
+            return 0
+        return 0 if station.run_once(args.port) else 1
+    finally:
+        if results is not None:
+            results.close()
+
+
+if __name__ == '__main__':
+    # 预加密的进程池在打包后的程序中也能启动
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""按 USB Hub 限制并发
+
+同一个 USB 2.0 Hub 下的端口共享上行带宽（全速设备还共享 Hub 的事务转换器），
+8 块板同时以 2 Mbaud 烧录时总吞吐量反而下降，还容易出现同步失败。
+这里按 pyserial ListPortInfo.location 中的 USB 路径把端口归到所在的 Hub，
+统计每个 Hub 的合计写入速度和每小时板数，并限制同一 Hub 上同时运行的任务数：
+
+    - 固定模式：每个 Hub 最多 limit 个任务
+    - 自适应模式：从上限开始，在当前并发数及其相邻的并发数上各取若干次结果，
+      换算成该 Hub 的每小时成功板数（n * 3600 / 单板用时，失败记 0），取最高的一档；
+      每隔 reprobe 个任务重新测量相邻档位，适应板子和线缆的变化
+
+没有位置信息的端口（如虚拟串口）不限制。
+"""
+import threading
+import time
+from collections import deque
+
+from port_monitor import find_port
+
+def hub_of(location):
+    """由 USB 位置（如 "1-1.2:1.0"）得到上一级 Hub 的路径（"1-1"）；直接接在根 Hub 上时返回总线号"""
+    if not location:
+        return None
+    path = location.split(':', 1)[0]
+    if '.' in path:
+        return path.rsplit('.', 1)[0]
+    bus, sep, _ = path.partition('-')
+    return bus if sep else None
+
+
+def parse_hub_limit(value):
+    """配置或命令行中的 Hub 并发设置：'off'、'auto' 或正整数"""
+    if value in (None, '', 'off', False):
+        return None
+    if value == 'auto':
+        return 'auto'
+    limit = int(value)
+    if limit < 1:
+        raise ValueError(f"Hub 并发数必须为正整数: {value}")
+    return limit
+
+
+class HubState:
+    """一个 Hub 的并发上限和测量结果"""
+    def __init__(self, limit, samples):
+        self.limit = limit
+        self.samples = samples
+        self.scores = {}            # 并发数 -> 最近若干次的每小时板数折算值
+        self.completed = deque()    # (结束时间, 开始时间, 写入字节数, 是否成功)
+        self.since_probe = 0
+        self.running = 0
+        self.area = 0.0             # 运行任务数对时间的积分，用于求任务期间的平均并发数
+        self.last = time.monotonic()
+
+    def advance(self, now):
+        self.area += self.running * (now - self.last)
+        self.last = now
+
+    def score(self, n):
+        """并发数 n 下的平均得分；样本不足时返回 None"""
+        values = self.scores.get(n)
+        if not values or len(values) < self.samples:
+            return None
+        return sum(values) / len(values)
+
+
+class HubThrottle:
+    """各 Hub 的并发上限，供 FlashScheduler 使用
+
+    mode 为 'auto'、固定的正整数或 None（只统计不限制）；identify(port) 返回 PortInfo（或 None），默认枚举串口查找。
+    max_per_hub 为自适应模式的起始值和上限，固定上限按设置的值生效（超过总并发数时实际不起限制作用）。
+    on_change(hub, old, new) 在自适应调整上限时调用。
+    """
+    def __init__(self, mode='auto', identify=None, max_per_hub=8, samples=3, reprobe=40, window=600,
+                 on_change=None):
+        self.mode = mode
+        self.identify = identify or find_port
+        self.max_per_hub = max(1, int(max_per_hub))
+        self.samples = samples
+        self.reprobe = reprobe
+        self.window = window
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._hubs = {}
+        self._ports = {}
+
+    @property
+    def adaptive(self):
+        return self.mode == 'auto'
+
+    def set_mode(self, mode):
+        """切换限制方式，各 Hub 的上限和测量结果重新开始，运行中的任务不受影响"""
+        with self._lock:
+            self.mode = mode
+            for state in self._hubs.values():
+                state.limit = self._initial_limit()
+                state.scores.clear()
+                state.since_probe = 0
+
+    def hub(self, port):
+        """端口所在的 Hub，没有位置信息时返回 None；结果按端口缓存"""
+        with self._lock:
+            if port in self._ports:
+                return self._ports[port]
+        try:
+            info = self.identify(port)
+        except Exception:
+            info = None
+        hub = hub_of(info.location) if info is not None else None
+        with self._lock:
+            self._ports[port] = hub
+        return hub
+
+    def forget(self, port):
+        """端口拔出后清除缓存，重新插到其他 Hub 时重新识别"""
+        with self._lock:
+            self._ports.pop(port, None)
+
+    def allows(self, hub):
+        """该 Hub 上能否再启动一个任务"""
+        if hub is None or self.mode is None:
+            return True
+        with self._lock:
+            state = self._state(hub)
+            return state.running < state.limit
+
+    def acquire(self, hub):
+        """任务开始，返回交给 release() 的标记"""
+        if hub is None:
+            return None
+        with self._lock:
+            state = self._state(hub)
+            state.advance(time.monotonic())
+            state.running += 1
+            return (state.area, state.last)
+
+    def release(self, hub, token, result):
+        """任务结束：按任务期间该 Hub 上的平均并发数记录得分，必要时调整上限；result 为 None 时只释放不记录"""
+        if hub is None or token is None:
+            return
+        success = bool(getattr(result, 'success', False))
+        written = getattr(result, 'bytes_written', 0) if success else 0
+        change = None
+        with self._lock:
+            state = self._state(hub)
+            now = time.monotonic()
+            state.advance(now)
+            state.running -= 1
+            if result is None:
+                return
+            duration = now - token[1]
+            state.completed.append((now, token[1], written, success))
+            while state.completed and now - state.completed[0][0] > self.window:
+                state.completed.popleft()
+            if not self.adaptive or duration <= 0:
+                return
+            concurrency = max(1, int(round((state.area - token[0]) / duration)))
+            score = concurrency * 3600.0 / duration if success else 0.0
+            state.scores.setdefault(concurrency, deque(maxlen=self.samples * 2)).append(score)
+            state.since_probe += 1
+            old = state.limit
+            new = self._decide(state)
+            if new != old:
+                state.limit = new
+                change = (hub, old, new)
+        if change is not None and self.on_change is not None:
+            try:
+                self.on_change(*change)
+            except Exception:
+                pass
+
+    def _decide(self, state):
+        """在当前上限和相邻两档中选得分最高的；当前档最好而相邻档还没有测量时去试相邻档（调用方持有锁）"""
+        limit = state.limit
+        if state.score(limit) is None:
+            return limit
+        if state.since_probe >= self.reprobe:
+            # 条件可能已变化，丢弃相邻档位的旧测量
+            state.since_probe = 0
+            for n in (limit - 1, limit + 1):
+                state.scores.pop(n, None)
+        candidates = [n for n in (limit - 1, limit + 1) if 1 <= n <= self.max_per_hub]
+        measured = [n for n in candidates if state.score(n) is not None]
+        best = max([limit] + measured, key=lambda n: (state.score(n), -abs(n - limit)))
+        if best != limit:
+            return best
+        for n in candidates:
+            if n not in measured:
+                # 先往下试：吞吐下降和同步失败更可能出现在高并发一侧
+                return n
+        return limit
+
+    def _initial_limit(self):
+        if self.mode is None or self.adaptive:
+            return self.max_per_hub
+        # 用户明确设置的固定上限原样生效，不按 max_per_hub 截断
+        return int(self.mode)
+
+    def _state(self, hub):
+        """（调用方持有锁）"""
+        state = self._hubs.get(hub)
+        if state is None:
+            state = self._hubs[hub] = HubState(self._initial_limit(), self.samples)
+        return state
+
+    def stats(self, now=None):
+        """各 Hub 的上限、运行数、最近 window 秒的合计写入速度（KB/s）和每小时成功板数"""
+        now = now or time.monotonic()
+        result = {}
+        with self._lock:
+            for hub, state in self._hubs.items():
+                completed = [item for item in state.completed if now - item[0] <= self.window]
+                span = max(now - min(item[1] for item in completed), 60.0) if completed else 60.0
+                successes = sum(1 for item in completed if item[3])
+                result[hub] = {
+                    'limit': state.limit if self.mode is not None else None,
+                    'running': state.running,
+                    'kbps': sum(item[2] for item in completed) / 1024.0 / span,
+                    'boards_per_hour': successes * 3600.0 / span,
+                    'scores': {n: round(state.score(n), 1) for n in sorted(state.scores)
+                               if state.score(n) is not None},
+                }
+        return result
@@ -0,0 +1,255 @@
+"""烧录任务调度器
+
+所有烧录任务进入同一个先进先出队列，由固定数量的工作线程执行。
+同一串口同一时间只允许一个任务排队或运行，手动点击与自动烧录不会冲突。
+指定 throttle（hub_throttle.HubThrottle）时还按 USB Hub 限制并发，
+所在 Hub 已满的任务留在队列中，先执行其他 Hub 上的任务。
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCESS = 'success'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED_STATES = (SUCCESS, FAILED, CANCELLED)
+
+_job_ids = itertools.count(1)
+
+
+class FlashJob:
+    """一个端口的一次烧录任务"""
+    def __init__(self, port, firmwares, options=None):
+        self.id = next(_job_ids)
+        self.port = port
+        self.hub = None
+        self.hub_token = None
+        self.firmwares = list(firmwares)
+        self.options = dict(options or {})
+        self.state = QUEUED
+        self.attempts = 0
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def finished_ok(self):
+        return self.state == SUCCESS
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'port': self.port,
+            'hub': self.hub,
+            'state': self.state,
+            'attempts': self.attempts,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+    def __repr__(self):
+        return f"FlashJob({self.id}, {self.port!r}, {self.state})"
+
+
+class FlashScheduler:
+    """有界并发的烧录任务调度器
+
+    runner(job) 在工作线程中执行任务并返回结果对象（需有 success 属性），
+    on_change(job) 在任务状态变化时被调用（工作线程或调用方线程）。
+    throttle 为 None 时不按 Hub 限制并发。
+    """
+    def __init__(self, runner, max_workers=8, max_retries=0, on_change=None, history=1000, throttle=None):
+        self.runner = runner
+        self.throttle = throttle
+        self.max_workers = max(1, int(max_workers))
+        self.max_retries = max_retries
+        self.on_change = on_change
+        self.history = history
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._running = {}          # 端口 -> 正在运行的任务
+        self._jobs = OrderedDict()  # 任务 ID -> 任务
+        self._workers = []
+        self._stopped = False
+
+    def submit(self, port, firmwares, options=None):
+        """提交任务；该端口已有排队或运行中的任务时直接返回那个任务"""
+        # 识别 Hub 可能要枚举串口，不在锁内进行
+        hub = self.throttle.hub(port) if self.throttle is not None else None
+        with self._cond:
+            existing = self.active_job(port)
+            if existing is not None:
+                return existing
+            job = FlashJob(port, firmwares, options)
+            job.hub = hub
+            self._jobs[job.id] = job
+            self._queue.append(job)
+            self._trim_history()
+            self._ensure_workers()
+            self._cond.notify()
+        self._notify(job)
+        return job
+
+    def cancel(self, job_id):
+        """取消任务：排队中的任务直接移除，运行中的任务在下一个检查点停止"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.state in FINISHED_STATES:
+                return False
+            job.cancel_event.set()
+            if job.state == QUEUED:
+                self._queue.remove(job)
+                job.state = CANCELLED
+                job.finished = time.time()
+            else:
+                return True
+        self._notify(job)
+        return True
+
+    def retry(self, job_id):
+        """把失败或已取消的任务重新放回队列末尾"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.state not in (FAILED, CANCELLED):
+                return None
+            if self.active_job(job.port) is not None:
+                return None
+            job.state = QUEUED
+            job.error = None
+            job.cancel_event.clear()
+            self._queue.append(job)
+            self._ensure_workers()
+            self._cond.notify()
+        self._notify(job)
+        return job
+
+    def set_max_workers(self, max_workers):
+        """调整并发上限，立即生效"""
+        with self._cond:
+            self.max_workers = max(1, int(max_workers))
+            self._ensure_workers()
+            self._cond.notify_all()
+
+    def wake(self):
+        """Hub 上限等外部条件变化后，让等待中的工作线程重新挑选任务"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def shutdown(self):
+        with self._cond:
+            self._stopped = True
+            for job in self._queue:
+                job.state = CANCELLED
+            self._queue.clear()
+            self._cond.notify_all()
+
+    def job(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._cond:
+            return list(self._jobs.values())
+
+    def active_job(self, port):
+        """该端口排队中或运行中的任务"""
+        with self._cond:
+            job = self._running.get(port)
+            if job is not None:
+                return job
+            for job in self._queue:
+                if job.port == port:
+                    return job
+            return None
+
+    def counts(self):
+        """各状态的任务数量"""
+        with self._cond:
+            counts = {state: 0 for state in (QUEUED, RUNNING, SUCCESS, FAILED, CANCELLED)}
+            for job in self._jobs.values():
+                counts[job.state] += 1
+            return counts
+
+    def _ensure_workers(self):
+        """按并发上限补足工作线程（调用方持有锁）"""
+        self._workers = [t for t in self._workers if t.is_alive()]
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._worker, daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _trim_history(self):
+        """只保留最近的已结束任务（调用方持有锁）"""
+        excess = len(self._jobs) - self.history
+        if excess <= 0:
+            return
+        for job_id in [i for i, j in self._jobs.items() if j.state in FINISHED_STATES][:excess]:
+            del self._jobs[job_id]
+
+    def _take(self):
+        """取出队列中第一个端口空闲（且所在 Hub 未满）的任务，没有时阻塞等待"""
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                if len(self._running) < self.max_workers:
+                    for job in self._queue:
+                        if job.port not in self._running and (self.throttle is None or self.throttle.allows(job.hub)):
+                            if self.throttle is not None:
+                                job.hub_token = self.throttle.acquire(job.hub)
+                            self._queue.remove(job)
+                            self._running[job.port] = job
+                            job.state = RUNNING
+                            job.attempts += 1
+                            job.started = time.time()
+                            return job
+                self._cond.wait()
+
+    def _worker(self):
+        while True:
+            job = self._take()
+            if job is None:
+                return
+            self._notify(job)
+            try:
+                job.result = self.runner(job)
+                success = bool(getattr(job.result, 'success', job.result))
+                if not success:
+                    job.error = getattr(job.result, 'error', None) or '烧录失败'
+            except Exception as e:
+                success = False
+                job.error = str(e)
+            if self.throttle is not None:
+                # 取消的任务不计入 Hub 的吞吐量统计
+                self.throttle.release(job.hub, job.hub_token, None if job.cancel_event.is_set() else job.result)
+            with self._cond:
+                del self._running[job.port]
+                job.finished = time.time()
+                if success:
+                    job.state = SUCCESS
+                elif job.cancel_event.is_set():
+                    job.state = CANCELLED
+                elif job.attempts <= self.max_retries and not self._stopped:
+                    # 自动重试：放回队列末尾，让其他端口先执行
+                    job.state = QUEUED
+                    self._queue.append(job)
+                else:
+                    job.state = FAILED
+                self._cond.notify_all()
+            self._notify(job)
+
+    def _notify(self, job):
+        if self.on_change is not None:
+            try:
+                self.on_change(job)
+            except Exception:
+                pass
@@ -0,0 +1,143 @@
+"""批量日志管道
+
+工作线程只把日志行放进无锁队列（queue.SimpleQueue），不直接触碰 Tk 控件；
+Tk 线程按固定间隔批量取出，一次性插入文本框，文本框和内存中只保留最近的若干行，
+完整日志由后台线程追加写入磁盘。
+"""
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+
+LOG_DIR = 'logs'
+
+
+def _safe_name(name):
+    """把端口名（如 /dev/ttyUSB0、COM3）转换成可用作文件名的字符串"""
+    return re.sub(r'[^0-9A-Za-z_.-]+', '_', name).strip('_') or 'log'
+
+
+class LogSpooler:
+    """后台线程，把日志批次追加写入文件"""
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, path, lines):
+        self._queue.put((path, lines))
+
+    def _run(self):
+        files = {}
+        while True:
+            path, lines = self._queue.get()
+            try:
+                f = files.get(path)
+                if f is None:
+                    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                    f = files[path] = open(path, 'a', encoding='utf-8')
+                f.write('\n'.join(lines) + '\n')
+                # 队列已空时再刷新，连续的批次合并成一次磁盘写入
+                if self._queue.empty():
+                    for handle in files.values():
+                        handle.flush()
+                if len(files) > 64:
+                    for handle in files.values():
+                        handle.close()
+                    files.clear()
+            except OSError:
+                pass
+
+
+class LogChannel:
+    """一个日志来源（主窗口或某个端口），log() 可在任意线程调用"""
+    def __init__(self, name, max_lines=2000, spool_path=None):
+        self.name = name
+        self.max_lines = max_lines
+        self.spool_path = spool_path
+        self.lines = deque(maxlen=max_lines)
+        self.widget = None
+        self._queue = queue.SimpleQueue()
+
+    def log(self, message):
+        self._queue.put(time.strftime('%H:%M:%S ') + message)
+
+    def drain(self, limit=1000):
+        """取出最多 limit 行待显示的日志"""
+        batch = []
+        try:
+            while len(batch) < limit:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        if batch:
+            self.lines.extend(batch)
+        return batch
+
+
+class LogPump:
+    """在 Tk 线程中定时把各通道的日志批量刷新到对应的文本框"""
+    def __init__(self, root, interval=100, log_dir=LOG_DIR, max_lines=2000):
+        self.root = root
+        self.interval = interval
+        self.log_dir = log_dir
+        self.max_lines = max_lines
+        self.spooler = LogSpooler()
+        self._channels = {}
+        self._lock = threading.Lock()
+        self.root.after(self.interval, self._tick)
+
+    def open_channel(self, name, widget=None):
+        """创建（或取回）通道；widget 可稍后在 Tk 线程中通过 attach 绑定"""
+        with self._lock:
+            channel = self._channels.get(name)
+            if channel is None:
+                spool_path = os.path.join(
+                    self.log_dir, time.strftime('%Y%m%d'), _safe_name(name) + '.log'
+                )
+                channel = LogChannel(name, self.max_lines, spool_path)
+                self._channels[name] = channel
+            if widget is not None:
+                channel.widget = widget
+            return channel
+
+    def attach(self, channel, widget):
+        """绑定文本框，并补上绑定之前已保留的日志"""
+        channel.widget = widget
+        if channel.lines:
+            self._insert(widget, list(channel.lines))
+
+    def close_channel(self, name):
+        """关闭通道，剩余日志写入磁盘"""
+        with self._lock:
+            channel = self._channels.pop(name, None)
+        if channel is not None:
+            batch = channel.drain(limit=1 << 30)
+            if batch:
+                self.spooler.write(channel.spool_path, batch)
+            channel.widget = None
+
+    def _tick(self):
+        with self._lock:
+            channels = list(self._channels.values())
+        for channel in channels:
+            batch = channel.drain()
+            if not batch:
+                continue
+            self.spooler.write(channel.spool_path, batch)
+            if channel.widget is not None:
+                try:
+                    self._insert(channel.widget, batch)
+                except Exception:
+                    channel.widget = None
+        self.root.after(self.interval, self._tick)
+
+    def _insert(self, widget, batch):
+        """一次插入整批日志并裁剪到最大行数"""
+        widget.insert("end", '\n'.join(batch[-self.max_lines:]) + '\n')
+        excess = int(widget.index("end-1c").split('.')[0]) - 1 - self.max_lines
+        if excess > 0:
+            widget.delete("1.0", f"{excess + 1}.0")
+        widget.see("end")
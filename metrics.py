@@ -0,0 +1,259 @@
+"""烧录指标记录与导出
+
+每次烧录结束后把 FlashResult 记录下来：
+- 逐条追加到 JSONL 或 CSV 文件，便于按班次离线分析；
+- 累积为各阶段耗时、单板周期和写入速度的直方图（按端口和汇总两套），
+  通过 Prometheus 文本格式的 HTTP 接口（/metrics）提供给监控系统抓取。
+"""
+import csv
+import io
+import json
+import os
+import threading
+import time
+
+# 各阶段耗时直方图的桶上限（秒）
+PHASE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# 单板周期直方图的桶上限（秒）
+JOB_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 300)
+# 写入速度直方图的桶上限（KB/s）
+KBPS_BUCKETS = (25, 50, 100, 150, 200, 300, 400, 600, 800, 1200, 1600)
+
+PHASES = ('load', 'connect', 'stub', 'encrypt', 'erase', 'diff', 'write', 'verify', 'device_data', 'efuse', 'reset')
+
+CSV_FIELDS = (
+    ['timestamp', 'port', 'chip', 'mac', 'serial', 'success', 'error_phase', 'error', 'elapsed']
+    + list(PHASES)
+    + ['bytes_written', 'bytes_sent', 'write_kbps', 'baud', 'baud_steps', 'recoveries']
+)
+
+
+def default_metrics_path(log_dir='logs'):
+    """按日期命名的 JSONL 结果文件，如 logs/metrics/20240101.jsonl"""
+    return os.path.join(log_dir, 'metrics', time.strftime('%Y%m%d') + '.jsonl')
+
+
+class Histogram:
+    """Prometheus 风格的累积直方图"""
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        """[(桶上限, 累计数量)]，最后一项为 +Inf"""
+        total = 0
+        rows = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            rows.append((bound, total))
+        rows.append(('+Inf', self.count))
+        return rows
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsRecorder:
+    """记录每次烧录的指标，线程安全
+
+    path 为结果文件路径，扩展名为 .csv 时写 CSV，否则写 JSONL；为 None 时只保留内存中的直方图。
+    path 也可以是返回路径的函数，每条记录写入前调用，如按日期命名的文件在跨天后自动换到新文件。
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._jobs = {}        # (端口, 结果) -> 次数
+        self._bytes = {}       # 端口 -> [写入字节, 发送字节]
+        self._recoveries = {}  # 端口 -> 链路中断后的恢复次数
+        self._phases = {}      # (端口, 阶段) -> Histogram，端口为 None 表示汇总
+        self._cycles = {}      # 端口 -> Histogram
+        self._kbps = {}        # 端口 -> Histogram
+        self.started = time.time()
+
+    def record(self, result, **labels):
+        """记录一次烧录结果；labels 为额外写入结果文件的字段（如 job_id、attempt）"""
+        outcome = 'success' if result.success else (result.error_phase or 'error')
+        with self._lock:
+            key = (result.port, outcome)
+            self._jobs[key] = self._jobs.get(key, 0) + 1
+            counters = self._bytes.setdefault(result.port, [0, 0])
+            counters[0] += result.bytes_written
+            counters[1] += result.bytes_sent
+            if result.recoveries:
+                self._recoveries[result.port] = self._recoveries.get(result.port, 0) + len(result.recoveries)
+            for port in (result.port, None):
+                for phase, seconds in result.phases.items():
+                    self._histogram(self._phases, (port, phase), PHASE_BUCKETS).observe(seconds)
+                if result.success:
+                    self._histogram(self._cycles, port, JOB_BUCKETS).observe(result.elapsed)
+                    if result.write_kbps:
+                        self._histogram(self._kbps, port, KBPS_BUCKETS).observe(result.write_kbps)
+            path = self.path() if callable(self.path) else self.path
+            if path:
+                self._append(path, result, labels)
+
+    @staticmethod
+    def _histogram(table, key, buckets):
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram(buckets)
+        return histogram
+
+    def _append(self, path, result, labels):
+        """追加一行到结果文件（调用方持有锁）"""
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if path.lower().endswith('.csv'):
+                row = {
+                    'timestamp': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(result.started)),
+                    'port': result.port,
+                    'chip': result.chip,
+                    'mac': result.mac,
+                    'serial': result.serial,
+                    'success': int(result.success),
+                    'error_phase': result.error_phase,
+                    'error': result.error,
+                    'elapsed': round(result.elapsed, 4),
+                    'bytes_written': result.bytes_written,
+                    'bytes_sent': result.bytes_sent,
+                    'write_kbps': round(result.write_kbps, 1),
+                    'baud': result.baud,
+                    'baud_steps': result.baud_steps,
+                    'recoveries': len(result.recoveries),
+                }
+                for phase in PHASES:
+                    if phase in result.phases:
+                        row[phase] = round(result.phases[phase], 4)
+                new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+                with open(path, 'a', encoding='utf-8', newline='') as f:
+                    writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction='ignore')
+                    if new_file:
+                        writer.writeheader()
+                    writer.writerow(row)
+            else:
+                record = result.to_dict()
+                record.update(labels)
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        except OSError:
+            pass
+
+    def render(self):
+        """按 Prometheus 文本格式输出全部指标"""
+        out = io.StringIO()
+        with self._lock:
+            out.write("# HELP esp_flash_jobs_total 烧录次数，按端口和结果（success 或失败阶段）统计\n")
+            out.write("# TYPE esp_flash_jobs_total counter\n")
+            for (port, outcome), count in sorted(self._jobs.items()):
+                out.write(f"esp_flash_jobs_total{_format_labels([('port', port), ('result', outcome)])} {count}\n")
+
+            out.write("# HELP esp_flash_bytes_written_total 写入 flash 的字节数（解压后）\n")
+            out.write("# TYPE esp_flash_bytes_written_total counter\n")
+            for port, (written, _sent) in sorted(self._bytes.items()):
+                out.write(f"esp_flash_bytes_written_total{_format_labels([('port', port)])} {written}\n")
+            out.write("# HELP esp_flash_bytes_sent_total 经串口发送的压缩数据字节数\n")
+            out.write("# TYPE esp_flash_bytes_sent_total counter\n")
+            for port, (_written, sent) in sorted(self._bytes.items()):
+                out.write(f"esp_flash_bytes_sent_total{_format_labels([('port', port)])} {sent}\n")
+
+            out.write("# HELP esp_flash_recoveries_total 写入中链路出错后的恢复次数（含失败的尝试）\n")
+            out.write("# TYPE esp_flash_recoveries_total counter\n")
+            for port, count in sorted(self._recoveries.items()):
+                out.write(f"esp_flash_recoveries_total{_format_labels([('port', port)])} {count}\n")
+
+            self._render_histograms(out, 'esp_flash_phase_seconds', "各阶段耗时（所有端口汇总）",
+                                    {phase: h for (port, phase), h in self._phases.items() if port is None},
+                                    lambda phase: [('phase', phase)])
+            self._render_histograms(out, 'esp_flash_port_phase_seconds', "各端口各阶段耗时",
+                                    {key: h for key, h in self._phases.items() if key[0] is not None},
+                                    lambda key: [('port', key[0]), ('phase', key[1])])
+            self._render_histograms(out, 'esp_flash_job_seconds', "成功烧录的单板周期（所有端口汇总）",
+                                    {k: h for k, h in self._cycles.items() if k is None},
+                                    lambda key: [])
+            self._render_histograms(out, 'esp_flash_port_job_seconds', "各端口成功烧录的单板周期",
+                                    {k: h for k, h in self._cycles.items() if k is not None},
+                                    lambda port: [('port', port)])
+            self._render_histograms(out, 'esp_flash_write_kbps', "写入阶段有效速度 KB/s（所有端口汇总）",
+                                    {k: h for k, h in self._kbps.items() if k is None},
+                                    lambda key: [])
+            self._render_histograms(out, 'esp_flash_port_write_kbps', "各端口写入阶段有效速度 KB/s",
+                                    {k: h for k, h in self._kbps.items() if k is not None},
+                                    lambda port: [('port', port)])
+
+            out.write("# HELP esp_flash_start_time_seconds 指标开始累积的时间\n")
+            out.write("# TYPE esp_flash_start_time_seconds gauge\n")
+            out.write(f"esp_flash_start_time_seconds {self.started}\n")
+        return out.getvalue()
+
+    @staticmethod
+    def _render_histograms(out, name, help_text, histograms, labels_of):
+        out.write(f"# HELP {name} {help_text}\n")
+        out.write(f"# TYPE {name} histogram\n")
+        for key in sorted(histograms, key=str):
+            histogram = histograms[key]
+            labels = labels_of(key)
+            for bound, count in histogram.cumulative():
+                le = bound if bound == '+Inf' else _format_value(float(bound))
+                out.write(f"{name}_bucket{_format_labels(labels + [('le', le)])} {count}\n")
+            out.write(f"{name}_sum{_format_labels(labels)} {_format_value(float(histogram.sum))}\n")
+            out.write(f"{name}_count{_format_labels(labels)} {histogram.count}\n")
+
+
+class MetricsServer:
+    """在后台线程提供 Prometheus 抓取接口 http://host:port/metrics"""
+    def __init__(self, recorder, port=9108, host='0.0.0.0'):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = recorder.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.recorder = recorder
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
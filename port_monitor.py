@@ -0,0 +1,314 @@
+"""USB 串口热插拔监控
+
+Linux 上监听 uevent（netlink），设备插拔在毫秒级内通知；
+其他系统或 netlink 不可用时退回到定时枚举 comports() 的方式。
+事件源可以替换，测试时使用 FakeEventSource 手动注入事件，无需硬件。
+"""
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+
+NETLINK_KOBJECT_UEVENT = 15
+# netlink 多播组：1 为内核直接发出的事件，2 为 udevd 处理完（设置好权限、创建符号链接）后转发的事件
+UEVENT_GROUP_KERNEL = 1
+UEVENT_GROUP_UDEV = 2
+UDEV_CONTROL = '/run/udev/control'
+UDEV_PREFIX = b'libudev\0'
+# 没有 udevd 时，收到 add 后等设备节点可读写的最长时间（秒）
+DEVICE_READY_TIMEOUT = 2.0
+
+
+class PortInfo:
+    """串口及其 USB 身份信息"""
+    def __init__(self, device, serial_number=None, location=None, vid=None, pid=None, description=None):
+        self.device = device
+        self.serial_number = serial_number
+        self.location = location
+        self.vid = vid
+        self.pid = pid
+        self.description = description
+
+    @classmethod
+    def from_list_port_info(cls, info):
+        """由 pyserial 的 ListPortInfo 构造"""
+        return cls(info.device, info.serial_number, info.location, info.vid, info.pid, info.description)
+
+    def identity(self):
+        """稳定的身份键：优先 USB 序列号（带 VID:PID），其次 Hub 位置，最后是设备名"""
+        if self.serial_number:
+            return f"sn:{self.vid or 0:04x}:{self.pid or 0:04x}:{self.serial_number}"
+        if self.location:
+            return f"loc:{self.location}"
+        return f"port:{self.device}"
+
+    def to_dict(self):
+        return {
+            'device': self.device,
+            'serial_number': self.serial_number,
+            'location': self.location,
+            'vid': self.vid,
+            'pid': self.pid,
+            'description': self.description,
+        }
+
+    def __repr__(self):
+        return f"PortInfo({self.device!r}, serial={self.serial_number!r}, location={self.location!r})"
+
+
+class PortEvent:
+    """端口插入（add）或移除（remove）事件
+
+    initial 为 True 表示监控启动时枚举到的已连接端口，而不是之后新插入的设备。
+    """
+    def __init__(self, action, port, timestamp=None, initial=False):
+        self.action = action
+        self.port = port
+        self.timestamp = timestamp or time.time()
+        self.initial = initial
+
+    @property
+    def device(self):
+        return self.port.device
+
+    def __repr__(self):
+        return f"PortEvent({self.action!r}, {self.port!r})"
+
+
+def list_ports():
+    """枚举当前所有串口"""
+    import serial.tools.list_ports
+    return [PortInfo.from_list_port_info(p) for p in serial.tools.list_ports.comports()]
+
+
+def find_port(device):
+    """枚举当前串口，找到 device 对应的 PortInfo，找不到时返回 None"""
+    try:
+        for info in list_ports():
+            if info.device == device:
+                return info
+    except Exception:
+        pass
+    return None
+
+
+class PollingEventSource:
+    """定时枚举 comports() 并比较前后差异，适用于所有平台"""
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._rescan = threading.Event()
+
+    def run(self, emit, stop_event, known):
+        initial = True
+        while not stop_event.is_set():
+            try:
+                current = {p.device: p for p in list_ports()}
+                for device in list(known):
+                    if device not in current:
+                        emit(PortEvent('remove', known[device]))
+                for device, info in current.items():
+                    if device not in known:
+                        emit(PortEvent('add', info, initial=initial))
+                initial = False
+            except Exception:
+                pass
+            self._rescan.wait(self.interval)
+            self._rescan.clear()
+
+    def rescan(self):
+        self._rescan.set()
+
+
+class NetlinkEventSource:
+    """监听 Linux 的 uevent 广播，只关心 USB 串口的 add/remove
+
+    内核事件先于 udevd 设置设备节点权限发出，收到 add 立刻打开串口可能遇到权限不足。
+    udevd 在运行时订阅它处理完后转发的事件；没有 udevd（容器、精简系统）时订阅内核事件，
+    并在报告 add 前等待设备节点可读写。
+    """
+    def __init__(self, group=None):
+        if group is None:
+            group = UEVENT_GROUP_UDEV if os.path.exists(UDEV_CONTROL) else UEVENT_GROUP_KERNEL
+        self.group = group
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        self.sock.bind((0, group))
+        self.sock.settimeout(0.5)
+        self._rescan = threading.Event()
+
+    @staticmethod
+    def parse(data):
+        """解析一条 uevent 报文（内核格式或 libudev 格式），返回键值字典"""
+        if data.startswith(UDEV_PREFIX):
+            # libudev 报文头: 前缀、magic、头长度、属性偏移、属性长度……，属性为 \0 分隔的 KEY=VALUE
+            if len(data) < 24:
+                return {}
+            offset, length = struct.unpack_from('=II', data, 16)
+            fields = data[offset:offset + length].split(b'\0')
+        else:
+            # 内核格式第一段为 "add@/devices/..."
+            fields = data.split(b'\0')[1:]
+        env = {}
+        for field in fields:
+            key, sep, value = field.partition(b'=')
+            if sep:
+                env[key.decode(errors='replace')] = value.decode(errors='replace')
+        return env
+
+    @staticmethod
+    def port_info(device):
+        """从 sysfs 读取 USB 身份信息"""
+        try:
+            from serial.tools.list_ports_linux import SysFS
+            return PortInfo.from_list_port_info(SysFS(device))
+        except Exception:
+            return PortInfo(device)
+
+    @staticmethod
+    def wait_ready(device, timeout=DEVICE_READY_TIMEOUT):
+        """等待设备节点出现且当前用户可读写（权限由 udev 规则稍后设置），逐次加倍间隔重试"""
+        delay = 0.02
+        deadline = time.monotonic() + timeout
+        while not os.access(device, os.R_OK | os.W_OK):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        return True
+
+    def run(self, emit, stop_event, known):
+        # 启动时先做一次完整枚举，之后只依赖 uevent
+        for info in list_ports():
+            if info.device not in known:
+                emit(PortEvent('add', info, initial=True))
+        while not stop_event.is_set():
+            if self._rescan.is_set():
+                self._rescan.clear()
+                current = {p.device: p for p in list_ports()}
+                for device in list(known):
+                    if device not in current:
+                        emit(PortEvent('remove', known[device]))
+                for device, info in current.items():
+                    if device not in known:
+                        emit(PortEvent('add', info))
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            env = self.parse(data)
+            if env.get('SUBSYSTEM') != 'tty' or 'DEVNAME' not in env:
+                continue
+            if '/usb' not in env.get('DEVPATH', ''):
+                continue
+            # 内核报文中 DEVNAME 为相对 /dev 的名称，udev 报文中为完整路径
+            device = os.path.join('/dev', env['DEVNAME'])
+            if env.get('ACTION') == 'add' and device not in known:
+                if self.group == UEVENT_GROUP_KERNEL:
+                    self.wait_ready(device)
+                emit(PortEvent('add', self.port_info(device)))
+            elif env.get('ACTION') == 'remove' and device in known:
+                emit(PortEvent('remove', known[device]))
+        self.sock.close()
+
+    def rescan(self):
+        self._rescan.set()
+
+
+class FakeEventSource:
+    """测试用事件源，通过 add()/remove() 注入事件"""
+    def __init__(self, ports=None):
+        self._initial = list(ports or [])
+        self._queue = queue.Queue()
+
+    def add(self, port):
+        if isinstance(port, str):
+            port = PortInfo(port)
+        self._queue.put(PortEvent('add', port))
+
+    def remove(self, device):
+        self._queue.put(('remove', device))
+
+    def run(self, emit, stop_event, known):
+        for port in self._initial:
+            emit(PortEvent('add', port if isinstance(port, PortInfo) else PortInfo(port), initial=True))
+        while not stop_event.is_set():
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if isinstance(item, tuple):
+                port = known.get(item[1])
+                if port is not None:
+                    emit(PortEvent('remove', port))
+            else:
+                emit(item)
+
+    def rescan(self):
+        pass
+
+
+def default_event_source():
+    """Linux 上优先使用 netlink，失败时退回轮询"""
+    if sys.platform.startswith('linux'):
+        try:
+            return NetlinkEventSource()
+        except OSError:
+            pass
+    return PollingEventSource()
+
+
+class HotplugMonitor:
+    """在后台线程运行事件源，维护当前端口表并把事件交给回调
+
+    callback 在监控线程中被调用，GUI 需自行切换回 Tk 线程。
+    """
+    def __init__(self, callback, source=None):
+        self.callback = callback
+        self.source = source or default_event_source()
+        self._ports = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def ports(self):
+        """当前已知端口的快照，按设备名排序"""
+        with self._lock:
+            return [self._ports[device] for device in sorted(self._ports)]
+
+    def port_info(self, device):
+        """已知端口的 PortInfo，未知时返回 None"""
+        with self._lock:
+            return self._ports.get(device)
+
+    def rescan(self):
+        """请求事件源重新完整枚举一次"""
+        self.source.rescan()
+
+    def _run(self):
+        self.source.run(self._emit, self._stop, self._ports)
+
+    def _emit(self, event):
+        # 重新枚举和 uevent 可能先后报告同一次插拔，已知端口的 add、未知端口的 remove 不再通知
+        with self._lock:
+            if event.action == 'add':
+                if event.device in self._ports:
+                    return
+                self._ports[event.device] = event.port
+            else:
+                if self._ports.pop(event.device, None) is None:
+                    return
+        try:
+            self.callback(event)
+        except Exception:
+            pass
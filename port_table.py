@@ -0,0 +1,140 @@
+"""端口表
+
+保存任意数量串口的选择状态和烧录状态，可在任意线程更新。
+每次修改递增 version，界面定时比较 version，只在有变化时重绘可见的几行，
+几十个端口同时烧录时状态刷新的开销与端口总数无关。
+"""
+import re
+import threading
+import time
+
+IDLE = 'idle'
+
+# 各状态在界面上显示的文字
+STATE_TEXT = {
+    IDLE: '空闲',
+    'queued': '排队中',
+    'running': '烧录中',
+    'success': '成功',
+    'failed': '失败',
+    'cancelled': '已取消',
+}
+
+
+def natural_key(device):
+    """按数字大小排序设备名，COM2 排在 COM10 之前"""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', device)]
+
+
+class PortRow:
+    """端口表中的一行"""
+    def __init__(self, info, selected=True):
+        self.info = info
+        self.device = info.device
+        self.selected = selected
+        self.state = IDLE
+        self.message = ''
+        self.chip = None
+        self.mac = None
+        self.updated = time.time()
+
+    @property
+    def identity(self):
+        """界面上显示的 USB 位置或序列号"""
+        info = self.info
+        return info.location or info.serial_number or ''
+
+    def snapshot(self):
+        """用于比较是否需要重绘的内容元组"""
+        return (self.device, self.selected, self.state, self.message, self.identity, self.chip, self.mac)
+
+
+class PortTable:
+    """线程安全的端口表，按设备名（数字按大小）排序"""
+    def __init__(self):
+        self._rows = {}
+        self._order = []
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._order)
+
+    def add(self, info, selected=True):
+        """加入端口；已存在时只更新 USB 信息"""
+        with self._lock:
+            row = self._rows.get(info.device)
+            if row is None:
+                self._rows[info.device] = PortRow(info, selected)
+                self._order = sorted(self._rows, key=natural_key)
+            else:
+                row.info = info
+            self.version += 1
+
+    def remove(self, device):
+        with self._lock:
+            if self._rows.pop(device, None) is not None:
+                self._order = sorted(self._rows, key=natural_key)
+                self.version += 1
+
+    def sync(self, infos):
+        """与完整的端口列表对齐：加入新端口，移除已消失的端口"""
+        with self._lock:
+            current = {info.device: info for info in infos}
+            for device in list(self._rows):
+                if device not in current:
+                    del self._rows[device]
+            for device, info in current.items():
+                row = self._rows.get(device)
+                if row is None:
+                    self._rows[device] = PortRow(info)
+                else:
+                    row.info = info
+            self._order = sorted(self._rows, key=natural_key)
+            self.version += 1
+
+    def update(self, device, **fields):
+        """更新某个端口的状态字段（state、message、chip、mac 等）"""
+        with self._lock:
+            row = self._rows.get(device)
+            if row is None:
+                return
+            for key, value in fields.items():
+                setattr(row, key, value)
+            row.updated = time.time()
+            self.version += 1
+
+    def set_selected(self, device, selected):
+        self.update(device, selected=selected)
+
+    def select_all(self, selected=True):
+        with self._lock:
+            for row in self._rows.values():
+                row.selected = selected
+            self.version += 1
+
+    def row(self, device):
+        with self._lock:
+            return self._rows.get(device)
+
+    def slice(self, start, count):
+        """按排序取出 [start, start + count) 范围内的行"""
+        with self._lock:
+            return [self._rows[device] for device in self._order[start:start + count]]
+
+    def devices(self):
+        with self._lock:
+            return list(self._order)
+
+    def selected_devices(self):
+        with self._lock:
+            return [device for device in self._order if self._rows[device].selected]
+
+    def counts(self):
+        """各状态的端口数量"""
+        with self._lock:
+            counts = {}
+            for row in self._rows.values():
+                counts[row.state] = counts.get(row.state, 0) + 1
+            return counts
@@ -0,0 +1,161 @@
+"""烧录进度事件
+
+烧录引擎在阶段切换和每个数据块写入后发出 ProgressEvent（阶段、已完成/总字节数、瞬时速度、预计剩余时间），
+不再需要从 esptool 的输出文本中解析进度。
+ProgressBoard 只保留每个端口的最新事件，可在任意线程更新；界面按固定帧率读取快照重绘，
+事件再多也不会堆积到 Tk 线程。
+"""
+import math
+import threading
+import time
+from collections import deque
+
+# 超过该时间（秒）没有新进度的运行中端口视为停滞
+STALL_SECONDS = 5.0
+# 瞬时速度的平滑时间常数（秒）
+RATE_TAU = 1.0
+# 结束的端口在看板上保留的时间（秒）
+LINGER_SECONDS = 3.0
+FINISHED_PHASES = ('done', 'failed')
+
+
+class ProgressEvent:
+    """某个端口在某一时刻的进度，创建后只读"""
+    __slots__ = ('port', 'phase', 'done', 'total', 'kbps', 'eta', 'elapsed', 'timestamp')
+
+    def __init__(self, port, phase, done=0, total=0, kbps=0.0, eta=None, elapsed=0.0, timestamp=None):
+        self.port = port
+        self.phase = phase
+        self.done = done
+        self.total = total
+        self.kbps = kbps
+        self.eta = eta
+        self.elapsed = elapsed
+        self.timestamp = timestamp or time.time()
+
+    @property
+    def fraction(self):
+        if self.phase == 'done':
+            return 1.0
+        return min(self.done / self.total, 1.0) if self.total else 0.0
+
+    @property
+    def finished(self):
+        return self.phase in FINISHED_PHASES
+
+    def to_dict(self):
+        return {
+            'port': self.port,
+            'phase': self.phase,
+            'done': self.done,
+            'total': self.total,
+            'kbps': round(self.kbps, 1),
+            'eta': round(self.eta, 1) if self.eta is not None else None,
+            'elapsed': round(self.elapsed, 2),
+            'timestamp': self.timestamp,
+        }
+
+
+class JobProgress:
+    """一次烧录任务的进度计数，由烧录线程调用；callback 为 None 时只计数不发事件"""
+    def __init__(self, port, callback=None):
+        self.port = port
+        self.callback = callback
+        self.phase = 'load'
+        self.done = 0
+        self.total = 0
+        self.rate = 0.0
+        self.started = time.perf_counter()
+        self._last = self.started
+
+    def set_phase(self, phase):
+        self.phase = phase
+        self._emit()
+
+    def add_total(self, size):
+        self.total += size
+
+    def advance(self, size):
+        """写入了 size 字节（解压后），更新平滑后的瞬时速度"""
+        now = time.perf_counter()
+        dt = now - self._last
+        self._last = now
+        self.done += size
+        if dt > 0:
+            alpha = 1.0 - math.exp(-dt / RATE_TAU)
+            self.rate += (size / dt - self.rate) * alpha
+        self._emit()
+
+    def skip(self, size):
+        """不需写入的字节（差分未变化、空白扇区）直接计入完成量，不影响速度"""
+        self.done += size
+        self._last = time.perf_counter()
+        self._emit()
+
+    def rewind(self, done):
+        """降速重写当前固件时回退到该固件开始前的完成量"""
+        self.done = done
+        self._last = time.perf_counter()
+
+    def finish(self, success):
+        self.phase = 'done' if success else 'failed'
+        self._emit()
+
+    def _emit(self):
+        if self.callback is None:
+            return
+        remaining = max(self.total - self.done, 0)
+        eta = remaining / self.rate if self.rate > 0 and self.phase == 'write' else None
+        try:
+            self.callback(ProgressEvent(self.port, self.phase, self.done, self.total, self.rate / 1024.0, eta,
+                                        time.perf_counter() - self.started))
+        except Exception:
+            pass
+
+
+class ProgressBoard:
+    """各端口的最新进度和整站吞吐量，update() 可直接作为 FlashEngine.flash 的 progress 回调"""
+    def __init__(self, stall_seconds=STALL_SECONDS, linger=LINGER_SECONDS, window=600):
+        self.stall_seconds = stall_seconds
+        self.linger = linger
+        self.window = window
+        self._latest = {}
+        self._finished = deque()
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def update(self, event):
+        with self._lock:
+            self._latest[event.port] = event
+            if event.phase == 'done':
+                self._finished.append(event.timestamp)
+            self.version += 1
+
+    def snapshot(self, now=None):
+        """[(事件, 是否停滞)]：停滞的排在最前，其余按进度从低到高；已结束超过 linger 秒的端口移除"""
+        now = now or time.time()
+        with self._lock:
+            for port, event in list(self._latest.items()):
+                if event.finished and now - event.timestamp > self.linger:
+                    del self._latest[port]
+                    self.version += 1
+            events = list(self._latest.values())
+        rows = [(event, not event.finished and now - event.timestamp > self.stall_seconds) for event in events]
+        rows.sort(key=lambda row: (row[0].finished, not row[1], row[0].fraction, row[0].port))
+        return rows
+
+    def throughput(self, now=None):
+        """运行中的端口数、合计写入速度（KB/s）和最近 window 秒折算的每小时板数"""
+        now = now or time.time()
+        with self._lock:
+            while self._finished and now - self._finished[0] > self.window:
+                self._finished.popleft()
+            active = [event for event in self._latest.values() if not event.finished]
+            finished = len(self._finished)
+            first = self._finished[0] if self._finished else now
+        span = max(min(self.window, now - first), 60.0)
+        return {
+            'active': len(active),
+            'kbps': sum(event.kbps for event in active if event.phase == 'write'),
+            'boards_per_hour': finished * 3600.0 / span if finished else 0.0,
+        }
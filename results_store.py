@@ -0,0 +1,315 @@
+"""烧录结果数据库
+
+每个任务一条记录：端口、MAC、芯片、序列号、固件哈希、各阶段耗时、结果和压缩后的过程日志，
+保存在 SQLite（WAL 模式）中，按 MAC、时间和固件建索引，用于追溯和良率统计。
+
+烧录线程只把结果放进队列，由唯一的写入线程批量插入，32 路同时烧录也不会等待磁盘。
+
+命令行:
+    python results_store.py yield --by shift --since 2024-01-01
+    python results_store.py yield --by port
+    python results_store.py history aa:bb:cc:dd:ee:ff
+"""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+RESULTS_DB = os.path.join('logs', 'results.db')
+SCHEMA_VERSION = 1
+
+# 班次：(开始小时, 名称)；最早一班开始之前的时间归入前一天的最后一班，如 ((8, '白班'), (20, '夜班'))
+DEFAULT_SHIFTS = ((0, '夜班'), (8, '早班'), (16, '中班'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    elapsed REAL,
+    station TEXT,
+    port TEXT,
+    mac TEXT,
+    chip TEXT,
+    serial TEXT,
+    firmware TEXT,
+    success INTEGER NOT NULL,
+    error_phase TEXT,
+    error TEXT,
+    mismatch TEXT,
+    phases TEXT,
+    bytes_written INTEGER,
+    write_kbps REAL,
+    baud INTEGER,
+    job_id INTEGER,
+    attempt INTEGER,
+    log BLOB
+);
+CREATE TABLE IF NOT EXISTS job_images (
+    job INTEGER NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+    address INTEGER NOT NULL,
+    size INTEGER,
+    sha256 TEXT,
+    md5 TEXT,
+    path TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_mac ON jobs(mac, started);
+CREATE INDEX IF NOT EXISTS jobs_started ON jobs(started);
+CREATE INDEX IF NOT EXISTS jobs_firmware ON jobs(firmware, started);
+CREATE INDEX IF NOT EXISTS jobs_port ON jobs(port, started);
+CREATE INDEX IF NOT EXISTS job_images_job ON job_images(job);
+CREATE INDEX IF NOT EXISTS job_images_sha256 ON job_images(sha256);
+"""
+
+
+def firmware_key(images):
+    """一组固件的标识：按地址排序后各固件 SHA-256 的组合哈希"""
+    parts = sorted(f"{image['address']}:{image.get('sha256') or image.get('md5')}" for image in images)
+    if not parts:
+        return None
+    return hashlib.sha256('\n'.join(parts).encode('ascii')).hexdigest()
+
+
+def compress_log(lines):
+    if not lines:
+        return None
+    return zlib.compress('\n'.join(lines).encode('utf-8'), 6)
+
+
+def decompress_log(blob):
+    return zlib.decompress(blob).decode('utf-8') if blob else ''
+
+
+def connect(path):
+    """打开数据库并建表，启用 WAL 以便读写互不阻塞"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA foreign_keys=ON')
+    if conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        conn.executescript(SCHEMA)
+        conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+        conn.commit()
+    return conn
+
+
+class ResultsStore:
+    """结果数据库，record() 可在任意线程调用，插入由后台写入线程批量完成"""
+    def __init__(self, path=RESULTS_DB, batch_size=256, station=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.station = station
+        self._queue = queue.SimpleQueue()
+        # 在调用方线程建表，路径或权限错误立即暴露
+        connect(path).close()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self.written = 0
+
+    def record(self, result, **labels):
+        """记录一次烧录结果（FlashResult），labels 可包含 job_id、attempt"""
+        record = result.to_dict()
+        self.record_dict(record, result.log, **labels)
+
+    def record_dict(self, record, log=None, **labels):
+        """记录 to_dict() 形式的结果，如多机协调端收到的代理结果"""
+        record = dict(record, **labels)
+        self._queue.put((record, compress_log(log or record.get('log'))))
+
+    def close(self, timeout=5):
+        """写完队列中剩余的记录后停止写入线程"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        conn = connect(self.path)
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            # 取出已排队的全部记录，合并为一个事务
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+            try:
+                with conn:
+                    for record, log in batch:
+                        self._insert(conn, record, log)
+                self.written += len(batch)
+            except sqlite3.Error as e:
+                sys.stderr.write(f"写入结果数据库失败: {e}\n")
+        conn.close()
+
+    def _insert(self, conn, record, log):
+        images = record.get('images') or []
+        cursor = conn.execute(
+            'INSERT INTO jobs (started, elapsed, station, port, mac, chip, serial, firmware, success, '
+            'error_phase, error, mismatch, phases, bytes_written, write_kbps, baud, job_id, attempt, log) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                record.get('started') or time.time(),
+                record.get('elapsed'),
+                record.get('agent') or self.station,
+                record.get('port'),
+                record.get('mac'),
+                record.get('chip'),
+                record.get('serial'),
+                firmware_key(images),
+                1 if record.get('success') else 0,
+                record.get('error_phase'),
+                record.get('error'),
+                record.get('mismatch'),
+                json.dumps(record.get('phases') or {}),
+                record.get('bytes_written'),
+                record.get('write_kbps'),
+                record.get('baud'),
+                record.get('job_id'),
+                record.get('attempt', record.get('attempts')),
+                log,
+            )
+        )
+        conn.executemany(
+            'INSERT INTO job_images (job, address, size, sha256, md5, path) VALUES (?, ?, ?, ?, ?, ?)',
+            [(cursor.lastrowid, int(str(image['address']), 0), image.get('size'), image.get('sha256'),
+              image.get('md5'), image.get('path')) for image in images]
+        )
+
+
+class ResultsQuery:
+    """只读查询；WAL 模式下与写入线程并行"""
+    def __init__(self, path=RESULTS_DB):
+        self.conn = connect(path)
+        self.conn.row_factory = sqlite3.Row
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def _range(since, until):
+        clauses, params = [], []
+        if since is not None:
+            clauses.append('started >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('started < ?')
+            params.append(until)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def yield_by_port(self, since=None, until=None):
+        """各端口的任务数、成功数和良率"""
+        where, params = self._range(since, until)
+        rows = self.conn.execute(
+            'SELECT port, COUNT(*) AS total, SUM(success) AS passed, AVG(CASE WHEN success THEN elapsed END) AS cycle '
+            f'FROM jobs{where} GROUP BY port ORDER BY port', params
+        ).fetchall()
+        return [self._yield_row(row, port=row['port']) for row in rows]
+
+    def yield_by_shift(self, since=None, until=None, shifts=DEFAULT_SHIFTS):
+        """按 (日期, 班次) 统计良率；跨零点的班次归入开始那一天"""
+        starts = sorted(shifts)
+        first = starts[0][0]
+
+        def quote(name):
+            return "'" + name.replace("'", "''") + "'"
+
+        hour = "CAST(strftime('%H', started, 'unixepoch', 'localtime') AS INTEGER)"
+        cases = ' '.join(f"WHEN {hour} >= {start} THEN {quote(name)}" for start, name in reversed(starts))
+        last = quote(starts[-1][1])
+        where, params = self._range(since, until)
+        rows = self.conn.execute(
+            f"SELECT date(started - {first * 3600}, 'unixepoch', 'localtime') AS day, "
+            f"CASE {cases} ELSE {last} END AS shift, "
+            'COUNT(*) AS total, SUM(success) AS passed, AVG(CASE WHEN success THEN elapsed END) AS cycle '
+            f'FROM jobs{where} GROUP BY day, shift ORDER BY day, MIN(started)', params
+        ).fetchall()
+        return [self._yield_row(row, day=row['day'], shift=row['shift']) for row in rows]
+
+    def yield_by_firmware(self, since=None, until=None):
+        where, params = self._range(since, until)
+        rows = self.conn.execute(
+            'SELECT firmware, COUNT(*) AS total, SUM(success) AS passed, AVG(CASE WHEN success THEN elapsed END) AS cycle '
+            f'FROM jobs{where} GROUP BY firmware ORDER BY MIN(started)', params
+        ).fetchall()
+        return [self._yield_row(row, firmware=row['firmware']) for row in rows]
+
+    @staticmethod
+    def _yield_row(row, **keys):
+        total, passed = row['total'], row['passed'] or 0
+        keys.update({
+            'total': total,
+            'passed': passed,
+            'failed': total - passed,
+            'yield': round(passed / total, 4) if total else None,
+            'avg_cycle': round(row['cycle'], 2) if row['cycle'] is not None else None,
+        })
+        return keys
+
+    def history(self, mac, with_log=False):
+        """某块板子（按 MAC）的全部烧录记录，最新的在前"""
+        rows = self.conn.execute('SELECT * FROM jobs WHERE mac = ? ORDER BY started DESC', (mac.lower(),)).fetchall()
+        records = []
+        for row in rows:
+            record = dict(row)
+            record['phases'] = json.loads(record['phases'] or '{}')
+            log = record.pop('log')
+            if with_log:
+                record['log'] = decompress_log(log)
+            records.append(record)
+        return records
+
+
+def parse_time(text):
+    """YYYY-MM-DD 或 YYYY-MM-DD HH:MM 转为时间戳"""
+    if text is None:
+        return None
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"无效的时间: {text}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="查询烧录结果数据库")
+    parser.add_argument('--db', default=RESULTS_DB, help=f"数据库路径 (默认 {RESULTS_DB})")
+    commands = parser.add_subparsers(dest='command', required=True)
+    stats = commands.add_parser('yield', help="良率统计")
+    stats.add_argument('--by', choices=('shift', 'port', 'firmware'), default='shift')
+    stats.add_argument('--since', type=parse_time, default=None, help="开始时间 YYYY-MM-DD[ HH:MM]")
+    stats.add_argument('--until', type=parse_time, default=None, help="结束时间 YYYY-MM-DD[ HH:MM]")
+    history = commands.add_parser('history', help="按 MAC 查询烧录记录")
+    history.add_argument('mac')
+    history.add_argument('--log', action='store_true', help="同时输出过程日志")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        sys.stderr.write(f"数据库不存在: {args.db}\n")
+        return 2
+    query = ResultsQuery(args.db)
+    try:
+        if args.command == 'yield':
+            rows = getattr(query, 'yield_by_' + args.by)(args.since, args.until)
+        else:
+            rows = query.history(args.mac, args.log)
+    finally:
+        query.close()
+    for row in rows:
+        print(json.dumps(row, ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""启动耗时分析
+
+命令行加 --profile-startup（或设置环境变量 ESP32_FLASHER_PROFILE=1）时记录：
+    - 主程序模块中各条 import 的耗时（含其依赖）
+    - 初始化各阶段的耗时和从进程启动到界面可操作的总时间
+结果写入主日志，并保存到 logs/startup_profile.json 供 benchmarks/bench_startup.py 汇总。
+未启用时 mark()/phase() 只是空操作。
+
+须在主程序中最先导入本模块，才能统计到其余的 import。
+"""
+import builtins
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_FLAG = '--profile-startup'
+EXIT_FLAG = '--profile-exit'
+PROFILE_ENV = 'ESP32_FLASHER_PROFILE'
+PROFILE_FILE = 'startup_profile.json'
+
+
+class StartupProfile:
+    """记录启动过程的时间点和耗时，只统计主线程"""
+    def __init__(self, enabled=False, roots=('__main__', 'esp32_flasher')):
+        self.enabled = enabled
+        self.roots = roots
+        self.start = time.perf_counter()
+        self.imports = []
+        self.phases = []
+        self.marks = []
+        self._import = None
+        self._depth = 0
+        self._thread = threading.get_ident()
+        if enabled:
+            self._install()
+
+    def _install(self):
+        """替换 __import__，记录 roots 中的模块发起的 import，其依赖的耗时计入该条 import"""
+        self._import = builtins.__import__
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            importer = globals.get('__name__') if globals else None
+            if importer not in self.roots or threading.get_ident() != self._thread or name in sys.modules:
+                return self._import(name, globals, locals, fromlist, level)
+            depth = self._depth
+            self._depth += 1
+            start = time.perf_counter()
+            try:
+                return self._import(name, globals, locals, fromlist, level)
+            finally:
+                self._depth -= 1
+                self.imports.append((name, time.perf_counter() - start, depth))
+
+        builtins.__import__ = timed_import
+
+    def _uninstall(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def mark(self, name):
+        """记录从启动到此刻的时间"""
+        if self.enabled:
+            self.marks.append((name, self.elapsed()))
+
+    @contextmanager
+    def phase(self, name):
+        """统计一段初始化代码的耗时"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def finish(self):
+        """界面可操作时调用：停止统计 import，返回报告"""
+        self.mark('interactive')
+        self._uninstall()
+        return self.report()
+
+    def report(self):
+        imports = sorted(self.imports, key=lambda item: -item[1])
+        return {
+            'interactive': dict(self.marks).get('interactive'),
+            # 嵌套的 import（如 __main__ 导入 esp32_flasher 时）已计入外层，不重复累加
+            'imports_total': sum(t for _, t, depth in self.imports if depth == 0),
+            'imports': [{'module': name, 'seconds': round(t, 6)} for name, t, _ in imports],
+            'phases': [{'phase': name, 'seconds': round(t, 6)} for name, t in self.phases],
+            'marks': [{'mark': name, 'seconds': round(t, 6)} for name, t in self.marks],
+        }
+
+    @staticmethod
+    def format(report, limit=10):
+        lines = [f"启动耗时 {report['interactive'] * 1000:.0f} ms，其中 import {report['imports_total'] * 1000:.0f} ms"]
+        for item in report['imports'][:limit]:
+            lines.append(f"  import {item['module']:<24} {item['seconds'] * 1000:8.1f} ms")
+        for item in report['phases']:
+            lines.append(f"  {item['phase']:<31} {item['seconds'] * 1000:8.1f} ms")
+        return '\n'.join(lines)
+
+    def save(self, report, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, PROFILE_FILE)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, path)
+        return path
+
+
+def profiling_requested(argv=None):
+    argv = sys.argv if argv is None else argv
+    return PROFILE_FLAG in argv or os.environ.get(PROFILE_ENV, '') not in ('', '0')
+
+
+PROFILE = StartupProfile(profiling_requested())
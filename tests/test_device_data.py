@@ -0,0 +1,43 @@
+"""NVS 分区生成：检查生成的页和条目布局"""
+import struct
+
+from device_data import (NVS_ENTRY_SIZE, NVS_FIRST_ENTRY_OFFSET, NVS_MAX_ENTRIES, NVS_PAGE_SIZE,
+                         NVS_TYPE_BLOB_DATA, NVS_TYPE_BLOB_INDEX, NvsPartition)
+
+
+def entries(image):
+    """按页返回已写入条目的头部，跳过数据块和字符串占用的后续条目"""
+    pages = []
+    for base in range(0, len(image), NVS_PAGE_SIZE):
+        page = image[base:base + NVS_PAGE_SIZE]
+        found = []
+        index = 0
+        while index < NVS_MAX_ENTRIES:
+            state = (page[32 + index // 4] >> ((index % 4) * 2)) & 3
+            if state == 3:
+                break
+            offset = NVS_FIRST_ENTRY_OFFSET + index * NVS_ENTRY_SIZE
+            header = page[offset:offset + NVS_ENTRY_SIZE]
+            found.append(header)
+            index += header[2]
+        pages.append(found)
+    return pages
+
+
+def test_blob_starting_at_last_entry_moves_to_new_page():
+    nvs = NvsPartition(0x6000)
+    nvs.set_namespace('factory')
+    # 填到本页只剩最后一个条目
+    for i in range(NVS_MAX_ENTRIES - 2):
+        nvs.add(f'k{i}', 'u8', i)
+    assert nvs.entry == NVS_MAX_ENTRIES - 1
+    data = bytes(range(100))
+    nvs.add('cal', 'binary', data)
+
+    first, second = entries(nvs.to_bytes())[:2]
+    assert all(header[1] != NVS_TYPE_BLOB_DATA for header in first)
+    chunks = [header for header in second if header[1] == NVS_TYPE_BLOB_DATA]
+    assert len(chunks) == 1
+    assert struct.unpack_from('<H', chunks[0], 24)[0] == len(data)
+    index = [header for header in first + second if header[1] == NVS_TYPE_BLOB_INDEX]
+    assert struct.unpack_from('<IB', index[0], 24) == (len(data), 1)
@@ -0,0 +1,153 @@
+"""用 benchmarks/fake_esp_rom.py 的模拟设备测试单会话烧录引擎"""
+import os
+import threading
+
+import pytest
+
+if not hasattr(os, 'openpty'):
+    pytest.skip("模拟设备依赖 pty", allow_module_level=True)
+
+from chip_info import ChipCache  # noqa: E402
+from fake_esp_rom import FakeStation  # noqa: E402
+from firmware_cache import FirmwareCache  # noqa: E402
+from flash_engine import DIFF_REGION_SIZE, FlashEngine  # noqa: E402
+
+SECTOR = 0x1000
+ADDRESS = 0x10000
+
+
+@pytest.fixture
+def station():
+    """返回创建模拟设备的函数；不模拟波特率和 flash 速度，测试只关心协议和结果"""
+    stations = []
+
+    def make(count=1, **kwargs):
+        options = dict(flash_mb=4, write_speed=0, erase_speed=0, md5_speed=0, simulate_baud=False)
+        options.update(kwargs)
+        created = FakeStation(count, **options).start()
+        stations.append(created)
+        return created
+
+    yield make
+    for created in stations:
+        created.stop()
+
+
+def make_engine(**kwargs):
+    options = dict(baud=921600, cache=FirmwareCache(), chip_cache=ChipCache(), before='no_reset',
+                   after='no_reset', port_lookup=lambda port: None, resume_backoff=0.05)
+    options.update(kwargs)
+    return FlashEngine(**options)
+
+
+def write_image(tmp_path, data, name='app.bin'):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def flashed(device, address, size):
+    return bytes(device.flash[address:address + size])
+
+
+def test_flash_success(station, tmp_path):
+    data = os.urandom(16 * SECTOR)
+    devices = station()
+    port = devices.ports[0]
+    result = make_engine().flash(port, [(write_image(tmp_path, data), hex(ADDRESS))])
+    assert result.success, result.error
+    assert result.chip == 'ESP32-S3'
+    assert result.images[0].verified
+    assert result.images[0].written == len(data)
+    assert flashed(devices.device(port), ADDRESS, len(data)) == data
+
+
+def test_cancel_during_write(station, tmp_path):
+    data = os.urandom(64 * SECTOR)
+    devices = station()
+    cancel = threading.Event()
+
+    def progress(event):
+        if event.phase == 'write' and event.done:
+            cancel.set()
+
+    result = make_engine().flash(devices.ports[0], [(write_image(tmp_path, data), hex(ADDRESS))],
+                                 cancel=cancel, progress=progress)
+    assert not result.success
+    assert result.error_phase == 'cancelled'
+
+
+def test_resume_after_link_drop(station, tmp_path):
+    data = os.urandom(64 * SECTOR)
+    devices = station(drop_after=32 * SECTOR, outage=0.2)
+    port = devices.ports[0]
+    result = make_engine(resume_retries=3).flash(port, [(write_image(tmp_path, data), hex(ADDRESS))])
+    assert result.success, result.error
+    assert devices.device(port).stats['link_drops'] == 1
+    assert len(result.recoveries) == 1
+    # 从已确认的位置续写，而不是从头重写
+    assert devices.device(port).stats['flash_written'] < 2 * len(data)
+    assert flashed(devices.device(port), ADDRESS, len(data)) == data
+
+
+def test_link_drop_without_resume_fails(station, tmp_path):
+    data = os.urandom(64 * SECTOR)
+    devices = station(drop_after=32 * SECTOR, outage=0.2)
+    result = make_engine(resume_retries=0).flash(devices.ports[0], [(write_image(tmp_path, data), hex(ADDRESS))])
+    assert not result.success
+    assert result.recoveries == []
+
+
+def test_diff_skips_unchanged_regions(station, tmp_path):
+    data = bytearray(os.urandom(8 * DIFF_REGION_SIZE))
+    devices = station()
+    port = devices.ports[0]
+    assert make_engine().flash(port, [(write_image(tmp_path, bytes(data)), hex(ADDRESS))]).success
+
+    data[3 * DIFF_REGION_SIZE + 100:3 * DIFF_REGION_SIZE + 116] = os.urandom(16)
+    path = write_image(tmp_path, bytes(data), 'app2.bin')
+    result = make_engine(diff=True).flash(port, [(path, hex(ADDRESS))])
+    assert result.success, result.error
+    image = result.images[0]
+    # 只重写内容变化的那一个比较区域
+    assert image.written == DIFF_REGION_SIZE
+    assert image.skipped == len(data) - image.written
+    assert flashed(devices.device(port), ADDRESS, len(data)) == bytes(data)
+
+
+def test_sparse_skips_blank_sectors(station, tmp_path):
+    data = os.urandom(SECTOR) + b'\xff' * (30 * SECTOR) + os.urandom(SECTOR)
+    devices = station()
+    port = devices.ports[0]
+    device = devices.device(port)
+    # 空白区域原有的旧数据必须被擦除
+    device.flash[ADDRESS:ADDRESS + len(data)] = b'\x00' * len(data)
+    result = make_engine(sparse=True).flash(port, [(write_image(tmp_path, data), hex(ADDRESS))])
+    assert result.success, result.error
+    image = result.images[0]
+    assert image.blank == 30 * SECTOR
+    assert image.written == 2 * SECTOR
+    assert device.stats['flash_written'] < len(data)
+    assert flashed(device, ADDRESS, len(data)) == data
+
+
+def test_verify_mismatch_reports_range(station, tmp_path):
+    data = os.urandom(16 * SECTOR)
+    devices = station()
+    port = devices.ports[0]
+    device = devices.device(port)
+    bad = ADDRESS + 7 * SECTOR + 100
+    write_flash = device._write_flash
+
+    def corrupting_write(offset, chunk):
+        write_flash(offset, chunk)
+        if offset <= bad < offset + len(chunk):
+            device.flash[bad] ^= 0xFF
+
+    device._write_flash = corrupting_write
+    result = make_engine(verify='md5').flash(port, [(write_image(tmp_path, data), hex(ADDRESS))])
+    assert not result.success
+    assert result.error_phase == 'verify'
+    assert result.mismatch
+    assert any(start <= bad < end for start, end in result.mismatch)
+
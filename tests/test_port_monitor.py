@@ -0,0 +1,158 @@
+"""热插拔监控：FakeEventSource 注入事件，netlink 报文解析使用抓取的原始字节"""
+import queue
+import threading
+
+import port_monitor
+from port_monitor import (UEVENT_GROUP_KERNEL, UEVENT_GROUP_UDEV, FakeEventSource, HotplugMonitor,
+                          NetlinkEventSource, PortInfo)
+
+# 内核组（1）广播的 uevent：第一段为 ACTION@DEVPATH，DEVNAME 相对 /dev
+KERNEL_ADD = (
+    b'add@/devices/pci0000:00/0000:00:14.0/usb1/1-2/1-2:1.0/ttyUSB0/tty/ttyUSB0\x00'
+    b'ACTION=add\x00DEVPATH=/devices/pci0000:00/0000:00:14.0/usb1/1-2/1-2:1.0/ttyUSB0/tty/ttyUSB0\x00'
+    b'SUBSYSTEM=tty\x00MAJOR=188\x00MINOR=0\x00DEVNAME=ttyUSB0\x00SEQNUM=4242\x00'
+)
+KERNEL_REMOVE = (
+    b'remove@/devices/pci0000:00/0000:00:14.0/usb1/1-2/1-2:1.0/ttyUSB0/tty/ttyUSB0\x00'
+    b'ACTION=remove\x00DEVPATH=/devices/pci0000:00/0000:00:14.0/usb1/1-2/1-2:1.0/ttyUSB0/tty/ttyUSB0\x00'
+    b'SUBSYSTEM=tty\x00MAJOR=188\x00MINOR=0\x00DEVNAME=ttyUSB0\x00SEQNUM=4250\x00'
+)
+# udevd 转发到组 2 的报文：40 字节 libudev 头，属性从 properties_off 开始，DEVNAME 为完整路径
+UDEV_ADD = (
+    b'libudev\x00\xfe\xed\xca\xfe(\x00\x00\x00(\x00\x00\x00\xac\x00\x00\x00,/\x9f\x1e'
+    b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+    b'ACTION=add\x00DEVPATH=/devices/pci0000:00/0000:00:14.0/usb1/1-2/1-2:1.0/ttyUSB0/tty/ttyUSB0\x00'
+    b'SUBSYSTEM=tty\x00DEVNAME=/dev/ttyUSB0\x00SEQNUM=4242\x00MAJOR=188\x00MINOR=0\x00ID_VENDOR_ID=10c4\x00'
+)
+# 非 USB 的串口不关心
+KERNEL_ADD_BUILTIN = (
+    b'add@/devices/platform/serial8250/tty/ttyS4\x00ACTION=add\x00'
+    b'DEVPATH=/devices/platform/serial8250/tty/ttyS4\x00SUBSYSTEM=tty\x00DEVNAME=ttyS4\x00SEQNUM=4243\x00'
+)
+
+
+def start_monitor(source):
+    events = queue.Queue()
+    monitor = HotplugMonitor(events.put, source=source)
+    monitor.start()
+    return monitor, events
+
+
+def drain(events, count, timeout=2.0):
+    return [events.get(timeout=timeout) for _ in range(count)]
+
+
+def assert_quiet(events):
+    try:
+        event = events.get(timeout=0.3)
+    except queue.Empty:
+        return
+    raise AssertionError(f"多余的事件: {event!r}")
+
+
+def test_initial_enumeration_emits_add():
+    source = FakeEventSource(['/dev/ttyUSB0', PortInfo('/dev/ttyUSB1', serial_number='A1')])
+    monitor, events = start_monitor(source)
+    try:
+        first = drain(events, 2)
+        assert [(e.action, e.device) for e in first] == [('add', '/dev/ttyUSB0'), ('add', '/dev/ttyUSB1')]
+        assert monitor.port_info('/dev/ttyUSB1').serial_number == 'A1'
+        assert [p.device for p in monitor.ports()] == ['/dev/ttyUSB0', '/dev/ttyUSB1']
+        assert all(e.initial for e in first)
+        # 启动后插入的设备不是初始枚举，自动烧录只处理这类事件
+        source.add('/dev/ttyUSB2')
+        later = drain(events, 1)[0]
+        assert (later.device, later.initial) == ('/dev/ttyUSB2', False)
+    finally:
+        monitor.stop()
+
+
+def test_duplicate_add_and_remove_are_suppressed():
+    source = FakeEventSource(['/dev/ttyUSB0'])
+    monitor, events = start_monitor(source)
+    try:
+        drain(events, 1)
+        # 重新枚举与 uevent 重复报告同一次插入
+        source.add('/dev/ttyUSB0')
+        assert_quiet(events)
+        source.remove('/dev/ttyUSB0')
+        source.remove('/dev/ttyUSB0')
+        assert [(e.action, e.device) for e in drain(events, 1)] == [('remove', '/dev/ttyUSB0')]
+        assert_quiet(events)
+        # 拔出后重新插入仍然通知
+        source.add('/dev/ttyUSB0')
+        assert [(e.action, e.device) for e in drain(events, 1)] == [('add', '/dev/ttyUSB0')]
+        assert [p.device for p in monitor.ports()] == ['/dev/ttyUSB0']
+    finally:
+        monitor.stop()
+
+
+def test_parse_kernel_uevent():
+    env = NetlinkEventSource.parse(KERNEL_ADD)
+    assert env['ACTION'] == 'add'
+    assert env['SUBSYSTEM'] == 'tty'
+    assert env['DEVNAME'] == 'ttyUSB0'
+    assert '/usb1/' in env['DEVPATH']
+
+
+def test_parse_udev_message():
+    env = NetlinkEventSource.parse(UDEV_ADD)
+    assert env['ACTION'] == 'add'
+    assert env['DEVNAME'] == '/dev/ttyUSB0'
+    assert env['ID_VENDOR_ID'] == '10c4'
+    # 二进制头不能被当成属性
+    assert not any(key.startswith('libudev') for key in env)
+
+
+def test_parse_truncated_udev_header():
+    assert NetlinkEventSource.parse(UDEV_ADD[:20]) == {}
+
+
+class FakeSocket:
+    """依次返回抓取的报文，读完后抛出 OSError 让事件循环退出"""
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    def recv(self, size):
+        if not self.messages:
+            raise OSError("closed")
+        return self.messages.pop(0)
+
+    def close(self):
+        pass
+
+
+def run_netlink(group, messages, monkeypatch):
+    source = NetlinkEventSource.__new__(NetlinkEventSource)
+    source.group = group
+    source.sock = FakeSocket(messages)
+    source._rescan = threading.Event()
+    waited = []
+    monkeypatch.setattr(port_monitor, 'list_ports', lambda: [])
+    monkeypatch.setattr(NetlinkEventSource, 'port_info', staticmethod(PortInfo))
+    monkeypatch.setattr(NetlinkEventSource, 'wait_ready', staticmethod(lambda device: waited.append(device)))
+    known = {}
+    emitted = []
+
+    def emit(event):
+        emitted.append((event.action, event.device))
+        if event.action == 'add':
+            known[event.device] = event.port
+        else:
+            known.pop(event.device, None)
+
+    source.run(emit, threading.Event(), known)
+    return emitted, waited
+
+
+def test_netlink_kernel_group_waits_for_device(monkeypatch):
+    emitted, waited = run_netlink(UEVENT_GROUP_KERNEL, [KERNEL_ADD_BUILTIN, KERNEL_ADD, KERNEL_REMOVE], monkeypatch)
+    assert emitted == [('add', '/dev/ttyUSB0'), ('remove', '/dev/ttyUSB0')]
+    # 内核事件早于 udev 设置权限，报告 add 前先等设备可用
+    assert waited == ['/dev/ttyUSB0']
+
+
+def test_netlink_udev_group_uses_full_devname(monkeypatch):
+    emitted, waited = run_netlink(UEVENT_GROUP_UDEV, [UDEV_ADD], monkeypatch)
+    assert emitted == [('add', '/dev/ttyUSB0')]
+    assert waited == []